@@ -11,13 +11,15 @@ Plot climatological seasonal cycles and 2022 anomalies of:
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import os
 import sys
 sys.path.append('../')
 import preprocessing.Preprocessing_Get_Data as PrepGD
 import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Climatology as PrepClim
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Statistics as PrepStat
 
 def Plot_Linechart(Plot_Data, Plot_Config):
 
@@ -82,30 +84,25 @@ if (__name__ == '__main__'):
 		# Print message
 		print('Plotting {Var}...'.format(Var=i_Var))
 
-		# Get data
-		Data, Time, Lat, Lon = PrepGD.Get_Data(i_Var)
+		# Get climatology of the spatial average (precomputed and stored)
+		Clim = PrepClim.Get_Climatology(i_Var, 'SouthChina_Analysis', Spatial_Average=True)
+		Data_Mean = Clim['Mean']
 
-		# Calculate spatial average
-		Data = Prep.Calc_SpatialAverage(Data, Lat, Lon, 'SouthChina_Analysis')
-		
-		# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-		Time = np.array([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
-		
-		# ==================================================
-		# Get climatological seasonal cycle
-		Data_SeasonalCycle = Data.reshape(-1, 12)
+		# Open 2022 data lazily
+		Data_2022, Time, Lat, Lon = PrepGD.Open_Data(i_Var, Time_Range=['2022-01', '2022-12'])
+
+		# Calculate spatial average (streamed in time chunks) and convert units
+		Data_2022 = Prep.Calc_SpatialAverage(Data_2022, Lat, Lon, 'SouthChina_Analysis', Memory_Budget=Prep.Memory_Budget_Default)
+		Data_2022 = PrepGD.Convert_Unit(Data_2022, Time, i_Var)
 
-		# Extract 2022 data by selecting the Time with year 2022
-		Data_2022 = Data[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
+		# Arrange 2022 data into 12 months (nan for months not available yet)
+		Data_2022 = PrepCal.Select_Year(Data_2022, PrepCal.Get_Calendar(Time), 2022)
 
 		# ==================================================
 		# Plot climatological seasonal cycle
 		Plot_Data = {\
-			'Data_Mean': np.nanmean(Data_SeasonalCycle, axis=0), \
-			'Data_CI'  : [\
-				np.nanmean(Data_SeasonalCycle, axis=0) - 1.96 * np.nanstd(Data_SeasonalCycle, axis=0) / np.sqrt(Data_SeasonalCycle.shape[0]), \
-				np.nanmean(Data_SeasonalCycle, axis=0) + 1.96 * np.nanstd(Data_SeasonalCycle, axis=0) / np.sqrt(Data_SeasonalCycle.shape[0]), \
-			], \
+			'Data_Mean': Data_Mean, \
+			'Data_CI'  : PrepStat.Calc_CI_t(Clim), \
 			'Data_2022': Data_2022, \
 		}
 
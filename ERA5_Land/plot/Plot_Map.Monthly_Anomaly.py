@@ -11,17 +11,18 @@ Plot monthly anomalies of:
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import cartopy
 import cartopy.crs as ccrs
-import warnings
 import os
 import sys
 sys.path.append('../')
 import preprocessing.Preprocessing_Get_Data as PrepGD
 import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Climatology as PrepClim
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Statistics as PrepStat
 
 def Get_Plot_vmin_vmax(Var):
 
@@ -119,11 +120,11 @@ def Plot_Map(Plot_Data, Plot_Config):
 		transform=ccrs.PlateCarree(), \
 	)
 
-	# Plot: hatch for Data_Significance < -2 or > 2
+	# Plot: hatch for grid points significant with FDR control (Data_Significance is a boolean mask)
 	ax.contourf(\
 		Plot_Data['Lon'], Plot_Data['Lat'], \
-		np.where((~np.isnan(Plot_Data['Data_Anomaly'])), Plot_Data['Data_Significance'], np.nan), \
-		colors='none', levels=[-999, -2, 2, 999], hatches=['////', '', '////'], zorder=9, \
+		np.where((~np.isnan(Plot_Data['Data_Anomaly'])), Plot_Data['Data_Significance'].astype(np.float64), np.nan), \
+		colors='none', levels=[-0.5, 0.5, 1.5], hatches=['', '////'], zorder=9, \
 		transform=ccrs.PlateCarree(), \
 	)
 	mpl.rcParams['hatch.linewidth'] = 0.5
@@ -170,38 +171,29 @@ if (__name__ == '__main__'):
 		# Print message
 		print('Plotting {Var}...'.format(Var=i_Var))
 
-		# Get data
-		Data, Time, Lat, Lon = PrepGD.Get_Data(i_Var)
-		
-		# Crop data
-		Data, Lat, Lon = Prep.Crop_Range(Data, Lat, Lon, Range='EastAsia_Analysis_Extended')
+		# Get climatology of each grid point (precomputed and stored)
+		Clim = PrepClim.Get_Climatology(i_Var, 'EastAsia_Analysis_Extended')
+		Lat, Lon = Clim['Lat'], Clim['Lon']
 
-		# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-		Time = pd.Series([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
-		
-		# ==================================================
-		# Get climatological seasonal cycle
-		Data_SeasonalCycle = Data.reshape(-1, 12, *Data.shape[-2:])
+		# Get 2022 data (only the range and 2022 are read from disk, kept in float32 with nan for missing values)
+		Data_2022, Time, _, _ = PrepGD.Get_Data(i_Var, Range='EastAsia_Analysis_Extended', Time_Range=['2022-01', '2022-12'], Precision='float32')
+
+		# Arrange 2022 data into 12 months (nan for months not available yet)
+		Data_2022 = PrepCal.Select_Year(Data_2022, PrepCal.Get_Calendar(Time), 2022)
 
-		# Extract 2022 data by selecting the Time with year 2022
-		Data_2022 = Data[Time.dt.year == 2022, ...]
+		# Calculate anomalies of all months, and test their significance with FDR control over each map
+		Data_Anomaly      = Data_2022 - Clim['Mean'].astype(Data_2022.dtype)
+		Data_Significance = PrepStat.Calc_FDR_Mask(PrepStat.Calc_P_Value(Data_Anomaly, Clim))
 
 		# ==================================================
 		# Plot anomaly for each month
 		for ind_Month in np.arange(12):
 
-			# Calculate the mean, standard deviation
-			with warnings.catch_warnings():
-				
-				warnings.simplefilter('ignore', category=RuntimeWarning)
-				Data_Clim_Mean = np.nanmean(Data_SeasonalCycle[:, ind_Month, ...], axis=0)
-				Data_Clim_Std  = np.nanstd(Data_SeasonalCycle[:, ind_Month, ...], axis=0)
-
 			Plot_Data = {\
 				'Lon'                 : Lon, \
 				'Lat'                 : Lat, \
-				'Data_Anomaly'        : (Data_2022[ind_Month, ...] - Data_Clim_Mean), \
-				'Data_Significance'   : (Data_2022[ind_Month, ...] - Data_Clim_Mean) / Data_Clim_Std, \
+				'Data_Anomaly'        : Data_Anomaly[ind_Month, ...], \
+				'Data_Significance'   : Data_Significance[ind_Month, ...], \
 				'Rectangular_Range'   : 'SouthChina_Analysis', \
 			}
 
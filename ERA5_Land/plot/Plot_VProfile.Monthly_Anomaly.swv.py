@@ -7,15 +7,16 @@ The horizontal axis is the time (2022-01 to 2022-12)
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import xarray as xr
-import warnings
 import os
 import sys
 sys.path.append('../')
 import preprocessing.Preprocessing_Get_Data as PrepGD
 import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Climatology as PrepClim
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Statistics as PrepStat
 
 def Plot_VProfile(Plot_Data, Plot_Config):
 	
@@ -138,65 +139,78 @@ def Plot_VProfile(Plot_Data, Plot_Config):
 
 def Get_Data_swv():
 
-	Data = []
+	Data, Clim = [], []
 
 	for i_Var in ['swvl1', 'swvl2', 'swvl3', 'swvl4']:
 
-		# Read data
-		Data_swv, Time, Lat, Lon = PrepGD.Get_Data(i_Var)
+		# Get climatology of the spatial average (precomputed and stored)
+		Clim.append(PrepClim.Get_Climatology(i_Var, 'SouthChina_Analysis', Spatial_Average=True))
+
+		# Open 2022 data lazily
+		Data_swv, Time, Lat, Lon = PrepGD.Open_Data(i_Var, Time_Range=['2022-01', '2022-12'])
 		
-		# Calculate spatial average
-		Data_swv = Prep.Calc_SpatialAverage(Data_swv, Lat, Lon, 'SouthChina_Analysis')
+		# Calculate spatial average (streamed in time chunks)
+		Data_swv = Prep.Calc_SpatialAverage(Data_swv, Lat, Lon, 'SouthChina_Analysis', Memory_Budget=Prep.Memory_Budget_Default)
+
+		# Arrange 2022 data into 12 months (nan for months not available yet)
+		Data_swv = PrepCal.Select_Year(Data_swv, PrepCal.Get_Calendar(Time), 2022)
 		
 		Data.append(Data_swv[:, None])
 
-	# Concatenate data
+	# Concatenate data and climatology
 	Data = np.concatenate(Data, axis=1)
+	Clim = {i: np.stack([j[i] for j in Clim], axis=1) for i in ['Count', 'Mean', 'M2']}
 
-	# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-	Time = np.array([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
-	
-	return Data, Time
+	return Data, Clim
 
 def Get_Data_tp():
 
-	# Read data
-	Data_tp, _, Lat, Lon = PrepGD.Get_Data('tp')
+	# Get climatology of the spatial average (precomputed and stored)
+	Clim = PrepClim.Get_Climatology('tp', 'SouthChina_Analysis', Spatial_Average=True)
 
-	# Calculate spatial average
-	Data_tp = Prep.Calc_SpatialAverage(Data_tp, Lat, Lon, 'SouthChina_Analysis')
+	# Open 2022 data lazily
+	Data_tp, Time, Lat, Lon = PrepGD.Open_Data('tp', Time_Range=['2022-01', '2022-12'])
 
-	return Data_tp
+	# Calculate spatial average (streamed in time chunks) and convert units
+	Data_tp = Prep.Calc_SpatialAverage(Data_tp, Lat, Lon, 'SouthChina_Analysis', Memory_Budget=Prep.Memory_Budget_Default)
+	Data_tp = PrepGD.Convert_Unit(Data_tp, Time, 'tp')
+
+	# Arrange 2022 data into 12 months (nan for months not available yet)
+	Data_tp = PrepCal.Select_Year(Data_tp, PrepCal.Get_Calendar(Time), 2022)
+
+	return Data_tp, Clim
 
 def Get_Data_t2m():
 
-	# Read data
-	Data_t2m, _, Lat, Lon = PrepGD.Get_Data('t2m')
+	# Get climatology of the spatial average (precomputed and stored)
+	Clim = PrepClim.Get_Climatology('t2m', 'SouthChina_Analysis', Spatial_Average=True)
+
+	# Open 2022 data lazily
+	Data_t2m, Time, Lat, Lon = PrepGD.Open_Data('t2m', Time_Range=['2022-01', '2022-12'])
 
-	# Calculate spatial average
-	Data_t2m = Prep.Calc_SpatialAverage(Data_t2m, Lat, Lon, 'SouthChina_Analysis')
+	# Calculate spatial average (streamed in time chunks)
+	Data_t2m = Prep.Calc_SpatialAverage(Data_t2m, Lat, Lon, 'SouthChina_Analysis', Memory_Budget=Prep.Memory_Budget_Default)
 
-	return Data_t2m
+	# Arrange 2022 data into 12 months (nan for months not available yet)
+	Data_t2m = PrepCal.Select_Year(Data_t2m, PrepCal.Get_Calendar(Time), 2022)
+
+	return Data_t2m, Clim
 
 def Get_Data_lwet():
 
 	# Read data
 	ncfile   = xr.open_dataset('../../GRACE/output/Output_Data/SeasonalCycle/SeasonalCycle.lwe_thickness.nc')
 	Data_lwe = ncfile['lwe_thickness'].values
-	Time     = pd.Series(ncfile['time'].values)
+	Time     = ncfile['time'].values
 
 	# Get climatological seasonal cycle
-	# Group the data with the same month and calculate the mean
-	Data_SeasonalCycle = pd.DataFrame({'Data': Data_lwe, 'Time': Time}).set_index('Time')
-	Data_SeasonalCycle = Data_SeasonalCycle.groupby(Data_SeasonalCycle.index.month)
-	Data_Mean          = Data_SeasonalCycle.mean()['Data'].values
-	Data_Std           = Data_SeasonalCycle.std()['Data'].values
-	Data_n             = Data_SeasonalCycle.count()['Data'].values
-	Data_CI            = [-1.96 * Data_Std / np.sqrt(Data_n), 1.96 * Data_Std / np.sqrt(Data_n)]
-
-	# Extract 2022 data by selecting the Time with year 2022
-	Data_2022 = Data_lwe[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
-	Data_2022 = np.append(Data_2022, np.nan)
+	# Calculate the mean, standard deviation and count of each calendar month in one pass, and the Student-t CI around the mean
+	Clim      = PrepClim.Calc_Climatology(Data_lwe, Time)
+	Data_Mean = Clim['Mean']
+	Data_CI   = PrepStat.Calc_CI_t(Clim) - Data_Mean
+
+	# Extract 2022 data into 12 months (nan for months not available, e.g. 2022-12)
+	Data_2022 = PrepCal.Select_Year(Data_lwe, PrepCal.Get_Calendar(Time), 2022)
 	Data_2022 = Data_2022 - Data_Mean
 
 	return Data_2022, Data_CI
@@ -206,41 +220,25 @@ if (__name__ == '__main__'):
 	# Get data: lwe_thickness
 	Data_lwet_2022, Data_lwet_CI = Get_Data_lwet()
 
-	# Get data: swvl1, swvl2, swvl3, swvl4
-	Data_swv, Time = Get_Data_swv()
+	# Get 2022 data and climatology: swvl1, swvl2, swvl3, swvl4
+	Data_swv_2022, Clim_swv = Get_Data_swv()
 
-	# Get data: tp
-	Data_tp        = Get_Data_tp()
+	# Get 2022 data and climatology: tp
+	Data_tp_2022, Clim_tp   = Get_Data_tp()
 
-	# Get data: t2m
-	Data_t2m       = Get_Data_t2m()
+	# Get 2022 data and climatology: t2m
+	Data_t2m_2022, Clim_t2m = Get_Data_t2m()
 	
 	# ==================================================
-	# Get climatological seasonal cycle
-	Data_swv_SeasonalCycle = Data_swv.reshape(-1, 12, Data_swv.shape[-1])
-	Data_tp_SeasonalCycle  = Data_tp.reshape(-1, 12)
-	Data_t2m_SeasonalCycle = Data_t2m.reshape(-1, 12)
-
-	# Calculate the mean, standard deviation
-	with warnings.catch_warnings():
-		
-		warnings.simplefilter('ignore', category=RuntimeWarning)
-
-		Data_swv_Clim_Mean	   = np.nanmean(Data_swv_SeasonalCycle, axis=0)
-		Data_swv_Clim_Std	   = np.nanstd(Data_swv_SeasonalCycle, axis=0)
-		
-		Data_tp_Clim_Mean	   = np.nanmean(Data_tp_SeasonalCycle, axis=0)
-		Data_tp_Clim_Std	   = np.nanstd(Data_tp_SeasonalCycle, axis=0)
-		Data_tp_Clim_n         = np.sum(~np.isnan(Data_tp_SeasonalCycle), axis=0)
+	# Get the mean, standard deviation and Student-t CI (around the mean) of the climatological seasonal cycle
+	Data_swv_Clim_Mean     = Clim_swv['Mean']
+	Data_swv_Clim_Std      = PrepClim.Get_Std(Clim_swv)
 
-		Data_t2m_Clim_Mean	   = np.nanmean(Data_t2m_SeasonalCycle, axis=0)
-		Data_t2m_Clim_Std	   = np.nanstd(Data_t2m_SeasonalCycle, axis=0)
-		Data_t2m_Clim_n        = np.sum(~np.isnan(Data_t2m_SeasonalCycle), axis=0)
+	Data_tp_Clim_Mean      = Clim_tp['Mean']
+	Data_tp_Clim_CI        = PrepStat.Calc_CI_t(Clim_tp) - Data_tp_Clim_Mean
 
-	# Extract 2022 data by selecting the Time with year 2022
-	Data_swv_2022          = Data_swv[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
-	Data_tp_2022           = Data_tp[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
-	Data_t2m_2022          = Data_t2m[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
+	Data_t2m_Clim_Mean     = Clim_t2m['Mean']
+	Data_t2m_Clim_CI       = PrepStat.Calc_CI_t(Clim_t2m) - Data_t2m_Clim_Mean
 
 	# ==================================================
 	# Plot anomaly profile
@@ -250,9 +248,9 @@ if (__name__ == '__main__'):
 		'Data_lwet_Anomaly'       : Data_lwet_2022, \
 		'Data_lwet_CI'            : Data_lwet_CI, \
 		'Data_tp_Anomaly'         : (Data_tp_2022 - Data_tp_Clim_Mean), \
-		'Data_tp_CI'              : [-1.96 * Data_tp_Clim_Std / np.sqrt(Data_tp_Clim_n), 1.96 * Data_tp_Clim_Std / np.sqrt(Data_tp_Clim_n)], \
+		'Data_tp_CI'              : Data_tp_Clim_CI, \
 		'Data_t2m_Anomaly'        : (Data_t2m_2022 - Data_t2m_Clim_Mean), \
-		'Data_t2m_CI'             : [-1.96 * Data_t2m_Clim_Std / np.sqrt(Data_t2m_Clim_n), 1.96 * Data_t2m_Clim_Std / np.sqrt(Data_t2m_Clim_n)], \
+		'Data_t2m_CI'             : Data_t2m_Clim_CI, \
 	}
 
 	Plot_Config = {\
@@ -1,140 +1,379 @@
 import numpy as np
+import scipy.sparse
+import collections
+import hashlib
+import os
+
+# ==================================================
+# Cache of static spatial-average weights, keyed by (grid fingerprint, range)
+# Weight_Cache_Size: maximum number of entries kept in memory (least recently used entries are evicted first)
+# Weight_Cache_Path: directory of the optional on-disk store. None to disable
+Weight_Cache      = collections.OrderedDict()
+Weight_Cache_Size = 32
+Weight_Cache_Path = None
+
+# ==================================================
+# Default memory budget (in bytes) of each time chunk in streaming mode
+Memory_Budget_Default = 1024 ** 3
+
+# ==================================================
+# Precision policy
+# 'float64': data as read (fill values masked, promoted to float64 by unit conversion and masks)
+# 'float32': float32 arrays with nan for missing values instead of masked arrays; reductions accumulate in float64
+Precision_Policy = 'float64'
+
+# ==================================================
+# Registry of analysis ranges: [lat_min, lat_max, lon_min, lon_max]
+Range_Dict = {\
+	'Global_Analysis'           : (-90, 90, 0, 360), \
+	'CentralChina_Analysis'     : (28, 34, 106, 118), \
+	'SouthChina_Analysis'       : (20, 32, 106, 120), \
+	'EastAsia_Analysis'         : (17, 40, 90, 133), \
+	'EastAsia_Analysis_Extended': (14, 43, 87, 136), \
+	'Taiwan_Analysis'           : (21.8, 25.3, 119.8, 122.1), \
+}
 
 def Get_Range(Range):
 
-	if (Range == 'Global_Analysis'):
+	if (Range in Range_Dict):
 
-		return -90, 90, 0, 360
+		return Range_Dict[Range]
 	
-	elif (Range == 'CentralChina_Analysis'):
+	else:
 
-		return 28, 34, 106, 118
+		raise ValueError('Error in Get_Range: wrong range name.')
 	
-	elif (Range == 'SouthChina_Analysis'):
+def Set_Precision_Policy(Precision):
 
-		return 20, 32, 106, 120
-	
-	elif (Range == 'EastAsia_Analysis'):
+	"""
+	Set the default precision policy
+	==================================================
+	Input:
+		Precision: 'float64' or 'float32'
+	"""
 
-		return 17, 40, 90, 133
-	
-	elif (Range == 'EastAsia_Analysis_Extended'):
+	global Precision_Policy
+
+	if (Precision not in ['float64', 'float32']):
+
+		raise ValueError('Error in Set_Precision_Policy: wrong precision policy.')
+
+	Precision_Policy = Precision
+
+	return
+
+def Apply_Precision(Data, Precision=None):
+
+	"""
+	Apply the precision policy to data
+	==================================================
+	Input:
+		Data: numpy array (or masked array, or dask array) of data
+		Precision: 'float64' (data unchanged) or 'float32' (float32 array with nan for missing values). Default: Precision_Policy
+	Output:
+		Data: numpy array (or masked array, or dask array) of data
+	"""
+
+	if (Precision is None): Precision = Precision_Policy
+
+	if (Precision == 'float64'):
+
+		return Data
+
+	elif (Precision == 'float32'):
+
+		if (np.ma.isMaskedArray(Data)): return np.ma.filled(Data.astype(np.float32, copy=False), np.nan)
+
+		return Data.astype(np.float32, copy=False)
 
-		return 14, 43, 87, 136
-	
 	else:
 
-		raise ValueError('Error in Get_Range: wrong range name.')
-	
-def Crop_Range(Data, Lat, Lon, Range, Range_Original='Global_Analysis'):
+		raise ValueError('Error in Apply_Precision: wrong precision policy.')
+
+def Crop_Range(Data, Lat, Lon, Range, Range_Original='Global_Analysis', Precision=None):
 
 	"""
 	Crop data to the given range
+	The range is resolved to an index window, so the cropped data is a view of the original data
+	(a copy only if the range crosses the longitude seam of the grid)
 	==================================================
 	Input:
 		Data: numpy array of data. The last two dimensions should be latitude and longitude, respectively
-		Lat: numpy array of latitude
-		Lon: numpy array of longitude
+		Lat: numpy array of latitude. Monotonic
+		Lon: numpy array of longitude. Monotonically increasing
 		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+		Range_Original: range of the given data if Lat and Lon are of a larger grid. Default: 'Global_Analysis'
+		Precision: precision policy of the cropped data (see Apply_Precision). Default: Precision_Policy
 	Output:
 		Data_Crop: numpy array of cropped data
 		Lat_Crop: numpy array of cropped latitude
 		Lon_Crop: numpy array of cropped longitude
 	"""
 
-	if (Lat[0] > Lat[-1]):
-		
-		Lat = Lat[::-1]
-		Data = Data[..., ::-1, :]
-	
 	# ==================================================
+	# Crop latitude and longitude to the original range if the data has already been cropped
+	if (tuple(Data.shape[-2:]) != (len(Lat), len(Lon))) and (Range_Original != 'Global_Analysis'):
+
+		Lat, Lon = Crop_Lat_Lon(Lat, Lon, Range_Original)
+
+	if (tuple(Data.shape[-2:]) != (len(Lat), len(Lon))):
+
+		raise ValueError('Error in Crop_Range: given array does not meet original range.')
+
+	# ==================================================
+	# Crop data, latitude and longitude by the index window
+	Lat_Slice, Lon_Slice_List = Get_Range_Index(Lat, Lon, Range)
+
+	Data_Crop = Apply_Precision(Crop_Window(Data, Lat_Slice, Lon_Slice_List), Precision)
+	Lat_Crop  = Lat[Lat_Slice]
+	Lon_Crop  = Crop_Window(Lon, None, Lon_Slice_List)
+
+	return Data_Crop, Lat_Crop, Lon_Crop
+
+def Crop_Lat_Lon(Lat, Lon, Range):
+
+	"""
+	Crop the latitude and longitude data to fit the given range
+	==========================
+	Input:
+		Lat: numpy array of latitude. Monotonic
+		Lon: numpy array of longitude. Monotonically increasing
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+	Output:
+		Lat_Crop: numpy array of cropped latitude
+		Lon_Crop: numpy array of cropped longitude
+	==========================
+	"""
+
+	Lat_Slice, Lon_Slice_List = Get_Range_Index(Lat, Lon, Range)
+
+	Lat_Crop = Lat[Lat_Slice]
+	Lon_Crop = Crop_Window(Lon, None, Lon_Slice_List)
+
+	return Lat_Crop, Lon_Crop
+
+def Get_Range_Index(Lat, Lon, Range, Tolerance=1e-6):
+
+	"""
+	Get the index window of the grid points inside the given range by binary search
+	A longitude range crossing the seam of the grid (e.g. 350 to 10 on a 0-360 grid) is split into two windows
+	==================================================
+	Input:
+		Lat: numpy array of latitude. Monotonic
+		Lon: numpy array of longitude. Monotonically increasing
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+		Tolerance: tolerance (in degree) of the range boundaries. Default: 1e-6
+	Output:
+		Lat_Slice: slice of latitude index window
+		Lon_Slice_List: list of slices of longitude index windows, in the order to be concatenated
+	"""
+
 	# Get range boundaries if the range is a string
 	if (isinstance(Range, str)): Range = Get_Range(Range)
 	Lat_Min, Lat_Max, Lon_Min, Lon_Max = Range
 
 	# ==================================================
-	# Crop latitude and longitude
-	Lat_Crop, Lon_Crop = Crop_Lat_Lon(Lat, Lon, Range)
+	# Latitude window (both orientations)
+	if (Lat[0] <= Lat[-1]):
 
-	# Crop data
-	if (tuple(Data.shape[-2:]) != tuple([Lat.shape[0], Lon.shape[0]])):
+		Lat_Slice = slice(\
+			int(np.searchsorted(Lat, Lat_Min - Tolerance, side='left')), \
+			int(np.searchsorted(Lat, Lat_Max + Tolerance, side='right')), \
+		)
 
-		raise ValueError('Error in Crop_Range: given array does not meet original range.')
+	else:
 
-	Arg_Lon_Min = np.argmin(np.abs(Lon-Lon_Min))
-	Arg_Lon_Max = np.argmin(np.abs(Lon-Lon_Max)) + 1
-	Arg_Lat_Min = np.argmin(np.abs(Lat-Lat_Min))
-	Arg_Lat_Max = np.argmin(np.abs(Lat-Lat_Max)) + 1
+		Lat_Slice = slice(\
+			len(Lat) - int(np.searchsorted(Lat[::-1], Lat_Max + Tolerance, side='right')), \
+			len(Lat) - int(np.searchsorted(Lat[::-1], Lat_Min - Tolerance, side='left')), \
+		)
 
-	if (Range_Original != 'Global_Analysis'):
+	# ==================================================
+	# Longitude window
+	if (Lon_Max - Lon_Min >= 360 - Tolerance):
 
-		Lon_Min_Original, Lon_Max_Original, Lat_Min_Original, Lat_Max_Original = Get_Range(Range_Original)
-		Arg_Lon_Min_Original = np.argmin(np.abs(Lon-Lon_Min_Original))
-		Arg_Lon_Max_Original = np.argmin(np.abs(Lon-Lon_Max_Original)) + 1
-		Arg_Lat_Min_Original = np.argmin(np.abs(Lat-Lat_Min_Original))
-		Arg_Lat_Max_Original = np.argmin(np.abs(Lat-Lat_Max_Original)) + 1
+		Lon_Slice_List = [slice(0, len(Lon))]
 
-		Arg_Lon_Min          = Arg_Lon_Min - Arg_Lon_Min_Original
-		Arg_Lon_Max          = Arg_Lon_Max - Arg_Lon_Max_Original
-		Arg_Lat_Min          = Arg_Lat_Min - Arg_Lat_Min_Original
-		Arg_Lat_Max          = Arg_Lat_Max - Arg_Lat_Max_Original
-		
-	if ((Arg_Lat_Max in Lat[[0, -1]]) and (Arg_Lon_Max in Lon[[0, -1]])):
+	else:
 
-		Data_Crop = Data[..., Arg_Lat_Min:, Arg_Lon_Min:]
-	
-	elif (Arg_Lat_Max in Lat[[0, -1]]) and ~(Arg_Lon_Max in Lon[[0, -1]]):
+		# Shift the range into the longitude domain of the grid: [Lon[0], Lon[0] + 360)
+		Lon_Span = (Lon_Max - Lon_Min) % 360
+		Lon_Min  = Lon[0] + (Lon_Min - Lon[0] + Tolerance) % 360 - Tolerance
+		Lon_Max  = Lon_Min + Lon_Span
 
-		Data_Crop = Data[..., Arg_Lat_Min:, Arg_Lon_Min:Arg_Lon_Max]
-	
-	elif ~(Arg_Lat_Max in Lat[[0, -1]]) and (Arg_Lon_Max in Lon[[0, -1]]):
+		Lon_Slice_List = [\
+			slice(int(np.searchsorted(Lon, Lon_Min - Tolerance, side='left')), int(np.searchsorted(Lon, Lon_Max + Tolerance, side='right'))), \
+			slice(0, int(np.searchsorted(Lon, Lon_Max - 360 + Tolerance, side='right'))), \
+		]
+		Lon_Slice_List = [i for i in Lon_Slice_List if (i.stop > i.start)]
 
-		Data_Crop = Data[..., Arg_Lat_Min:Arg_Lat_Max, Arg_Lon_Min:]
-	
-	else:
+	if (Lat_Slice.stop <= Lat_Slice.start) or (len(Lon_Slice_List) == 0):
 
-		Data_Crop = Data[..., Arg_Lat_Min:Arg_Lat_Max, Arg_Lon_Min:Arg_Lon_Max]
+		raise ValueError('Error in Get_Range_Index: no grid point inside the given range.')
 
-	# ==================================================
-	if (Lat[0] > Lat[-1]):
-		
-		Lat_Crop = Lat_Crop[::-1]
-		Data_Crop = Data_Crop[..., ::-1, :]
-	
-	return Data_Crop, Lat_Crop, Lon_Crop
+	return Lat_Slice, Lon_Slice_List
 
-def Crop_Lat_Lon(Lat, Lon, Range):
+def Crop_Window(Data, Lat_Slice, Lon_Slice_List):
 
 	"""
-	Crop the latitude and longitude data to fit the given range
-	==========================
+	Crop data by the index window from Get_Range_Index
+	==================================================
+	Input:
+		Data: numpy array of data. The last two dimensions should be latitude and longitude, respectively
+			  If Lat_Slice is None, the last dimension should be longitude
+		Lat_Slice: slice of latitude index window, or None
+		Lon_Slice_List: list of slices of longitude index windows
+	Output:
+		Data_Crop: numpy array of cropped data. A view of data if there is only one longitude window
+	"""
+
+	Index_Lat = () if (Lat_Slice is None) else (Lat_Slice, )
+
+	if (len(Lon_Slice_List) == 1):
+
+		return Data[(..., *Index_Lat, Lon_Slice_List[0])]
+
+	return np.ma.concatenate([Data[(..., *Index_Lat, i)] for i in Lon_Slice_List], axis=-1) if (np.ma.isMaskedArray(Data)) \
+		else np.concatenate([Data[(..., *Index_Lat, i)] for i in Lon_Slice_List], axis=-1)
+
+def Set_Weight_Cache(Size=None, Path=None):
+
+	"""
+	Configure the cache of spatial-average weights
+	==================================================
+	Input:
+		Size: maximum number of entries kept in memory. None to keep the current setting
+		Path: directory of the on-disk store. None to keep the current setting, False to disable
+	"""
+
+	global Weight_Cache_Size, Weight_Cache_Path
+
+	if (Size is not None): Weight_Cache_Size = int(Size)
+	if (Path is not None): Weight_Cache_Path = Path if (Path) else None
+
+	# Evict the least recently used entries exceeding the new size
+	while (len(Weight_Cache) > Weight_Cache_Size): Weight_Cache.popitem(last=False)
+
+	return
+
+def Get_Grid_Fingerprint(Lat, Lon):
+
+	"""
+	Get a fingerprint identifying the latitude-longitude grid
+	==================================================
+	Input:
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	Output:
+		Fingerprint: hex string of the grid fingerprint
+	"""
+
+	Hash = hashlib.sha1()
+	Hash.update(np.ascontiguousarray(Lat, dtype=np.float64).tobytes())
+	Hash.update(b'|')
+	Hash.update(np.ascontiguousarray(Lon, dtype=np.float64).tobytes())
+
+	return Hash.hexdigest()
+
+def Get_Weight(Lat, Lon, Range):
+
+	"""
+	Get the cropped index window and the normalized static weights (range and latitude weighting) of the given range
+	Weights are cached by (grid fingerprint, range) in memory and, if Weight_Cache_Path is set, on disk
+	==================================================
 	Input:
-		Lat: numpy array of latitude. The order should be from south to north
+		Lat: numpy array of latitude
 		Lon: numpy array of longitude
 		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
 	Output:
-		Lat_Crop: numpy array of cropped latitude
-		Lon_Crop: numpy array of cropped longitude
-	==========================
+		Weight: dictionary of
+			Lat_Slice: slice of latitude index window
+			Lon_Slice_List: list of slices of longitude index windows
+			Weight: numpy array of normalized weights inside the index window
 	"""
 
-	# ==================================================
 	# Get range boundaries if the range is a string
 	if (isinstance(Range, str)): Range = Get_Range(Range)
-	Lat_Min, Lat_Max, Lon_Min, Lon_Max = Range
+	Range = tuple(float(i) for i in Range)
 
 	# ==================================================
-	Arg_Lon_Min = np.argmin(np.abs(Lon-Lon_Min))
-	Arg_Lon_Max = np.argmin(np.abs(Lon-Lon_Max))
-	Arg_Lat_Min = np.argmin(np.abs(Lat-Lat_Min))
-	Arg_Lat_Max = np.argmin(np.abs(Lat-Lat_Max))
+	# Search the memory cache
+	Key = hashlib.sha1('{}|{}'.format(Get_Grid_Fingerprint(Lat, Lon), Range).encode()).hexdigest()
 
-	Lat_Crop = Lat[Arg_Lat_Min:Arg_Lat_Max+1]
-	Lon_Crop = Lon[Arg_Lon_Min:Arg_Lon_Max+1]
+	if (Key in Weight_Cache):
 
-	return Lat_Crop, Lon_Crop
+		Weight_Cache.move_to_end(Key)
+
+		return Weight_Cache[Key]
+
+	# Search the on-disk store
+	Weight_File = None if (Weight_Cache_Path is None) else os.path.join(Weight_Cache_Path, 'Weight.{}.npz'.format(Key))
+
+	if (Weight_File is not None) and (os.path.exists(Weight_File)):
+
+		with np.load(Weight_File) as ncFile:
+
+			Weight = {\
+				'Lat_Slice'     : slice(*ncFile['Lat_Slice']), \
+				'Lon_Slice_List': [slice(*i) for i in ncFile['Lon_Slice_List']], \
+				'Weight'        : ncFile['Weight'], \
+			}
+
+	else:
+
+		Weight = Calc_Weight(Lat, Lon, Range)
+
+		# Write to the on-disk store (write to a temporary file first to avoid partially written files)
+		if (Weight_File is not None):
+
+			if not os.path.exists(Weight_Cache_Path): os.makedirs(Weight_Cache_Path)
+			np.savez(\
+				Weight_File + '.tmp.npz', \
+				Lat_Slice=[Weight['Lat_Slice'].start, Weight['Lat_Slice'].stop], \
+				Lon_Slice_List=[[i.start, i.stop] for i in Weight['Lon_Slice_List']], \
+				Weight=Weight['Weight'], \
+			)
+			os.replace(Weight_File + '.tmp.npz', Weight_File)
+
+	# ==================================================
+	# Add to the memory cache and evict the least recently used entries
+	Weight_Cache[Key] = Weight
+	while (len(Weight_Cache) > Weight_Cache_Size): Weight_Cache.popitem(last=False)
+
+	return Weight
 
-def Calc_SpatialAverage(Data, Lat, Lon, Range, Optimization=True):
+def Calc_Weight(Lat, Lon, Range):
+
+	"""
+	Calculate the cropped index window and the normalized static weights of the given range
+	==================================================
+	Input:
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+	Output:
+		Weight: dictionary of
+			Lat_Slice: slice of latitude index window
+			Lon_Slice_List: list of slices of longitude index windows
+			Weight: numpy array of normalized weights inside the index window
+	"""
+
+	# Get the index window of the range
+	Lat_Slice, Lon_Slice_List = Get_Range_Index(Lat, Lon, Range)
+	Num_Lon = sum(i.stop - i.start for i in Lon_Slice_List)
+
+	# Mask: latitude weighting
+	# Set the latitude weighting to the cosine of latitude
+	Mask_Lat = np.cos(np.deg2rad(Lat[Lat_Slice]))
+
+	# ==================================================
+	# Calculate overall weights and normalize
+	Weight = np.repeat(Mask_Lat[:, None], Num_Lon, axis=1)
+	Weight = Weight / np.sum(Weight)
+
+	return {'Lat_Slice': Lat_Slice, 'Lon_Slice_List': Lon_Slice_List, 'Weight': Weight}
+
+def Calc_SpatialAverage(Data, Lat, Lon, Range, Optimization=True, Memory_Budget=None, Return_Coverage=False, Precision=None):
 
 	"""
 	Calculate spatial average considering range and latitude weighting
@@ -144,38 +383,356 @@ def Calc_SpatialAverage(Data, Lat, Lon, Range, Optimization=True):
 		Lat: numpy array of latitude
 		Lon: numpy array of longitude
 		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+		Optimization: whether to reduce only inside the index window of the range. Default: True
+		Memory_Budget: memory budget (in bytes) of each time chunk. If given, the data is streamed in time chunks
+					   (see Iter_SpatialAverage) and may be a lazily opened xarray DataArray. Default: None
+		Return_Coverage: whether to return the weight coverage per time step (see Calc_WeightedAverage). Default: False
+		Precision: precision policy of the data being reduced (see Apply_Precision). Default: Precision_Policy
 	Output:
 		Data_Avg: numpy array of spatial average
+		Data_Coverage (if Return_Coverage): numpy array of weight coverage
 	"""
 
 	# ==================================================
-	# Mask: range
-	# Get range boundaries if the range is a string
-	if (isinstance(Range, str)): Range = Get_Range(Range)
+	# Streaming mode: concatenate the averages of time chunks
+	if (Memory_Budget is not None):
 
-	# Create a numpy array and set the range inside the rectangle range to 1, and outside to 0
-	Mask_Range = np.zeros((len(Lat), len(Lon)))
-	Mask_Range[(Lat[:, None] >= Range[0]) & (Lat[:, None] <= Range[1]) & (Lon[None, :] >= Range[2]) & (Lon[None, :] <= Range[3])] = 1
+		Output = [i[1:] for i in Iter_SpatialAverage(Data, Lat, Lon, Range, Memory_Budget, Return_Coverage=True, Precision=Precision)]
+		Data_Avg      = np.concatenate([i[0] for i in Output])
+		Data_Coverage = np.concatenate([i[1] for i in Output])
 
-	# Mask: latitude weighting
-	# Create a numpy array and set the latitude weighting to the cosine of latitude and broadcast to the last two dimensions of data
-	Mask_Lat = np.cos(np.deg2rad(Lat))
-	Mask_Lat = np.broadcast_to(Mask_Lat[:, np.newaxis], (len(Lat), len(Lon)))
+		return (Data_Avg, Data_Coverage) if (Return_Coverage) else Data_Avg
+
+	# ==================================================
+	# Get the cached index window and static weights (range and latitude weighting)
+	Weight = Get_Weight(Lat, Lon, Range)
+
+	if (Optimization):
+
+		Data = Apply_Precision(Crop_Window(Data, Weight['Lat_Slice'], Weight['Lon_Slice_List']), Precision)
+		Mask = Weight['Weight']
+
+	else:
+
+		Data = Apply_Precision(Data, Precision)
+		Mask = np.zeros((len(Lat), len(Lon)))
+		Mask[Weight['Lat_Slice'], np.r_[tuple(Weight['Lon_Slice_List'])]] = Weight['Weight']
+
+	return Calc_WeightedAverage(Data, Mask, Return_Coverage)
+
+def Calc_WeightedAverage(Data, Weight, Return_Coverage=False):
+
+	"""
+	Calculate weighted average sum(w * x) / sum(w) over the last two dimensions, skipping nan values
+	If the nan pattern (e.g. land mask) does not change along the leading dimensions, it is applied once to the static
+	weights and only the valid grid points are reduced; otherwise the weights are masked per time step
+	float32 data is not promoted: products are formed in float32 and summed pairwise in float64
+	==================================================
+	Input:
+		Data: numpy array of data
+		Weight: numpy array of static weights, with the shape of the last two dimensions of data
+		Return_Coverage: whether to return the weight coverage. Default: False
+	Output:
+		Data_Avg: numpy array of weighted average. nan if there is no valid grid point
+		Data_Coverage (if Return_Coverage): numpy array of the fraction of the static weights covered by valid grid points
+	"""
 
+	Data = np.ma.filled(Data, np.nan) if (np.ma.isMaskedArray(Data)) else np.asarray(Data)
+
+	# ==================================================
 	# Mask: land region
-	# Create a numpy array and set the values to 1 where the data is not nan, and 0 where the data is nan
-	Mask_Land = np.where(np.isnan(Data), 0, 1)
+	Mask_Land        = ~np.isnan(Data)
+	Mask_Land_Static = Mask_Land.reshape(-1, *Data.shape[-2:])[0]
+
+	if (np.all(Mask_Land == Mask_Land_Static)):
+
+		# Static mask: reduce only the valid grid points
+		Weight_Valid = Weight[Mask_Land_Static]
+		Weight_Sum   = np.full(Data.shape[:-2], np.sum(Weight_Valid))
+
+		if (Data.dtype == np.float32):
+
+			Data_Sum = np.sum(Data[..., Mask_Land_Static] * Weight_Valid.astype(np.float32), axis=-1, dtype=np.float64)
+
+		else:
+
+			Data_Sum = Data[..., Mask_Land_Static] @ Weight_Valid
+
+	else:
+
+		# Time-varying mask: mask the weights per time step
+		Weight_Sum   = np.einsum('...ij,ij->...', Mask_Land, Weight)
+
+		if (Data.dtype == np.float32):
+
+			Data_Sum = np.sum(np.where(Mask_Land, Data, 0) * Weight.astype(np.float32), axis=(-2, -1), dtype=np.float64)
+
+		else:
+
+			Data_Sum = np.einsum('...ij,ij->...', np.where(Mask_Land, Data, 0), Weight)
 
 	# ==================================================
-	# Calculate overall mask (by multiplying all masks)
-	Mask = Mask_Range * Mask_Lat * Mask_Land
+	with np.errstate(invalid='ignore', divide='ignore'):
 
-	if (Optimization):
+		Data_Avg = np.where(Weight_Sum > 0, Data_Sum / Weight_Sum, np.nan)
+
+	if (Return_Coverage):
+
+		return Data_Avg, Weight_Sum / np.sum(Weight)
+
+	return Data_Avg
+
+def Get_Chunk_Size(Num_Grid, Itemsize, Memory_Budget):
+
+	"""
+	Get the number of time steps per chunk fitting the memory budget
+	Each grid point is counted with the data itself and the float64 temporaries of the reduction
+	==================================================
+	Input:
+		Num_Grid: number of grid points per time step
+		Itemsize: size (in bytes) of each data value
+		Memory_Budget: memory budget (in bytes) of each time chunk
+	Output:
+		Chunk_Size: number of time steps per chunk (at least 1)
+	"""
+
+	return max(1, int(Memory_Budget // (Num_Grid * (Itemsize + 3 * 8))))
+
+def Iter_Crop_Range(Data, Lat, Lon, Range, Memory_Budget=Memory_Budget_Default, Precision=None):
+
+	"""
+	Crop data to the given range chunk by chunk along time
+	Only the index window of each chunk is read, so the data can be larger than memory
+	==================================================
+	Input:
+		Data: numpy array (or memory-mapped array, or lazily opened xarray DataArray) of data. The dimensions should be time, latitude and longitude
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+		Memory_Budget: memory budget (in bytes) of each time chunk. Default: Memory_Budget_Default
+		Precision: precision policy of the cropped data (see Apply_Precision). Default: Precision_Policy
+	Output (yield):
+		Time_Slice: slice of time steps of the chunk
+		Data_Crop: numpy array of cropped data of the chunk. Masked values are filled with nan
+	"""
+
+	# Get the index window of the range
+	Lat_Slice, Lon_Slice_List = Get_Range_Index(Lat, Lon, Range)
+	Num_Grid = (Lat_Slice.stop - Lat_Slice.start) * sum(i.stop - i.start for i in Lon_Slice_List)
+	Chunk_Size = Get_Chunk_Size(Num_Grid, Data.dtype.itemsize, Memory_Budget)
+
+	# ==================================================
+	for ind_Time in range(0, Data.shape[0], Chunk_Size):
+
+		Time_Slice = slice(ind_Time, min(ind_Time + Chunk_Size, Data.shape[0]))
+		Data_Crop  = Crop_Window(Data[Time_Slice], Lat_Slice, Lon_Slice_List)
+		Data_Crop  = np.ma.filled(Data_Crop, np.nan) if (np.ma.isMaskedArray(Data_Crop)) else np.asarray(Data_Crop)
+		Data_Crop  = Apply_Precision(Data_Crop, Precision)
+
+		yield Time_Slice, Data_Crop
+
+def Iter_SpatialAverage(Data, Lat, Lon, Range, Memory_Budget=Memory_Budget_Default, Return_Coverage=False, Precision=None):
+
+	"""
+	Calculate spatial average chunk by chunk along time, emitting the average series incrementally
+	==================================================
+	Input:
+		Data: numpy array (or memory-mapped array, or lazily opened xarray DataArray) of data. The dimensions should be time, latitude and longitude
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+		Memory_Budget: memory budget (in bytes) of each time chunk. Default: Memory_Budget_Default
+		Return_Coverage: whether to yield the weight coverage. Default: False
+		Precision: precision policy of the data being reduced (see Apply_Precision). Default: Precision_Policy
+	Output (yield):
+		Time_Slice: slice of time steps of the chunk
+		Data_Avg: numpy array of spatial average of the chunk
+		Data_Coverage (if Return_Coverage): numpy array of weight coverage of the chunk
+	"""
+
+	# Get the cached static weights (range and latitude weighting)
+	Weight = Get_Weight(Lat, Lon, Range)
+
+	for Time_Slice, Data_Crop in Iter_Crop_Range(Data, Lat, Lon, Range, Memory_Budget, Precision):
+
+		if (Return_Coverage):
+
+			yield (Time_Slice, *Calc_WeightedAverage(Data_Crop, Weight['Weight'], Return_Coverage=True))
+
+		else:
+
+			yield Time_Slice, Calc_WeightedAverage(Data_Crop, Weight['Weight'])
+
+def Calc_SpatialAverage_MultiRange(Data, Lat, Lon, Range_List=None, Chunk_Size=12):
+
+	"""
+	Calculate spatial averages of multiple ranges in a single pass over the data
+	The static weights of all ranges are stacked into a sparse (range x grid point) matrix, so each time step is read only once
+	==================================================
+	Input:
+		Data: numpy array of data. The last two dimensions should be latitude and longitude, respectively
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range_List: list of [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: all ranges in Range_Dict
+		Chunk_Size: number of leading (time) steps reduced at once. Default: 12
+	Output:
+		Data_Avg: numpy array of spatial averages. The last dimension is range, in the order of Range_List
+		Range_List: list of ranges
+	"""
+
+	if (Range_List is None): Range_List = list(Range_Dict)
+
+	# ==================================================
+	# Get the cached index window and static weights of each range
+	Weight_List = [Get_Weight(Lat, Lon, i_Range) for i_Range in Range_List]
+
+	# Get the index window enclosing all ranges
+	Lat_Slice = slice(\
+		min(i['Lat_Slice'].start for i in Weight_List), \
+		max(i['Lat_Slice'].stop for i in Weight_List), \
+	)
+	Lon_Slice = slice(\
+		min(j.start for i in Weight_List for j in i['Lon_Slice_List']), \
+		max(j.stop for i in Weight_List for j in i['Lon_Slice_List']), \
+	)
+	Num_Lat   = Lat_Slice.stop - Lat_Slice.start
+	Num_Lon   = Lon_Slice.stop - Lon_Slice.start
+
+	# Create the sparse weight matrix (range x grid point inside the enclosing window)
+	Row, Col, Val = [], [], []
+
+	for ind_Range, i_Weight in enumerate(Weight_List):
+
+		Arg_Lat, Arg_Lon = np.nonzero(i_Weight['Weight'])
+		Val.append(i_Weight['Weight'][Arg_Lat, Arg_Lon])
+
+		# Convert to the index inside the enclosing window
+		Arg_Lat = Arg_Lat + i_Weight['Lat_Slice'].start - Lat_Slice.start
+		Arg_Lon = np.r_[tuple(i_Weight['Lon_Slice_List'])][Arg_Lon] - Lon_Slice.start
+
+		Row.append(np.full(Arg_Lat.size, ind_Range))
+		Col.append(np.ravel_multi_index((Arg_Lat, Arg_Lon), (Num_Lat, Num_Lon)))
+
+	Weight = scipy.sparse.csr_matrix(\
+		(np.concatenate(Val), (np.concatenate(Row), np.concatenate(Col))), \
+		shape=(len(Range_List), Num_Lat * Num_Lon), \
+	)
+
+	# ==================================================
+	# Calculate spatial averages chunk by chunk along the leading dimension
+	Shape_Leading = Data.shape[:-2]
+	Data          = Data.reshape(-1, *Data.shape[-2:])
+	Data_Avg      = np.full((Data.shape[0], len(Range_List)), np.nan)
+
+	for ind_Chunk in range(0, Data.shape[0], Chunk_Size):
+
+		Data_Chunk = np.ma.filled(Data[ind_Chunk:ind_Chunk+Chunk_Size, Lat_Slice, Lon_Slice], np.nan)
+		Data_Chunk = Data_Chunk.reshape(Data_Chunk.shape[0], -1)
+		Mask_Land  = ~np.isnan(Data_Chunk)
+
+		# Weighted sum of data and weighted sum of valid weights
+		Data_Sum   = Weight @ np.where(Mask_Land, Data_Chunk, 0).T
+		Weight_Sum = Weight @ Mask_Land.T.astype(np.float64)
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+
+			Data_Avg[ind_Chunk:ind_Chunk+Chunk_Size] = (Data_Sum / Weight_Sum).T
+
+	return Data_Avg.reshape(*Shape_Leading, len(Range_List)), Range_List
+
+def Calc_SummedAreaTable(Data, Lat, Lon):
+
+	"""
+	Calculate the summed-area tables (2-D prefix sums) of latitude-weighted data and weights
+	With the tables, the spatial average of any rectangle range is obtained by a few lookups (see Calc_BoxAverage)
+	==================================================
+	Input:
+		Data: numpy array of data. The last two dimensions should be latitude and longitude, respectively
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	Output:
+		SAT: dictionary of
+			Data_SAT: numpy array of summed-area table of weighted data, with a leading row and column of zeros
+			Weight_SAT: numpy array of summed-area table of weights. 2-D if the nan pattern of data does not change with time
+			Lat: numpy array of latitude
+			Lon: numpy array of longitude
+	"""
+
+	Data = np.ma.filled(Data, np.nan)
+
+	# ==================================================
+	# Mask: land region
+	Mask_Land = ~np.isnan(Data)
+	Mask_Land_Static = Mask_Land.reshape(-1, *Data.shape[-2:])[0]
+
+	# Mask: latitude weighting
+	Mask_Lat = np.cos(np.deg2rad(Lat))[:, None]
+
+	# Use the static land mask if the nan pattern does not change with time
+	if (np.all(Mask_Land == Mask_Land_Static)):
+
+		Weight = Mask_Lat * Mask_Land_Static
+	
+	else:
+
+		Weight = Mask_Lat * Mask_Land
+
+	# ==================================================
+	# Calculate summed-area tables
+	Data_SAT   = Calc_PrefixSum(np.where(Mask_Land, Data, 0) * Mask_Lat)
+	Weight_SAT = Calc_PrefixSum(Weight)
+
+	return {'Data_SAT': Data_SAT, 'Weight_SAT': Weight_SAT, 'Lat': Lat, 'Lon': Lon}
+
+def Calc_PrefixSum(Data):
+
+	"""
+	Calculate the 2-D prefix sum over the last two dimensions, padded with a leading row and column of zeros
+	==================================================
+	Input:
+		Data: numpy array of data
+	Output:
+		Data_Sum: numpy array of prefix sum. The last two dimensions are one larger than data
+	"""
+
+	Data_Sum = np.zeros((*Data.shape[:-2], Data.shape[-2] + 1, Data.shape[-1] + 1))
+
+	np.cumsum(Data, axis=-2, out=Data_Sum[..., 1:, 1:])
+	np.cumsum(Data_Sum[..., 1:, 1:], axis=-1, out=Data_Sum[..., 1:, 1:])
+
+	return Data_Sum
+
+def Calc_BoxAverage(SAT, Range):
+
+	"""
+	Calculate spatial average of a rectangle range from summed-area tables
+	Equivalent to Calc_SpatialAverage on the data the tables were built from
+	==================================================
+	Input:
+		SAT: dictionary of summed-area tables from Calc_SummedAreaTable
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+	Output:
+		Data_Avg: numpy array of spatial average
+	"""
+
+	# Get the index window of the range
+	Lat_Slice, Lon_Slice_List = Get_Range_Index(SAT['Lat'], SAT['Lon'], Range)
+	i0, i1 = Lat_Slice.start, Lat_Slice.stop
+
+	# Sum inside each window by inclusion-exclusion of the four corners
+	Data_Sum, Weight_Sum = 0, 0
+
+	for i_Lon_Slice in Lon_Slice_List:
+
+		j0, j1 = i_Lon_Slice.start, i_Lon_Slice.stop
+
+		Data_Sum   = Data_Sum + SAT['Data_SAT'][..., i1, j1] - SAT['Data_SAT'][..., i0, j1] \
+					 - SAT['Data_SAT'][..., i1, j0] + SAT['Data_SAT'][..., i0, j0]
+		Weight_Sum = Weight_Sum + SAT['Weight_SAT'][..., i1, j1] - SAT['Weight_SAT'][..., i0, j1] \
+					 - SAT['Weight_SAT'][..., i1, j0] + SAT['Weight_SAT'][..., i0, j0]
 
-		Mask = Crop_Range(Mask, Lat, Lon, Range)[0]
-		Data = Crop_Range(Data, Lat, Lon, Range)[0]
+	with np.errstate(invalid='ignore', divide='ignore'):
 
-	# Calculate spatial average ignoring nan values
-	Data_Avg = np.ma.average(np.ma.MaskedArray(Data, mask=np.isnan(Data)), weights=Mask, axis=(-2, -1))
+		Data_Avg = Data_Sum / Weight_Sum
 
-	return Data_Avg
\ No newline at end of file
+	return Data_Avg
@@ -0,0 +1,291 @@
+import numpy as np
+import collections
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+
+# ==================================================
+# Tiered cache of decoded arrays
+# Memory tier: zlib-compressed arrays with least-recently-used eviction
+# Disk tier: one directory of .npy files per entry, read back as memory-mapped arrays, with least-recently-used eviction (the
+#            modification time of each entry directory is its last access)
+# Memory_Cache_Size: maximum size (in bytes) of the compressed arrays kept in memory. Larger entries are not compressed at all
+# Memory_Cache_Used: size (in bytes) of the compressed arrays kept in memory
+# Disk_Cache_Path: directory of the disk tier. None to disable
+# Disk_Cache_Entry_Size: maximum size (in bytes) of the arrays of an entry written to the disk tier
+# Disk_Cache_Size: maximum total size (in bytes) of the entries of the disk tier
+# Disk_Cache_Temp_Age: age (in seconds) after which temporary directories of writers (e.g. crashed) are removed
+Memory_Cache          = collections.OrderedDict()
+Memory_Cache_Size     = 2 * 1024 ** 3
+Memory_Cache_Used     = 0
+Disk_Cache_Path       = '../output/Output_Data/Cache/'
+Disk_Cache_Entry_Size = 4 * 1024 ** 3
+Disk_Cache_Size       = 16 * 1024 ** 3
+Disk_Cache_Temp_Age   = 24 * 3600
+
+def Set_Cache_Config(Size=None, Path=None, Entry_Size=None, Disk_Size=None):
+
+	"""
+	Configure the cache
+	==================================================
+	Input:
+		Size: maximum size (in bytes) of the memory tier. None to keep the current setting
+		Path: directory of the disk tier. None to keep the current setting, False to disable
+		Entry_Size: maximum size (in bytes) of an entry of the disk tier. None to keep the current setting
+		Disk_Size: maximum total size (in bytes) of the disk tier. None to keep the current setting
+	"""
+
+	global Memory_Cache_Size, Disk_Cache_Path, Disk_Cache_Entry_Size, Disk_Cache_Size
+
+	if (Size is not None): Memory_Cache_Size = int(Size)
+	if (Path is not None): Disk_Cache_Path = Path if (Path) else None
+	if (Entry_Size is not None): Disk_Cache_Entry_Size = int(Entry_Size)
+	if (Disk_Size is not None): Disk_Cache_Size = int(Disk_Size)
+
+	Evict_Memory_Cache()
+	Evict_Disk_Cache()
+
+	return
+
+def Get_Cache_Key(Source_File_List, **Parameter):
+
+	"""
+	Get the cache key of the given source files and parameters
+	The key changes if any source file is modified (path, modification time or size)
+	==================================================
+	Input:
+		Source_File_List: list of source file paths
+		Parameter: parameters determining the cached arrays (e.g. variable, range, conversion)
+	Output:
+		Key: hex string of the cache key
+	"""
+
+	Source = []
+
+	for i_File in Source_File_List:
+
+		Stat = os.stat(i_File)
+		Source.append([os.path.abspath(i_File), Stat.st_mtime_ns, Stat.st_size])
+
+	Key = json.dumps({'Source': Source, 'Parameter': Parameter}, sort_keys=True, default=str)
+
+	return hashlib.sha1(Key.encode()).hexdigest()
+
+def Get_Cache(Key):
+
+	"""
+	Get cached arrays from the memory tier, or from the disk tier as memory-mapped arrays
+	==================================================
+	Input:
+		Key: cache key from Get_Cache_Key
+	Output:
+		Array_Dict: dictionary of read-only numpy arrays (masked arrays are restored), or None if not cached
+	"""
+
+	# ==================================================
+	# Memory tier
+	if (Key in Memory_Cache):
+
+		Memory_Cache.move_to_end(Key)
+
+		return {i: Decompress_Array(j) for i, j in Memory_Cache[Key].items()}
+
+	# ==================================================
+	# Disk tier
+	if (Disk_Cache_Path is None) or (not os.path.exists(os.path.join(Disk_Cache_Path, Key))):
+
+		return None
+
+	Array_Dict = {}
+	Cache_Path = os.path.join(Disk_Cache_Path, Key)
+
+	# Record the access for the least-recently-used eviction
+	os.utime(Cache_Path)
+
+	for i_File in sorted(os.listdir(Cache_Path)):
+
+		if (i_File.endswith('.mask.npy')): continue
+
+		Name = i_File[:-len('.npy')]
+		Array_Dict[Name] = np.load(os.path.join(Cache_Path, i_File), mmap_mode='r')
+
+		# Restore the mask of masked arrays
+		if (os.path.exists(os.path.join(Cache_Path, Name + '.mask.npy'))):
+
+			Mask = np.load(os.path.join(Cache_Path, Name + '.mask.npy'), mmap_mode='r')
+			Array_Dict[Name] = np.ma.MaskedArray(Array_Dict[Name], mask=Mask, copy=False)
+
+	return Array_Dict
+
+def Set_Cache(Key, Array_Dict):
+
+	"""
+	Put arrays into the memory tier and the disk tier, evicting the least recently used entries beyond the size of each tier
+	Entries whose arrays are larger than the size of a tier (or Disk_Cache_Entry_Size) are not put into it
+	==================================================
+	Input:
+		Key: cache key from Get_Cache_Key
+		Array_Dict: dictionary of numpy arrays (or masked arrays)
+	"""
+
+	global Memory_Cache_Used
+
+	# Size of the arrays (and masks) before compression
+	Size = sum(np.asanyarray(i).nbytes + (np.asanyarray(i).size if (np.ma.isMaskedArray(i)) else 0) for i in Array_Dict.values())
+
+	# ==================================================
+	# Memory tier
+	if (Size <= Memory_Cache_Size):
+
+		if (Key in Memory_Cache): Memory_Cache_Used -= Get_Entry_Size(Memory_Cache.pop(Key))
+
+		Memory_Cache[Key] = {i: Compress_Array(j) for i, j in Array_Dict.items()}
+		Memory_Cache_Used += Get_Entry_Size(Memory_Cache[Key])
+
+		Evict_Memory_Cache()
+
+	# ==================================================
+	# Disk tier (write to a temporary directory first to avoid partially written entries)
+	if (Disk_Cache_Path is None) or (Size > min(Disk_Cache_Entry_Size, Disk_Cache_Size)): return
+
+	Cache_Path = os.path.join(Disk_Cache_Path, Key)
+	if (os.path.exists(Cache_Path)): return
+
+	Temp_Path = Cache_Path + '.tmp.{}'.format(os.getpid())
+	if (os.path.exists(Temp_Path)): shutil.rmtree(Temp_Path)
+	os.makedirs(Temp_Path)
+
+	for i_Name, i_Array in Array_Dict.items():
+
+		np.save(os.path.join(Temp_Path, i_Name + '.npy'), np.ma.getdata(i_Array))
+
+		if (np.ma.isMaskedArray(i_Array)):
+
+			np.save(os.path.join(Temp_Path, i_Name + '.mask.npy'), np.ma.getmaskarray(i_Array))
+
+	try:
+
+		os.rename(Temp_Path, Cache_Path)
+
+	except OSError:
+
+		# Another process has written the same entry
+		shutil.rmtree(Temp_Path)
+
+	Evict_Disk_Cache()
+
+	return
+
+def Evict_Memory_Cache():
+
+	"""
+	Evict the least recently used entries of the memory tier exceeding Memory_Cache_Size
+	"""
+
+	global Memory_Cache_Used
+
+	while (len(Memory_Cache) > 0) and (Memory_Cache_Used > Memory_Cache_Size):
+
+		Memory_Cache_Used -= Get_Entry_Size(Memory_Cache.popitem(last=False)[1])
+
+	return
+
+def Evict_Disk_Cache():
+
+	"""
+	Evict the least recently used entries of the disk tier exceeding Disk_Cache_Size, and remove temporary directories older
+	than Disk_Cache_Temp_Age (left by crashed writers)
+	"""
+
+	if (Disk_Cache_Path is None) or (not os.path.exists(Disk_Cache_Path)): return
+
+	Entry_List = []
+
+	for i_Name in os.listdir(Disk_Cache_Path):
+
+		i_Path = os.path.join(Disk_Cache_Path, i_Name)
+
+		# Entries may be removed by another process at the same time
+		try:
+
+			Access_Time = os.path.getmtime(i_Path)
+
+			if ('.tmp.' in i_Name):
+
+				if (time.time() - Access_Time > Disk_Cache_Temp_Age): shutil.rmtree(i_Path, ignore_errors=True)
+				continue
+
+			Entry_List.append([Access_Time, sum(os.path.getsize(os.path.join(i_Path, i)) for i in os.listdir(i_Path)), i_Path])
+
+		except OSError:
+
+			continue
+
+	# Evict from the least recently used
+	Entry_List.sort()
+	Disk_Cache_Used = sum(i[1] for i in Entry_List)
+
+	for i_Access_Time, i_Size, i_Path in Entry_List:
+
+		if (Disk_Cache_Used <= Disk_Cache_Size): break
+
+		shutil.rmtree(i_Path, ignore_errors=True)
+		Disk_Cache_Used -= i_Size
+
+	return
+
+def Get_Entry_Size(Entry):
+
+	"""
+	Get the size of an entry of the memory tier
+	==================================================
+	Input:
+		Entry: dictionary of compressed arrays from Compress_Array
+	Output:
+		Size: size (in bytes) of the compressed bytes
+	"""
+
+	return sum(len(i['Data']) + len(i['Mask'] or b'') for i in Entry.values())
+
+def Compress_Array(Array):
+
+	"""
+	Compress an array (or masked array) by zlib
+	==================================================
+	Input:
+		Array: numpy array or masked array
+	Output:
+		Compressed: dictionary of compressed bytes, dtype, shape and compressed mask
+	"""
+
+	Array = np.asanyarray(Array)
+
+	return {\
+		'Data' : zlib.compress(np.ascontiguousarray(np.ma.getdata(Array)).tobytes(), 1), \
+		'Dtype': Array.dtype, \
+		'Shape': Array.shape, \
+		'Mask' : zlib.compress(np.packbits(np.ma.getmaskarray(Array)).tobytes(), 1) if (np.ma.isMaskedArray(Array)) else None, \
+	}
+
+def Decompress_Array(Compressed):
+
+	"""
+	Decompress an array compressed by Compress_Array
+	==================================================
+	Input:
+		Compressed: dictionary from Compress_Array
+	Output:
+		Array: numpy array or masked array
+	"""
+
+	Array = np.frombuffer(zlib.decompress(Compressed['Data']), dtype=Compressed['Dtype']).reshape(Compressed['Shape'])
+
+	if (Compressed['Mask'] is not None):
+
+		Mask  = np.unpackbits(np.frombuffer(zlib.decompress(Compressed['Mask']), dtype=np.uint8), count=Array.size).astype(bool)
+		Array = np.ma.MaskedArray(Array, mask=Mask.reshape(Compressed['Shape']))
+
+	return Array
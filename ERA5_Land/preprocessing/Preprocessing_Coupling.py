@@ -0,0 +1,244 @@
+import numpy as np
+import scipy.stats
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+
+# ==================================================
+# Lagged coupling of two variables at each grid point, e.g. swvl1 anomalies leading t2m anomalies by 0-3 months
+# (deseasonalized anomalies from Preprocessing_Climatology). For a lag L, X at time t is paired with Y at time t + L
+# The statistics of a lag are the sums over the valid pairs, each one product reduction over time of the centered series of all
+# grid points of a block (the diagonal of the cross-product matrix, never formed). Missing values (nan or masked) are skipped pairwise
+
+def Get_Lag_Slice(Num_Time, Lag):
+
+	"""
+	Get the time steps of the pairs of X and lagged Y inside the record
+	==================================================
+	Input:
+		Num_Time: number of time steps
+		Lag: lag (in time steps)
+	Output:
+		Slice_X, Slice_Y: slices of time steps, X[Slice_X] pairs with Y[Slice_Y]
+	"""
+
+	return slice(max(0, -Lag), Num_Time - max(0, Lag)), slice(max(0, Lag), Num_Time - max(0, -Lag))
+
+def Calc_Center(Data):
+
+	"""
+	Subtract the mean of the valid values of each grid point
+	==================================================
+	Input:
+		Data: numpy array (time, grid point) with nan for missing values
+	Output:
+		Data: numpy array (time, grid point)
+	"""
+
+	Valid = ~np.isnan(Data)
+	Num = np.sum(Valid, axis=0)
+
+	return Data - np.sum(np.where(Valid, Data, 0), axis=0) / np.maximum(Num, 1)
+
+def Calc_Lag_Sum(Data_X, Data_Y, Lag_List):
+
+	"""
+	Calculate the sums over the valid pairs of X and lagged Y at each grid point, one product reduction over time per lag
+	==================================================
+	Input:
+		Data_X, Data_Y: numpy arrays (time, grid point) with nan for missing values, centered (e.g. anomalies) so the sums are well conditioned
+		Lag_List: list of lags (in time steps)
+	Output:
+		Sum: dictionary of Num, Sum_X, Sum_XX, Sum_Y, Sum_YY and Sum_XY (lag, grid point)
+	"""
+
+	Num_Time, Num_Grid = Data_X.shape
+
+	Valid_X = ~np.isnan(Data_X)
+	Valid_Y = ~np.isnan(Data_Y)
+	Index_Full = np.all(Valid_X, axis=0) & np.all(Valid_Y, axis=0)
+	Index_Part = ~Index_Full & np.any(Valid_X, axis=0) & np.any(Valid_Y, axis=0)
+
+	Sum = {i: np.zeros((len(Lag_List), Num_Grid)) for i in ['Num', 'Sum_X', 'Sum_XX', 'Sum_Y', 'Sum_YY', 'Sum_XY']}
+
+	# ==================================================
+	# Grid points without missing values: all pairs inside the record are valid
+	X = Data_X[:, Index_Full]
+	Y = Data_Y[:, Index_Full]
+
+	for ind_Lag, i_Lag in enumerate(Lag_List):
+
+		Slice_X, Slice_Y = Get_Lag_Slice(Num_Time, i_Lag)
+
+		Sum['Num'][ind_Lag, Index_Full]    = X[Slice_X].shape[0]
+		Sum['Sum_X'][ind_Lag, Index_Full]  = np.sum(X[Slice_X], axis=0)
+		Sum['Sum_XX'][ind_Lag, Index_Full] = np.einsum('ij,ij->j', X[Slice_X], X[Slice_X])
+		Sum['Sum_Y'][ind_Lag, Index_Full]  = np.sum(Y[Slice_Y], axis=0)
+		Sum['Sum_YY'][ind_Lag, Index_Full] = np.einsum('ij,ij->j', Y[Slice_Y], Y[Slice_Y])
+		Sum['Sum_XY'][ind_Lag, Index_Full] = np.einsum('ij,ij->j', X[Slice_X], Y[Slice_Y])
+
+	# ==================================================
+	# Grid points with missing values: the valid pairs are masked by the product of the validity of X and lagged Y
+	Valid_X = Valid_X[:, Index_Part].astype(np.float64)
+	Valid_Y = Valid_Y[:, Index_Part].astype(np.float64)
+	X = np.nan_to_num(Data_X[:, Index_Part])
+	Y = np.nan_to_num(Data_Y[:, Index_Part])
+	XX, YY = X ** 2, Y ** 2
+
+	for ind_Lag, i_Lag in enumerate(Lag_List):
+
+		Slice_X, Slice_Y = Get_Lag_Slice(Num_Time, i_Lag)
+
+		Sum['Num'][ind_Lag, Index_Part]    = np.einsum('ij,ij->j', Valid_X[Slice_X], Valid_Y[Slice_Y])
+		Sum['Sum_X'][ind_Lag, Index_Part]  = np.einsum('ij,ij->j', X[Slice_X], Valid_Y[Slice_Y])
+		Sum['Sum_XX'][ind_Lag, Index_Part] = np.einsum('ij,ij->j', XX[Slice_X], Valid_Y[Slice_Y])
+		Sum['Sum_Y'][ind_Lag, Index_Part]  = np.einsum('ij,ij->j', Valid_X[Slice_X], Y[Slice_Y])
+		Sum['Sum_YY'][ind_Lag, Index_Part] = np.einsum('ij,ij->j', Valid_X[Slice_X], YY[Slice_Y])
+		Sum['Sum_XY'][ind_Lag, Index_Part] = np.einsum('ij,ij->j', X[Slice_X], Y[Slice_Y])
+
+	return Sum
+
+def Calc_Correlation_Sum(Sum):
+
+	"""
+	Calculate the Pearson correlation and the regression slope of Y on X from the sums of pairs
+	==================================================
+	Input:
+		Sum: dictionary of sums from Calc_Lag_Sum
+	Output:
+		Correlation: numpy array of correlation coefficient, nan with less than 3 pairs
+		Slope: numpy array of regression slope of Y on X (units of Y per unit of X)
+		P_Value: numpy array of two-sided p-value of the Student-t test of zero correlation
+	"""
+
+	Num = Sum['Num']
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Cov_XX = Sum['Sum_XX'] - Sum['Sum_X'] ** 2 / Num
+		Cov_YY = Sum['Sum_YY'] - Sum['Sum_Y'] ** 2 / Num
+		Cov_XY = Sum['Sum_XY'] - Sum['Sum_X'] * Sum['Sum_Y'] / Num
+
+		Correlation = np.clip(Cov_XY / np.sqrt(Cov_XX * Cov_YY), -1, 1)
+		Slope = Cov_XY / Cov_XX
+
+		Degree = np.where(Num > 2, Num - 2, np.nan)
+		t_Value = Correlation * np.sqrt(Degree / (1 - Correlation ** 2))
+		P_Value = 2 * scipy.stats.t.sf(np.abs(t_Value), Degree)
+
+	Correlation = np.where(np.isnan(Degree), np.nan, Correlation)
+	Slope = np.where(np.isnan(Degree), np.nan, Slope)
+
+	return Correlation, Slope, P_Value
+
+def Calc_Lag_Correlation(Data_X, Data_Y, Lag_List=[0, 1, 2, 3], Method='Pearson', Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Calculate the lagged correlation and regression slope between two variables at each grid point, X leading Y
+	==================================================
+	Input:
+		Data_X, Data_Y: numpy arrays (or masked arrays) of anomalies with the same shape and time steps. The first dimension should be time
+		Lag_List: list of lags (in time steps), shorter than the record. Positive lags pair X with later Y. Default: [0, 1, 2, 3]
+		Method: 'Pearson', or 'Spearman' (the Pearson correlation of the ranks of the valid pairs of each lag). Default: 'Pearson'
+		Memory_Budget: memory budget (in bytes) of each block of grid points. Default: Prep.Memory_Budget_Default
+	Output:
+		Coupling: dictionary of
+			Lag_List: numpy array of lags
+			Correlation: correlation coefficient (lag, ...)
+			Slope: regression slope of Y on X (lag, ...), from the values whatever the method
+			P_Value: two-sided p-value of zero correlation (lag, ...)
+			Num: number of valid pairs (lag, ...)
+			All are nan with less than 3 valid pairs
+	"""
+
+	if (Method not in ['Pearson', 'Spearman']): raise ValueError('Error in Calc_Lag_Correlation: wrong method.')
+	if (Data_X.shape != Data_Y.shape): raise ValueError('Error in Calc_Lag_Correlation: shapes of data do not match.')
+
+	Shape = Data_X.shape[1:]
+	Data_X = np.ma.filled(np.ma.asarray(Data_X).astype(np.float64), np.nan).reshape(Data_X.shape[0], -1)
+	Data_Y = np.ma.filled(np.ma.asarray(Data_Y).astype(np.float64), np.nan).reshape(Data_Y.shape[0], -1)
+
+	Num_Time, Num_Grid = Data_X.shape
+	Lag_List = np.asarray(Lag_List)
+
+	if (np.any(np.abs(Lag_List) >= Num_Time)): raise ValueError('Error in Calc_Lag_Correlation: lag exceeds the record.')
+
+	Coupling = {i: np.full((len(Lag_List), Num_Grid), np.nan) for i in ['Correlation', 'Slope', 'P_Value', 'Num']}
+
+	# Number of grid points per block (the centered data, masks and squares)
+	Block_Size = Prep.Get_Chunk_Size(Num_Time, 8 * 8, Memory_Budget)
+
+	for ind_Block in range(0, Num_Grid, Block_Size):
+
+		Block_Slice = slice(ind_Block, min(ind_Block + Block_Size, Num_Grid))
+
+		# Centered by the mean of each grid point
+		X = Calc_Center(Data_X[:, Block_Slice])
+		Y = Calc_Center(Data_Y[:, Block_Slice])
+
+		Sum = Calc_Lag_Sum(X, Y, Lag_List)
+		Correlation, Slope, P_Value = Calc_Correlation_Sum(Sum)
+
+		# ==================================================
+		# Spearman: rank the valid pairs of each lag, then the same reduction at lag 0
+		if (Method == 'Spearman'):
+
+			for ind_Lag, i_Lag in enumerate(Lag_List):
+
+				Slice_X, Slice_Y = Get_Lag_Slice(Num_Time, i_Lag)
+				Valid = ~np.isnan(X[Slice_X]) & ~np.isnan(Y[Slice_Y])
+
+				# Ranks centered by their mean, (Num + 1) / 2
+				Rank_Mean = (np.sum(Valid, axis=0) + 1) / 2
+				Rank_X = scipy.stats.rankdata(np.where(Valid, X[Slice_X], np.nan), axis=0, nan_policy='omit') - Rank_Mean
+				Rank_Y = scipy.stats.rankdata(np.where(Valid, Y[Slice_Y], np.nan), axis=0, nan_policy='omit') - Rank_Mean
+
+				Correlation_Rank, _, P_Value_Rank = Calc_Correlation_Sum(Calc_Lag_Sum(Rank_X, Rank_Y, [0]))
+				Correlation[ind_Lag, :], P_Value[ind_Lag, :] = Correlation_Rank[0, :], P_Value_Rank[0, :]
+
+		Coupling['Correlation'][:, Block_Slice] = Correlation
+		Coupling['Slope'][:, Block_Slice] = Slope
+		Coupling['P_Value'][:, Block_Slice] = P_Value
+		Coupling['Num'][:, Block_Slice] = Sum['Num']
+
+	for i_Key in Coupling:
+
+		Coupling[i_Key] = Coupling[i_Key].reshape(len(Lag_List), *Shape)
+
+	Coupling['Lag_List'] = Lag_List
+
+	return Coupling
+
+def Calc_Lag_Correlation_Regional(Data_X, Data_Y, Lat, Lon, Range_List, Lag_List=[0, 1, 2, 3], Method='Pearson', Memory_Budget=None):
+
+	"""
+	Calculate the lagged correlation and regression slope between the spatial average series of two variables over regions
+	==================================================
+	Input:
+		Data_X, Data_Y: numpy arrays (or masked arrays, or lazily opened xarray DataArray with Memory_Budget) of anomalies (time, lat, lon)
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range_List: list of [lat_min, lat_max, lon_min, lon_max] or strings of region names
+		Lag_List, Method: see Calc_Lag_Correlation
+		Memory_Budget: memory budget (in bytes) of each time chunk of the spatial average (see Prep.Calc_SpatialAverage). Default: None
+	Output:
+		Series_X, Series_Y: numpy arrays of spatial average (time, region)
+		Coupling: dictionary of the statistics (lag, region) from Calc_Lag_Correlation
+	"""
+
+	Series_X = np.stack([Prep.Calc_SpatialAverage(Data_X, Lat, Lon, i, Memory_Budget=Memory_Budget) for i in Range_List], axis=1)
+	Series_Y = np.stack([Prep.Calc_SpatialAverage(Data_Y, Lat, Lon, i, Memory_Budget=Memory_Budget) for i in Range_List], axis=1)
+
+	return Series_X, Series_Y, Calc_Lag_Correlation(Series_X, Series_Y, Lag_List, Method)
+
+if (__name__ == '__main__'):
+
+	import preprocessing.Preprocessing_Climatology as PrepClim
+
+	# Soil moisture leading 2m temperature by 0-3 months
+	Anomaly_swvl1, _, Time, Lat, Lon = PrepClim.Get_Anomaly('swvl1', ['1992-01', '2022-12'], 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])
+	Anomaly_t2m = PrepClim.Get_Anomaly('t2m', ['1992-01', '2022-12'], 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])[0]
+
+	Coupling = Calc_Lag_Correlation(Anomaly_swvl1, Anomaly_t2m, [0, 1, 2, 3], 'Pearson')
+	Series_swvl1, Series_t2m, Coupling_Regional = Calc_Lag_Correlation_Regional(Anomaly_swvl1, Anomaly_t2m, Lat, Lon, \
+																				['SouthChina_Analysis', 'EastAsia_Analysis_Extended'])
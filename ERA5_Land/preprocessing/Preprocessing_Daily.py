@@ -0,0 +1,269 @@
+import numpy as np
+import xarray as xr
+import netCDF4
+import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Get_Data as PrepGD
+
+# ==================================================
+# Reduction of hourly ERA5-Land (see src/ERA5-Land/Download_Hourly.py) to daily data of local days, in one pass of time chunks
+# Instantaneous variables: daily mean ({Var}), maximum ({Var}_max) and minimum ({Var}_min) of the 24 hours of the local day
+# Accumulated variables: daily sum ({Var}) of the hourly increments ending within the local day. ERA5-Land accumulations restart
+# after 00 UTC, so the value at 01 UTC is the first hour and the value at 00 UTC is the total of the previous UTC day
+# Each chunk of days is read with the hour before it, so chunks are independent and the hourly cube is never held
+# Days with missing hours are nan. The daily data is written chunk by chunk as one file per year to ERA5-Land.{Var}.Daily.Shard/,
+# and a year is rewritten only when the hourly files covering its hours are newer
+
+Accumulated_List = ['tp', 'e']
+
+def Get_Daily_Var_List(Var):
+
+	"""
+	Get the names of the daily variables reduced from an hourly variable
+	==================================================
+	Input:
+		Var: variable name
+	Output:
+		Daily_Var_List: list of daily variable names
+	"""
+
+	return [Var] if (Var in Accumulated_List) else [Var, Var + '_max', Var + '_min']
+
+def Get_Hour_Slot(Day_Start, Num_Day, UTC_Offset=8, Accumulated=False):
+
+	"""
+	Get the UTC time of the hourly steps of local days
+	==================================================
+	Input:
+		Day_Start: numpy datetime64 of the first local day
+		Num_Day: number of days
+		UTC_Offset: offset (in hours) of local time from UTC, e.g. 8 for China and Taiwan. Default: 8
+		Accumulated: whether the variable is accumulated. Accumulations are the hours ending within the day, with the hour
+					 before them for de-accumulation. Default: False
+	Output:
+		Slot_Time: numpy array of UTC time (datetime64[h]), 24 * Num_Day (+ 1 if Accumulated) steps
+	"""
+
+	Time_Start = np.datetime64(Day_Start, 'D').astype('datetime64[h]') - np.timedelta64(UTC_Offset, 'h')
+
+	if (Accumulated): return Time_Start + np.arange(0, 24 * Num_Day + 1)
+
+	return Time_Start + np.arange(0, 24 * Num_Day)
+
+def Calc_Daily(Data, Time, Day_Start, Num_Day, UTC_Offset=8, Accumulated=False):
+
+	"""
+	Reduce hourly data to daily data of local days
+	==================================================
+	Input:
+		Data: numpy array of hourly data with nan for missing values. The first dimension should be time
+		Time: numpy array of UTC time of data (covering Get_Hour_Slot; other steps are ignored)
+		Day_Start: numpy datetime64 of the first local day
+		Num_Day: number of days
+		UTC_Offset: offset (in hours) of local time from UTC. Default: 8
+		Accumulated: whether the variable is accumulated (ERA5-Land convention). Default: False
+	Output:
+		Daily: dictionary of numpy arrays (day, ...), Sum for accumulated variables, or Mean, Max and Min. nan for days with missing hours
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = Data.reshape(Data.shape[0], -1)
+
+	# Place the hourly steps into the slots of the days
+	Slot_Time = Get_Hour_Slot(Day_Start, Num_Day, UTC_Offset, Accumulated)
+	Time = np.asarray(Time).astype('datetime64[h]')
+
+	Index = np.searchsorted(Slot_Time, Time)
+	Index_Valid = np.flatnonzero((Index < len(Slot_Time)) & (Slot_Time[np.minimum(Index, len(Slot_Time) - 1)] == Time))
+
+	Hour = np.full((len(Slot_Time), Data.shape[1]), np.nan)
+	Hour[Index[Index_Valid], :] = Data[Index_Valid, :]
+
+	Present = np.zeros(len(Slot_Time), dtype=bool)
+	Present[Index[Index_Valid]] = True
+
+	if (Accumulated):
+
+		# Hourly increments, restarting at 01 UTC
+		Index_Restart = Slot_Time[1:].astype(np.int64) % 24 == 1
+
+		Increment = Hour[1:, :] - Hour[:-1, :]
+		Increment[Index_Restart, :] = Hour[1:, :][Index_Restart, :]
+
+		Present = Present[1:] & (Present[:-1] | Index_Restart)
+		Hour = Increment
+
+	Hour = Hour.reshape(Num_Day, 24, Data.shape[1])
+	Complete = np.all(Present.reshape(Num_Day, 24), axis=1)
+
+	if (Accumulated):
+
+		Daily = {'Sum': np.sum(Hour, axis=1)}
+
+	else:
+
+		Daily = {'Mean': np.mean(Hour, axis=1), 'Max': np.max(Hour, axis=1), 'Min': np.min(Hour, axis=1)}
+
+	for i_Key in Daily:
+
+		Daily[i_Key][~Complete, :] = np.nan
+		Daily[i_Key] = Daily[i_Key].reshape(Num_Day, *Shape)
+
+	return Daily
+
+def Get_File_Time_Span(File_List):
+
+	"""
+	Get the first and last UTC time of each file, reading only the time coordinate
+	==================================================
+	Input:
+		File_List: list of file paths
+	Output:
+		Time_Span: numpy array of the first and last time (datetime64[h]) of each file (file, 2)
+	"""
+
+	Time_Span = np.empty((len(File_List), 2), dtype='datetime64[h]')
+
+	for ind_File, i_File in enumerate(File_List):
+
+		with xr.open_dataset(i_File) as ncFile:
+
+			Time = ncFile['time'].values.astype('datetime64[h]')
+
+		Time_Span[ind_File] = [Time.min(), Time.max()]
+
+	return Time_Span
+
+def Create_Daily(Day, Lat, Lon, Var, Output_File):
+
+	"""
+	Create a chunked netCDF file of a daily variable (float32, 1e+20 for missing values), written chunk by chunk of days
+	The file is written to Output_File + '.tmp' and should be renamed to Output_File once complete
+	==================================================
+	Input:
+		Day: numpy array of day
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Var: daily variable name
+		Output_File: file path
+	Output:
+		ncFile: netCDF4 Dataset open for writing. Masked or nan values written to Var are stored as missing values
+	"""
+
+	ncFile = netCDF4.Dataset(Output_File + '.tmp', 'w')
+
+	ncFile.createDimension('time', len(Day))
+	ncFile.createDimension('latitude', len(Lat))
+	ncFile.createDimension('longitude', len(Lon))
+
+	ncFile.createVariable('time', 'i8', ('time',))
+	ncFile['time'].units    = 'days since 1970-01-01'
+	ncFile['time'].calendar = 'proleptic_gregorian'
+	ncFile['time'][:] = np.asarray(Day).astype('datetime64[D]').astype(np.int64)
+
+	ncFile.createVariable('latitude', 'f8', ('latitude',))[:] = Lat
+	ncFile.createVariable('longitude', 'f8', ('longitude',))[:] = Lon
+
+	ncFile.createVariable(Var, 'f4', ('time', 'latitude', 'longitude'), zlib=True, complevel=1, fill_value=1e+20, \
+						  chunksizes=(min(31, len(Day)), min(64, len(Lat)), min(64, len(Lon))))
+
+	return ncFile
+
+def Get_Daily(Var, Range=None, Year_List=None, UTC_Offset=8, Memory_Budget=Prep.Memory_Budget_Default, Rebuild=False):
+
+	"""
+	Reduce the hourly data of a variable to daily data of local days and write the daily store, one file per year
+	Years whose files are newer than the hourly files covering them are skipped
+	==================================================
+	Input:
+		Var: variable name, e.g. 't2m', 'skt', 'tp' or 'e'
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: None (the downloaded area)
+		Year_List: list of local years. Default: None (all years of the hourly data)
+		UTC_Offset: offset (in hours) of local time from UTC, e.g. 8 for China and Taiwan. Default: 8
+		Memory_Budget: memory budget (in bytes) of each chunk of days. Default: Preprocessing.Memory_Budget_Default
+		Rebuild: whether to rewrite all years. Default: False
+	Output:
+		Output_File_List: list of the daily files written
+	"""
+
+	Accumulated = Var in Accumulated_List
+	Daily_Var_List = Get_Daily_Var_List(Var)
+	Daily_Key_List = ['Sum'] if (Accumulated) else ['Mean', 'Max', 'Min']
+
+	# Open hourly data lazily, and get the time span of each hourly file
+	File_List = PrepGD.Get_File_List(Var, 'Hourly')
+	File_Time_Span = Get_File_Time_Span(File_List)
+	Data, Time, Lat, Lon = PrepGD.Open_Data(Var, Range=Range, Frequency='Hourly')
+	Time = Time.astype('datetime64[h]')
+
+	# Local days fully covered by the hourly data
+	Day_First = (Time[0] + np.timedelta64(UTC_Offset + 23, 'h')).astype('datetime64[D]')
+	Day_Last  = (Time[-1] + np.timedelta64(UTC_Offset - (24 if (Accumulated) else 23), 'h')).astype('datetime64[D]')
+
+	if (Year_List is None): Year_List = range(Day_First.astype('datetime64[Y]').astype(np.int64) + 1970, Day_Last.astype('datetime64[Y]').astype(np.int64) + 1971)
+
+	# Number of days per chunk (the hourly data and the float64 temporaries)
+	Chunk_Size = Prep.Get_Chunk_Size(24 * len(Lat) * len(Lon), Data.dtype.itemsize, Memory_Budget)
+
+	Output_File_List = []
+
+	for i_Year in Year_List:
+
+		Output_File = {i: '../src/ERA5-Land/ERA5-Land.{Var}.Daily.Shard/ERA5-Land.{Var}.Daily.{Year}.nc'.format(Var=i, Year=i_Year) for i in Daily_Var_List}
+
+		Day = np.arange(max(np.datetime64('{}-01-01'.format(i_Year)), Day_First), min(np.datetime64('{}-12-31'.format(i_Year)), Day_Last) + 1)
+		if (len(Day) == 0): continue
+
+		# Skip the year if its files are newer than the hourly files covering its hours (with the UTC offset and the hour
+		# before for accumulations), so a new month rewrites only the years it belongs to
+		Time_Start = Get_Hour_Slot(Day[0], 1, UTC_Offset, Accumulated)[0]
+		Time_End   = Get_Hour_Slot(Day[-1], 1, UTC_Offset, Accumulated)[-1]
+		Source_Time = max([os.path.getmtime(i) for i, j in zip(File_List, File_Time_Span) if (j[0] <= Time_End) and (j[1] >= Time_Start)], default=0)
+
+		if (not Rebuild) and all(os.path.exists(i) and (os.path.getmtime(i) >= Source_Time) for i in Output_File.values()): continue
+
+		for i_File in Output_File.values():
+
+			if not os.path.exists(os.path.dirname(i_File)): os.makedirs(os.path.dirname(i_File))
+
+		# ==================================================
+		# Reduce each chunk of days, reading only its hours, and write it to the daily files (only one chunk is held)
+		ncFile = {i: Create_Daily(Day, Lat, Lon, i, Output_File[i]) for i in Daily_Var_List}
+
+		try:
+
+			for ind_Day in range(0, len(Day), Chunk_Size):
+
+				Num_Day = min(Chunk_Size, len(Day) - ind_Day)
+				Slot_Time = Get_Hour_Slot(Day[ind_Day], Num_Day, UTC_Offset, Accumulated)
+
+				Data_Chunk = Data.sel(time=slice(Slot_Time[0], Slot_Time[-1]))
+				Time_Chunk = Data_Chunk['time'].values
+				Data_Chunk = Data_Chunk.values.astype(np.float64)
+
+				Daily_Chunk = Calc_Daily(Data_Chunk, Time_Chunk, Day[ind_Day], Num_Day, UTC_Offset, Accumulated)
+
+				for i_Daily_Var, i_Key in zip(Daily_Var_List, Daily_Key_List):
+
+					ncFile[i_Daily_Var][i_Daily_Var][ind_Day:ind_Day + Num_Day] = np.ma.masked_invalid(Daily_Chunk[i_Key].astype(np.float32))
+
+		finally:
+
+			for i_ncFile in ncFile.values(): i_ncFile.close()
+
+		# Rename the complete files
+		for i_Daily_Var in Daily_Var_List:
+
+			os.replace(Output_File[i_Daily_Var] + '.tmp', Output_File[i_Daily_Var])
+			Output_File_List.append(Output_File[i_Daily_Var])
+
+	return Output_File_List
+
+if (__name__ == '__main__'):
+
+	# Reduce hourly data to daily data
+	for i_Var in ['t2m', 'skt', 'tp', 'e']:
+
+		Get_Daily(i_Var)
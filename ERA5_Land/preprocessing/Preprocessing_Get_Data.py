@@ -1,46 +1,362 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
+import os
+import shutil
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Cache as PrepCache
+import preprocessing.Preprocessing_Calendar as PrepCal
 
-def Get_Data(Var):
+def Get_File_List(Var, Frequency='Monthly'):
+
+	"""
+	Get the archive file and the shard files (see src/ERA5-Land/Download.py and Download_Incremental.py) of a variable
+	==================================================
+	Input:
+		Var: variable name
+		Frequency: 'Monthly' (ERA5-Land.{Var}.nc), 'Daily' (ERA5-Land.{Var}.Daily.nc, see Preprocessing_Daily) or 'Hourly'
+				   (ERA5-Land.{Var}.Hourly.nc, see src/ERA5-Land/Download_Hourly.py). Default: 'Monthly'
+	Output:
+		File_List: list of file paths in time order
+	"""
+
+	if (Frequency not in ['Monthly', 'Daily', 'Hourly']):
+
+		raise ValueError('Error in Get_File_List: wrong frequency.')
+
+	File_Name = 'ERA5-Land.{Var}'.format(Var=Var) if (Frequency == 'Monthly') else 'ERA5-Land.{Var}.{Frequency}'.format(Var=Var, Frequency=Frequency)
+
+	Archive_File = '../src/ERA5-Land/{File_Name}.nc'.format(File_Name=File_Name)
+	Shard_Path   = '../src/ERA5-Land/{File_Name}.Shard/'.format(File_Name=File_Name)
+
+	File_List = [Archive_File] if (os.path.exists(Archive_File)) else []
+
+	if (os.path.exists(Shard_Path)):
+
+		File_List += [Shard_Path + i for i in sorted(os.listdir(Shard_Path)) if (i.endswith('.nc'))]
+
+	if (len(File_List) == 0):
+
+		raise ValueError('Error in Get_File_List: no file of the variable.')
+
+	return File_List
+
+def Get_Data(Var, Range=None, Time_Range=None, Chunk_Size=None, Cache=True, Precision=None, Frequency='Monthly'):
 
 	"""
 	Get data by xarray and convert to numpy array
+	The range and time selections are pushed down to the file reader, so only the selected hyperslab is read
 	==================================================
 	Input:
 		Var: variable name
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: None (whole grid)
+		Time_Range: [start, end] of time (inclusive), e.g. ['1992-01', '2022-12']. Default: None (whole record)
+		Chunk_Size: number of time steps per chunk. If given, data is returned as a lazily evaluated dask array
+					chunked along time. Default: None
+		Cache: whether to use the decoded-array cache (see Preprocessing_Cache). Not used with Chunk_Size. Default: True
+		Precision: precision policy (see Preprocessing.Apply_Precision). With 'float32', data is a float32 array with nan
+				   for fill values instead of a masked array. Default: Preprocessing.Precision_Policy
+		Frequency: 'Monthly', 'Daily' or 'Hourly' (see Get_File_List). Default: 'Monthly'
 	Output:
-		Data: numpy array of data
+		Data: numpy array (or dask array) of data. Read-only if from the cache
 		Time: numpy array of time
-		Lat: numpy array of latitude
+		Lat: numpy array of latitude (from south to north)
 		Lon: numpy array of longitude
 	"""
 
-	# Get data
-	Data = xr.open_dataset('../src/ERA5-Land/ERA5-Land.{Var}.nc'.format(Var=Var))[Var].values
+	if (Precision is None): Precision = Prep.Precision_Policy
+
+	# ==================================================
+	# Get decoded arrays from the cache
+	if (Cache) and (Chunk_Size is None):
+
+		Cache_Key = PrepCache.Get_Cache_Key(\
+			Get_File_List(Var, Frequency), \
+			Function='Get_Data', Var=Var, Frequency=Frequency, \
+			Range=Prep.Get_Range(Range) if (isinstance(Range, str)) else Range, Time_Range=Time_Range, \
+			Fill_Value=1e+20, Convert_Unit=(Var == 'tp'), Precision=Precision, \
+		)
+		Cache_Data = PrepCache.Get_Cache(Cache_Key)
+
+		if (Cache_Data is not None):
+
+			return Cache_Data['Data'], Cache_Data['Time'], Cache_Data['Lat'], Cache_Data['Lon']
+
+	# ==================================================
+	# Open data lazily with the selections
+	Data, Time, Lat, Lon = Open_Data(Var, Range=Range, Time_Range=Time_Range, Chunk_Size=Chunk_Size, Frequency=Frequency)
+
+	if (Chunk_Size is None):
+
+		# Read the selected hyperslab (fill values are nan, see Open_Data) and convert to numpy array
+		Data = np.ascontiguousarray(Data.values)
 
-	# Get time, latitude and longitude
-	Time = xr.open_dataset('../src/ERA5-Land/ERA5-Land.{Var}.nc'.format(Var=Var))['time'].values
-	Lat  = xr.open_dataset('../src/ERA5-Land/ERA5-Land.{Var}.nc'.format(Var=Var))['latitude'].values
-	Lon  = xr.open_dataset('../src/ERA5-Land/ERA5-Land.{Var}.nc'.format(Var=Var))['longitude'].values
+		if (Precision == 'float32'):
 
-	# Convert to numpy array
-	Data = np.array(Data)
+			Data = Data.astype(np.float32, copy=False)
 
-	# Mask fill values to nan
-	Data = np.ma.masked_where(Data == 1e+20, Data)
+		else:
+
+			Data = np.ma.masked_invalid(Data, copy=False)
+
+	else:
+
+		Data = Prep.Apply_Precision(Data.data, Precision)
 
 	# Convert units
+	Data = Convert_Unit(Data, Time, Var, Frequency)
+
+	# Put decoded arrays into the cache
+	if (Cache) and (Chunk_Size is None):
+
+		PrepCache.Set_Cache(Cache_Key, {'Data': Data, 'Time': Time, 'Lat': Lat, 'Lon': Lon})
+	
+	return Data, Time, Lat, Lon
+
+def Open_Data(Var, Range=None, Time_Range=None, Chunk_Size=None, Frequency='Monthly'):
+
+	"""
+	Open data lazily by xarray with a single file handle, without reading the data values
+	The returned DataArray reads from disk only the part being indexed, so it can be streamed in time chunks
+	(e.g. by Preprocessing.Iter_SpatialAverage). Missing values and the 1e+20 fill value (not always decoded by xarray on these files)
+	are nan, units are not converted
+	==================================================
+	Input:
+		Var: variable name
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: None (whole grid)
+		Time_Range: [start, end] of time (inclusive), e.g. ['1992-01', '2022-12']. Default: None (whole record)
+		Chunk_Size: number of time steps per dask chunk. Default: None (no dask, unless there are appended shard files)
+		Frequency: 'Monthly', 'Daily' or 'Hourly' (see Get_File_List). Default: 'Monthly'
+	Output:
+		Data: lazily indexed xarray DataArray of data (time, latitude, longitude)
+		Time: numpy array of time
+		Lat: numpy array of latitude (from south to north)
+		Lon: numpy array of longitude
+	"""
+
+	# Open dataset (with the months appended by Download_Incremental.py, if any)
+	File_List = Get_File_List(Var, Frequency)
+
+	if (len(File_List) == 1):
+
+		ncFile = xr.open_dataset(File_List[0], decode_cf=False, chunks=None if (Chunk_Size is None) else {'time': Chunk_Size})
+
+		# Declare the fill value as a missing value, so it is masked to nan lazily when decoding (only the indexed part is read)
+		if (np.issubdtype(ncFile[Var].dtype, np.floating)):
+
+			Missing_Value = np.unique(np.append(ncFile[Var].attrs.get('missing_value', []), 1e+20).astype(ncFile[Var].dtype))
+			ncFile[Var].attrs['missing_value'] = Missing_Value[0] if (len(Missing_Value) == 1) else Missing_Value
+
+		ncFile = xr.decode_cf(ncFile)
+		Data = ncFile[Var]
+
+	else:
+
+		# The files must share one grid (e.g. shards downloaded for another area would be outer-joined into a mostly nan cube)
+		try:
+
+			ncFile = xr.open_mfdataset(File_List, combine='nested', concat_dim='time', join='exact', \
+									   chunks={'time': 12 if (Chunk_Size is None) else Chunk_Size})
+
+		except ValueError as Error:
+
+			raise ValueError('Error in Open_Data: grids (latitude and longitude) of the files do not match.') from Error
+
+		# Mask fill values to nan (lazily, as a dask array)
+		Data = ncFile[Var].where(ncFile[Var] != 1e+20)
+
+	# ==================================================
+	# Select time
+	if (Time_Range is not None): Data = Data.sel(time=slice(*Time_Range))
+
+	# Select range by the index window (a range crossing the longitude seam is concatenated from two windows)
+	if (Range is not None):
+
+		Lat_Slice, Lon_Slice_List = Prep.Get_Range_Index(Data['latitude'].values, Data['longitude'].values, Range)
+		Data = Data.isel(latitude=Lat_Slice)
+
+		if (len(Lon_Slice_List) == 1):
+
+			Data = Data.isel(longitude=Lon_Slice_List[0])
+
+		else:
+
+			Data = xr.concat([Data.isel(longitude=i) for i in Lon_Slice_List], dim='longitude')
+
+	# Normalize latitude orientation from south to north (lazily)
+	if (Data['latitude'].values[0] > Data['latitude'].values[-1]):
+
+		Data = Data.isel(latitude=slice(None, None, -1))
+
+	return Data, Data['time'].values, Data['latitude'].values, Data['longitude'].values
+
+def Iter_Band(Data, Time, Var, Memory_Budget=Prep.Memory_Budget_Default, Frequency='Monthly', Element_Size=None):
+
+	"""
+	Iterate over latitude bands of the whole record of lazily opened data, each fitting the memory budget
+	==================================================
+	Input:
+		Data: lazily indexed xarray DataArray of data (time, latitude, longitude) from Open_Data
+		Time: numpy array of time
+		Var: variable name (for unit conversion)
+		Memory_Budget: memory budget (in bytes) of each latitude band. Default: Preprocessing.Memory_Budget_Default
+		Frequency: 'Monthly', 'Daily' or 'Hourly' (for unit conversion, see Convert_Unit). Default: 'Monthly'
+		Element_Size: memory (in bytes) per value of each band, with the temporaries of its reduction by the caller.
+					  Default: None (the data and three float64 temporaries, see Preprocessing.Get_Chunk_Size)
+	Output:
+		Band_Slice: slice of latitude index of each band
+		Data_Band: numpy array of data of each band (time, lat, lon) in converted units with nan for missing values
+	"""
+
+	# Number of latitudes per band (the data and the float64 temporaries)
+	if (Element_Size is None):
+
+		Band_Size = Prep.Get_Chunk_Size(len(Time) * Data.shape[2], Data.dtype.itemsize, Memory_Budget)
+
+	else:
+
+		Band_Size = max(1, int(Memory_Budget // (len(Time) * Data.shape[2] * Element_Size)))
+
+	for ind_Band in range(0, Data.shape[1], Band_Size):
+
+		Band_Slice = slice(ind_Band, min(ind_Band + Band_Size, Data.shape[1]))
+
+		# Read the band (fill values are nan, see Open_Data)
+		Data_Band = Data.isel(latitude=Band_Slice).values.astype(np.float64)
+
+		yield Band_Slice, Convert_Unit(Data_Band, Time, Var, Frequency)
+
+def Iter_Chunk(Data, Time, Var, Memory_Budget=Prep.Memory_Budget_Default, Frequency='Monthly'):
+
+	"""
+	Iterate over time chunks of lazily opened data, each fitting the memory budget
+	==================================================
+	Input:
+		Data, Time, Var, Frequency: see Iter_Band
+		Memory_Budget: memory budget (in bytes) of each time chunk. Default: Preprocessing.Memory_Budget_Default
+	Output:
+		Time_Slice: slice of time index of each chunk
+		Data_Chunk: numpy array of data of each chunk (time, lat, lon) in converted units with nan for missing values
+	"""
+
+	Chunk_Size = Prep.Get_Chunk_Size(Data.shape[1] * Data.shape[2], Data.dtype.itemsize, Memory_Budget)
+
+	for ind_Time in range(0, len(Time), Chunk_Size):
+
+		Time_Slice = slice(ind_Time, min(ind_Time + Chunk_Size, len(Time)))
+
+		# Read the chunk (fill values are nan, see Open_Data)
+		Data_Chunk = Data.isel(time=Time_Slice).values.astype(np.float64)
+
+		yield Time_Slice, Convert_Unit(Data_Chunk, Time[Time_Slice], Var, Frequency)
+
+def Convert_Unit(Data, Time, Var, Frequency='Monthly'):
+
+	"""
+	Convert units of data. Also applicable to spatial averages, since the conversion is uniform in space
+	==================================================
+	Input:
+		Data: numpy array of data. The first dimension should be time
+		Time: numpy array of time
+		Var: variable name
+		Frequency: 'Monthly' (accumulations per month), 'Daily' (accumulations per day) or 'Hourly' (accumulations since 00 UTC,
+				   converted to mm without de-accumulation, see Preprocessing_Daily). Default: 'Monthly'
+	Output:
+		Data: numpy array of converted data
+	"""
+
 	if (Var == 'tp'):
 
 		# Convert m/month to mm/day (considergin the number of days in each month)
-		# Get the number of days in each month
-		Num_Days = np.array([pd.to_datetime(t).daysinmonth for t in Time])
+		# Get the number of days in each month (one day for daily data)
+		Num_Days = PrepCal.Get_Days_In_Month(Time) if (Frequency == 'Monthly') else np.ones(len(Time), dtype=np.int64)
 		
-		# Convert units
-		Data = Data * 1000 / Num_Days[:, None, None]
+		# Convert units (keeping the floating-point precision of data)
+		Factor = (1000 / Num_Days).astype(Data.dtype if (np.issubdtype(Data.dtype, np.floating)) else np.float64)
+		Data = Data * Factor.reshape(-1, *[1] * (Data.ndim - 1))
 	
-	return Data, Time, Lat, Lon
+	return Data
+
+def Get_SummedAreaTable(Var, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Get summed-area tables of data (see Preprocessing.Calc_SummedAreaTable)
+	The tables are stored alongside the output data as .npy files, built chunk by chunk along time, read back as memory-mapped
+	arrays (so each lookup reads only the corners it needs) and rebuilt only when the source files are newer
+	==================================================
+	Input:
+		Var: variable name
+		Memory_Budget: memory budget (in bytes) of each time chunk when building the tables. Default: Preprocessing.Memory_Budget_Default
+	Output:
+		SAT: dictionary of summed-area tables (read-only memory-mapped arrays)
+		Time: numpy array of time
+	"""
+
+	# Set file paths
+	Source_Time = max(os.path.getmtime(i) for i in Get_File_List(Var))
+	Output_Path = '../output/Output_Data/SummedAreaTable/SummedAreaTable.{Var}/'.format(Var=Var)
+	Name_List   = ['Data_SAT', 'Weight_SAT', 'Lat', 'Lon', 'Time']
+
+	# Read the stored tables if they are up to date
+	if all(os.path.exists(Output_Path + i + '.npy') and (os.path.getmtime(Output_Path + i + '.npy') >= Source_Time) for i in Name_List):
+
+		SAT = {i: np.load(Output_Path + i + '.npy', mmap_mode='r') for i in Name_List}
+
+		return SAT, np.asarray(SAT.pop('Time'))
+
+	# ==================================================
+	# Calculate the tables chunk by chunk into a temporary directory
+	Data, Time, Lat, Lon = Open_Data(Var)
+
+	Temp_Path = Output_Path.rstrip('/') + '.tmp.{}/'.format(os.getpid())
+	if (os.path.exists(Temp_Path)): shutil.rmtree(Temp_Path)
+	os.makedirs(Temp_Path)
+
+	Data_SAT = np.lib.format.open_memmap(Temp_Path + 'Data_SAT.npy', mode='w+', dtype=np.float64, shape=(len(Time), len(Lat) + 1, len(Lon) + 1))
+	Mask_Lat = np.cos(np.deg2rad(Lat))[:, None]
+
+	# The weight table is 2-D while the nan pattern equals that of the first time step, and 3-D from the first change on
+	Mask_Land_Static = None
+	Weight_SAT = None
+
+	for Time_Slice, Data_Chunk in Iter_Chunk(Data, Time, Var, Memory_Budget):
+
+		Mask_Land = ~np.isnan(Data_Chunk)
+		if (Mask_Land_Static is None): Mask_Land_Static = Mask_Land[0]
+
+		Data_SAT[Time_Slice] = Prep.Calc_PrefixSum(np.where(Mask_Land, Data_Chunk, 0) * Mask_Lat)
+
+		if (Weight_SAT is None) and (not np.all(Mask_Land == Mask_Land_Static)):
+
+			# Fill the previous time steps with the static weights
+			Weight_SAT = np.lib.format.open_memmap(Temp_Path + 'Weight_SAT.npy', mode='w+', dtype=np.float64, shape=Data_SAT.shape)
+			Weight_SAT[:Time_Slice.start] = Prep.Calc_PrefixSum(Mask_Lat * Mask_Land_Static)
+
+		if (Weight_SAT is not None): Weight_SAT[Time_Slice] = Prep.Calc_PrefixSum(Mask_Lat * Mask_Land)
+
+	Data_SAT.flush()
+	del Data_SAT
+
+	if (Weight_SAT is None):
+
+		np.save(Temp_Path + 'Weight_SAT.npy', Prep.Calc_PrefixSum(Mask_Lat * Mask_Land_Static))
+
+	else:
+
+		Weight_SAT.flush()
+		del Weight_SAT
+
+	for i_Name, i_Array in zip(['Lat', 'Lon', 'Time'], [Lat, Lon, Time]): np.save(Temp_Path + i_Name + '.npy', i_Array)
+
+	# Replace the stored tables
+	if (os.path.exists(Output_Path)): shutil.rmtree(Output_Path)
+	os.rename(Temp_Path, Output_Path)
+
+	SAT = {i: np.load(Output_Path + i + '.npy', mmap_mode='r') for i in Name_List}
+
+	return SAT, np.asarray(SAT.pop('Time'))
 
 if (__name__ == '__main__'):
 
@@ -0,0 +1,197 @@
+import numpy as np
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Get_Data as PrepGD
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Threshold as PrepThr
+
+# ==================================================
+# Heatwave events of daily data at each grid point: runs of at least Min_Duration consecutive days above a calendar-day
+# percentile threshold (see Preprocessing_Threshold). The runs of all grid points are found at once from the start and end edges
+# of the exceedance mask in (grid point, time) order, and the event statistics are segment reductions of the flattened cube
+
+# Bytes per (time step, grid point) of a latitude band at the peak of Calc_Heatwave: the float64 band, its float64 copies
+# (data, exceedance, flattened exceedance), the masks, and at worst one event per two days with its indices and reductions
+Heatwave_Element_Size = 96
+
+def Get_Run(Mask, Link):
+
+	"""
+	Get the runs of True along time at all grid points at once
+	==================================================
+	Input:
+		Mask: boolean numpy array (grid point, time)
+		Link: boolean numpy array (time) of whether each time step follows the previous one without a gap (Link[0] is ignored)
+	Output:
+		Index_Grid: numpy array of grid point index of each run
+		Index_Start: numpy array of the first time step of each run
+		Index_End: numpy array of the last time step of each run (inclusive)
+	"""
+
+	# Previous and next time steps belonging to the same run
+	Prev = np.zeros_like(Mask)
+	Next = np.zeros_like(Mask)
+	Prev[:, 1:] = Mask[:, :-1] & Link[None, 1:]
+	Next[:, :-1] = Mask[:, 1:] & Link[None, 1:]
+
+	# Edges in (grid point, time) order, so the starts and ends of each grid point pair up in order
+	Index_Grid, Index_Start = np.nonzero(Mask & ~Prev)
+	Index_End = np.nonzero(Mask & ~Next)[1]
+
+	return Index_Grid, Index_Start, Index_End
+
+def Calc_Heatwave(Data, Time, Threshold, Min_Duration=3, Year_List=None):
+
+	"""
+	Detect heatwave events at each grid point and calculate the statistics of the events starting in each year
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of daily data. The first dimension should be time
+		Time: numpy array of time (daily, in ascending order). Missing days break events
+		Threshold: numpy array of threshold (366, ...) from Preprocessing_Threshold
+		Min_Duration: minimum number of consecutive days of an event. Default: 3
+		Year_List: numpy array of the years of the output. Default: None (from the first to the last year of time)
+	Output:
+		Heatwave: dictionary of
+			Year_List: numpy array of years
+			Count: number of events (year, ...)
+			Duration: total number of event days (year, ...)
+			Duration_Max: number of days of the longest event (year, ...)
+			Intensity: mean exceedance over the threshold of the event days (year, ...), nan without events
+			Intensity_Max: maximum exceedance over the threshold (year, ...), nan without events
+			Cumulative_Heat: sum of exceedance over the threshold of the event days (year, ...)
+			All statistics are nan at grid points without valid values
+	"""
+
+	Shape = Data.shape[1:]
+	Num_Grid = int(np.prod(Shape))
+
+	Day  = np.asarray(Time).astype('datetime64[D]')
+	Year = Day.astype('datetime64[Y]').astype(np.int64) + 1970
+	if (Year_List is None): Year_List = np.arange(Year[0], Year[-1] + 1)
+
+	# Exceedance over the threshold in (grid point, time) order
+	Data = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan).reshape(-1, Num_Grid)
+	Excess = np.ascontiguousarray((Data - np.asarray(Threshold).reshape(366, Num_Grid)[PrepCal.Get_Calendar_Day(Day), :]).T)
+
+	with np.errstate(invalid='ignore'):
+
+		Mask = Excess > 0
+
+	Index_Valid = np.any(~np.isnan(Excess), axis=1)
+
+	# ==================================================
+	# Runs of exceedance, kept if long enough
+	Link = np.concatenate([[False], np.diff(Day).astype(np.int64) == 1])
+	Index_Grid, Index_Start, Index_End = Get_Run(Mask, Link)
+
+	Duration = Index_End - Index_Start + 1
+	Index_Event = Duration >= Min_Duration
+	Index_Grid, Index_Start, Index_End, Duration = Index_Grid[Index_Event], Index_Start[Index_Event], Index_End[Index_Event], Duration[Index_Event]
+
+	# Sum and maximum of exceedance of each event as segments [start, end + 1) of the flattened cube
+	# (a zero is appended so an event ending at the last element has a valid end index)
+	Excess_Flat = np.append(np.where(Mask, Excess, 0).ravel(), 0)
+	Index_Flat  = np.stack([Index_Grid * len(Day) + Index_Start, Index_Grid * len(Day) + Index_End + 1], axis=1).ravel()
+
+	if (len(Index_Flat) > 0):
+
+		Event_Heat = np.add.reduceat(Excess_Flat, Index_Flat)[::2]
+		Event_Peak = np.maximum.reduceat(Excess_Flat, Index_Flat)[::2]
+
+	else:
+
+		Event_Heat = Event_Peak = np.array([])
+
+	# ==================================================
+	# Statistics of each (grid point, year), attributing events to the year they start
+	# Events are in (grid point, time) order, so the keys are sorted and each key is a segment of events
+	Index_Year = np.searchsorted(Year_List, Year[Index_Start])
+	Index_Event = (Year[Index_Start] >= Year_List[0]) & (Year[Index_Start] <= Year_List[-1])
+
+	Key = (Index_Grid * len(Year_List) + Index_Year)[Index_Event]
+	Duration, Event_Heat, Event_Peak = Duration[Index_Event], Event_Heat[Index_Event], Event_Peak[Index_Event]
+
+	Num_Key = Num_Grid * len(Year_List)
+	Count = np.bincount(Key, minlength=Num_Key).astype(np.float64)
+
+	# (bincount of empty weights is an integer array, so the sums are cast for the nan of grid points without valid values)
+	Heatwave = {\
+		'Count'          : Count, \
+		'Duration'       : np.bincount(Key, weights=Duration, minlength=Num_Key).astype(np.float64), \
+		'Duration_Max'   : np.zeros(Num_Key), \
+		'Intensity_Max'  : np.full(Num_Key, np.nan), \
+		'Cumulative_Heat': np.bincount(Key, weights=Event_Heat, minlength=Num_Key).astype(np.float64), \
+	}
+
+	if (len(Key) > 0):
+
+		Key_Start = np.flatnonzero(np.concatenate([[True], np.diff(Key) != 0]))
+
+		Heatwave['Duration_Max'][Key[Key_Start]]  = np.maximum.reduceat(Duration, Key_Start)
+		Heatwave['Intensity_Max'][Key[Key_Start]] = np.maximum.reduceat(Event_Peak, Key_Start)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Heatwave['Intensity'] = np.where(Count > 0, Heatwave['Cumulative_Heat'] / Heatwave['Duration'], np.nan)
+
+	# (grid point, year) to (year, ...), nan at grid points without valid values
+	for i_Key in list(Heatwave.keys()):
+
+		Heatwave[i_Key] = Heatwave[i_Key].reshape(Num_Grid, len(Year_List))
+		Heatwave[i_Key][~Index_Valid, :] = np.nan
+		Heatwave[i_Key] = np.ascontiguousarray(Heatwave[i_Key].T).reshape(len(Year_List), *Shape)
+
+	Heatwave['Year_List'] = Year_List
+
+	return Heatwave
+
+def Get_Heatwave(Var='t2m', Range='EastAsia_Analysis_Extended', Time_Range=None, Baseline=None, Percentile=90, Window=15, \
+				 Method='Exact', Min_Duration=3, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Detect heatwave events of the daily data of a variable (see Preprocessing_Get_Data.Get_File_List)
+	The data is read in latitude bands of the whole record fitting the memory budget, so events are never split in time
+	==================================================
+	Input:
+		Var: variable name. Default: 't2m'
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: 'EastAsia_Analysis_Extended'
+		Time_Range: [start, end] of time (inclusive), e.g. ['1992-01-01', '2022-12-31']. Default: None (whole record)
+		Baseline, Percentile, Window, Method: threshold (see Preprocessing_Threshold.Get_Threshold)
+		Min_Duration: minimum number of consecutive days of an event. Default: 3
+		Memory_Budget: memory budget (in bytes) of each latitude band with the temporaries of Calc_Heatwave (see Heatwave_Element_Size).
+					   Default: Preprocessing.Memory_Budget_Default
+	Output:
+		Heatwave: dictionary of statistics (year, lat, lon) from Calc_Heatwave
+		Threshold: numpy array of threshold (366, lat, lon)
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	"""
+
+	Threshold = PrepThr.Get_Threshold(Var, Range, Baseline, Percentile, Window, Method, Memory_Budget)[0]
+
+	Data, Time, Lat, Lon = PrepGD.Open_Data(Var, Range=Range, Time_Range=Time_Range, Frequency='Daily')
+
+	Year_List = np.arange(Time[0].astype('datetime64[Y]').astype(np.int64) + 1970, Time[-1].astype('datetime64[Y]').astype(np.int64) + 1971)
+	Heatwave  = None
+
+	for Band_Slice, Data_Band in PrepGD.Iter_Band(Data, Time, Var, Memory_Budget, 'Daily', Heatwave_Element_Size):
+
+		Heatwave_Band = Calc_Heatwave(Data_Band, Time, Threshold[:, Band_Slice, :], Min_Duration, Year_List)
+
+		if (Heatwave is None):
+
+			Heatwave = {i: np.full((len(Year_List), len(Lat), len(Lon)), np.nan) for i in Heatwave_Band if (i != 'Year_List')}
+			Heatwave['Year_List'] = Year_List
+
+		for i_Key in Heatwave_Band:
+
+			if (i_Key != 'Year_List'): Heatwave[i_Key][:, Band_Slice, :] = Heatwave_Band[i_Key]
+
+	return Heatwave, Threshold, Lat, Lon
+
+if (__name__ == '__main__'):
+
+	# Get heatwave events
+	Heatwave, Threshold, Lat, Lon = Get_Heatwave('t2m', 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])
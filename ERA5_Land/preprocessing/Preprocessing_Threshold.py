@@ -0,0 +1,367 @@
+import numpy as np
+import scipy.stats
+import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Get_Data as PrepGD
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Climatology as PrepClim
+
+# ==================================================
+# Calendar-day percentile thresholds of daily data, on the 366-day calendar of Preprocessing_Calendar.Get_Calendar_Day
+# The threshold of each calendar day is the percentile of the days of the baseline years within a window centred on the day
+# Exact: the data of a block of grid points is arranged by (calendar day, year), so the window of each day is a contiguous slice
+#        copied into a reused buffer and partitioned in place
+# Sketch: per (calendar day, grid point) moments (Count, Mean, M2, M3, M4) merged exactly across time chunks (Pebay, 2008),
+#         pooled over the window, and the percentile estimated by the Cornish-Fisher expansion of the four moments.
+#         This is a parametric approximation, not a quantile sketch: its error has no bound and can be large in the tails of
+#         skewed or bounded distributions (e.g. P90 of daily maximum temperature), so thresholds for analysis should use Exact.
+#         Latitude bands are processed in turn over time chunks, each band sized so its sketches fit half of the memory budget
+
+# Bytes of the sketch state per grid point: the merged and chunk sketches, the merged output and the temporaries of
+# Merge_Sketch (24 arrays of 366 calendar days in float64 at the peak)
+Sketch_Size = 24 * 366 * 8
+
+def Calc_Threshold(Data, Time, Percentile=90, Window=15, Baseline=None, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Calculate the exact calendar-day percentile threshold (linear interpolation, as numpy.percentile)
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of daily data. The first dimension should be time
+		Time: numpy array of time
+		Percentile: percentile (0 to 100). Default: 90
+		Window: number of days of the window centred on each calendar day (odd). Default: 15
+		Baseline: [year_start, year_end] (inclusive). Default: None (whole record)
+		Memory_Budget: memory budget (in bytes) of each block of grid points. Default: Preprocessing.Memory_Budget_Default
+	Output:
+		Threshold: numpy array of threshold (366, ...), nan for grid points without valid values
+	"""
+
+	Shape = Data.shape[1:]
+	Time_Slice = PrepClim.Get_Baseline_Slice(Time, Baseline)
+
+	Data = np.ma.filled(np.ma.asarray(Data[Time_Slice]).astype(np.float64), np.nan).reshape(-1, int(np.prod(Shape)))
+	Day  = PrepCal.Get_Calendar_Day(Time[Time_Slice])
+	Year = np.asarray(Time[Time_Slice]).astype('datetime64[Y]').astype(np.int64)
+	Year = Year - Year[0]
+
+	Half = Window // 2
+	Num_Year = Year[-1] + 1
+	Num_Grid = Data.shape[1]
+
+	# Number of grid points per block (the slots, the window buffer and the data of the block)
+	Block_Size = max(1, int(Memory_Budget // (((366 + 2 * Half) * Num_Year + Window * Num_Year + len(Day)) * 8)))
+
+	Threshold = np.full((366, Num_Grid), np.nan)
+	Buffer = np.empty((min(Block_Size, Num_Grid), Window * Num_Year))
+
+	for ind_Block in range(0, Num_Grid, Block_Size):
+
+		Block_Slice = slice(ind_Block, min(ind_Block + Block_Size, Num_Grid))
+		Num_Block = Block_Slice.stop - Block_Slice.start
+
+		# ==================================================
+		# Slots (grid point, calendar day, year), nan for missing days (e.g. February 29 of common years), padded circularly
+		Slot = np.full((Num_Block, 366 + 2 * Half, Num_Year), np.nan)
+		Slot[:, Half + Day, Year] = Data[:, Block_Slice].T
+		Slot[:, :Half, :] = Slot[:, 366:366 + Half, :]
+		Slot[:, 366 + Half:, :] = Slot[:, Half:2 * Half, :]
+
+		# Number of valid values in the window of each calendar day
+		Count = np.concatenate([np.zeros((Num_Block, 1)), np.cumsum(np.sum(~np.isnan(Slot), axis=2), axis=1)], axis=1)
+		Num_Valid = (Count[:, Window:] - Count[:, :-Window]).astype(np.int64)
+
+		Slot = Slot.reshape(Num_Block, -1)
+		Work = Buffer[:Num_Block]
+
+		for ind_Day in range(366):
+
+			# The window is a contiguous slice of the slots, copied into the reused buffer and partitioned in place
+			# (nan are placed after all values, so the order statistics of the valid values are not affected)
+			np.copyto(Work, Slot[:, ind_Day * Num_Year:(ind_Day + Window) * Num_Year])
+
+			Index_Valid = np.flatnonzero(Num_Valid[:, ind_Day] > 0)
+			Num_Valid_List = np.unique(Num_Valid[Index_Valid, ind_Day])
+
+			for i_Num_Valid in Num_Valid_List:
+
+				# Grid points with the same number of valid values share the order statistics to partition
+				Rank = Percentile / 100 * (i_Num_Valid - 1)
+				Rank_Low, Rank_High = int(np.floor(Rank)), min(int(np.floor(Rank)) + 1, i_Num_Valid - 1)
+
+				if (len(Num_Valid_List) == 1):
+
+					Index = Index_Valid
+					Work.partition([Rank_Low, Rank_High], axis=1)
+					Value_Low, Value_High = Work[Index, Rank_Low], Work[Index, Rank_High]
+
+				else:
+
+					Index = Index_Valid[Num_Valid[Index_Valid, ind_Day] == i_Num_Valid]
+					Work_Part = Work[Index]
+					Work_Part.partition([Rank_Low, Rank_High], axis=1)
+					Value_Low, Value_High = Work_Part[:, Rank_Low], Work_Part[:, Rank_High]
+
+				Threshold[ind_Day, Block_Slice.start + Index] = Value_Low + (Rank - Rank_Low) * (Value_High - Value_Low)
+
+	return Threshold.reshape(366, *Shape)
+
+def Calc_Chunk_Sketch(Data, Day_Index):
+
+	"""
+	Calculate the moment sketch of each calendar day of a chunk of data in one vectorized pass
+	==================================================
+	Input:
+		Data: numpy array of daily data with nan for missing values. The first dimension should be time
+		Day_Index: numpy array of calendar day (0 to 365) of each time step
+	Output:
+		Sketch: dictionary of Count, Mean, M2, M3 and M4 (sums of the powers of deviations from the mean), each of shape (366, ...)
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = Data.reshape(Data.shape[0], -1)
+	Valid = ~np.isnan(Data)
+
+	# One-hot matrix of calendar days, so the reductions are matrix products
+	Day_Matrix = PrepCal.Get_Group_Matrix(Day_Index, 366)
+
+	Count = Day_Matrix @ Valid.astype(np.float64)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Mean = (Day_Matrix @ np.where(Valid, Data, 0)) / Count
+
+	Deviation = np.where(Valid, Data - np.nan_to_num(Mean)[Day_Index, :], 0)
+
+	Sketch = {\
+		'Count': Count, \
+		'Mean' : Mean, \
+		'M2'   : Day_Matrix @ Deviation ** 2, \
+		'M3'   : Day_Matrix @ Deviation ** 3, \
+		'M4'   : Day_Matrix @ Deviation ** 4, \
+	}
+
+	return {i: Sketch[i].reshape(366, *Shape) for i in Sketch}
+
+def Merge_Sketch(Sketch_A, Sketch_B):
+
+	"""
+	Merge the moment sketches of two disjoint sets of values exactly (Pebay, 2008)
+	==================================================
+	Input:
+		Sketch_A, Sketch_B: dictionaries of Count, Mean, M2, M3 and M4
+	Output:
+		Sketch: dictionary of Count, Mean, M2, M3 and M4 of both sets
+	"""
+
+	Count_A, Count_B = Sketch_A['Count'], Sketch_B['Count']
+	Mean_A , Mean_B  = np.where(Count_A > 0, Sketch_A['Mean'], 0), np.where(Count_B > 0, Sketch_B['Mean'], 0)
+	Count = Count_A + Count_B
+	Delta = Mean_B - Mean_A
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Mean = (Count_A * Mean_A + Count_B * Mean_B) / Count
+
+		# Terms of the deviation between the means, zero if either set is empty
+		Ratio = np.where(Count > 0, Count_A * Count_B / Count, 0)
+		Delta_A = np.where(Count > 0, Delta * Count_A / Count, 0)
+		Delta_B = np.where(Count > 0, Delta * Count_B / Count, 0)
+
+	M2 = Sketch_A['M2'] + Sketch_B['M2'] + Delta ** 2 * Ratio
+	M3 = Sketch_A['M3'] + Sketch_B['M3'] + Delta ** 3 * Ratio * (Count_A - Count_B) / np.maximum(Count, 1) \
+	   + 3 * (Delta_A * Sketch_B['M2'] - Delta_B * Sketch_A['M2'])
+	M4 = Sketch_A['M4'] + Sketch_B['M4'] + Delta ** 4 * Ratio * (Count_A ** 2 - Count_A * Count_B + Count_B ** 2) / np.maximum(Count, 1) ** 2 \
+	   + 6 * (Delta_A ** 2 * Sketch_B['M2'] + Delta_B ** 2 * Sketch_A['M2']) + 4 * (Delta_A * Sketch_B['M3'] - Delta_B * Sketch_A['M3'])
+
+	return {'Count': Count, 'Mean': Mean, 'M2': M2, 'M3': M3, 'M4': M4}
+
+def Calc_Sketch_Quantile(Sketch, Percentile=90):
+
+	"""
+	Estimate the percentile from the four moments by the Cornish-Fisher expansion (skewness and excess kurtosis)
+	A parametric approximation without an error bound (see the module header)
+	==================================================
+	Input:
+		Sketch: dictionary of Count, Mean, M2, M3 and M4
+		Percentile: percentile (0 to 100). Default: 90
+	Output:
+		Quantile: numpy array of the estimated percentile, nan where Count < 2
+	"""
+
+	Count = Sketch['Count']
+	z = scipy.stats.norm.ppf(Percentile / 100)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Std = np.sqrt(np.where(Count > 1, Sketch['M2'] / Count, np.nan))
+		Skewness = np.sqrt(Count) * Sketch['M3'] / Sketch['M2'] ** 1.5
+		Kurtosis = Count * Sketch['M4'] / Sketch['M2'] ** 2 - 3
+
+	w = z + (z ** 2 - 1) * Skewness / 6 + (z ** 3 - 3 * z) * Kurtosis / 24 - (2 * z ** 3 - 5 * z) * Skewness ** 2 / 36
+
+	# Values without spread are the percentile themselves
+	return np.where(Std == 0, Sketch['Mean'], Sketch['Mean'] + Std * w)
+
+def Calc_Threshold_Sketch(Sketch, Percentile=90, Window=15):
+
+	"""
+	Calculate the approximate calendar-day percentile threshold from the moment sketches of the calendar days
+	==================================================
+	Input:
+		Sketch: dictionary of Count, Mean, M2, M3 and M4 of shape (366, ...), e.g. merged from Calc_Chunk_Sketch of time chunks
+		Percentile: percentile (0 to 100). Default: 90
+		Window: number of days of the window centred on each calendar day (odd). Default: 15
+	Output:
+		Threshold: numpy array of threshold (366, ...)
+	"""
+
+	Half = Window // 2
+	Count = Sketch['Count']
+
+	# Power sums of deviations from a reference of each grid point (the mean of all days), so pooling is a sum over the window
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Reference = np.nan_to_num(np.sum(Count * np.nan_to_num(Sketch['Mean']), axis=0) / np.sum(Count, axis=0))
+
+	d  = np.where(Count > 0, Sketch['Mean'] - Reference, 0)
+	S1 = Count * d
+	S2 = Sketch['M2'] + S1 * d
+	S3 = Sketch['M3'] + 3 * d * Sketch['M2'] + S1 * d ** 2
+	S4 = Sketch['M4'] + 4 * d * Sketch['M3'] + 6 * d ** 2 * Sketch['M2'] + S1 * d ** 3
+
+	Threshold = np.full(Sketch['Mean'].shape, np.nan)
+
+	for ind_Day in range(366):
+
+		Index_Window = np.arange(ind_Day - Half, ind_Day + Half + 1) % 366
+
+		Count_Window = np.sum(Count[Index_Window], axis=0)
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+
+			m = np.where(Count_Window > 0, np.sum(S1[Index_Window], axis=0) / Count_Window, 0)
+
+		# Back to the moments about the mean of the window
+		S2_Window = np.sum(S2[Index_Window], axis=0)
+		S3_Window = np.sum(S3[Index_Window], axis=0)
+		S4_Window = np.sum(S4[Index_Window], axis=0)
+
+		Sketch_Window = {\
+			'Count': Count_Window, \
+			'Mean' : Reference + m, \
+			'M2'   : np.maximum(S2_Window - Count_Window * m ** 2, 0), \
+			'M3'   : S3_Window - 3 * m * S2_Window + 2 * Count_Window * m ** 3, \
+			'M4'   : np.maximum(S4_Window - 4 * m * S3_Window + 6 * m ** 2 * S2_Window - 3 * Count_Window * m ** 4, 0), \
+		}
+
+		Threshold[ind_Day] = Calc_Sketch_Quantile(Sketch_Window, Percentile)
+
+	return Threshold
+
+def Get_Threshold_File(Var, Range, Baseline, Percentile, Window, Method):
+
+	"""
+	Get the file name of the stored threshold
+	==================================================
+	Input:
+		Var, Range, Baseline, Percentile, Window, Method: see Get_Threshold
+	Output:
+		Output_File: file name
+	"""
+
+	return 'Threshold.{Var}.{Range}.P{Percentile}.W{Window}.{Baseline}.{Method}.npz'.format(\
+		Var=Var, \
+		Range='Global' if (Range is None) else (Range if (isinstance(Range, str)) else '_'.join(str(i) for i in Range)), \
+		Percentile=Percentile, Window=Window, \
+		Baseline='All' if (Baseline is None) else '{}-{}'.format(*Baseline), \
+		Method=Method, \
+	)
+
+def Get_Threshold(Var='t2m', Range='EastAsia_Analysis_Extended', Baseline=None, Percentile=90, Window=15, Method='Exact', \
+				  Memory_Budget=Prep.Memory_Budget_Default, Rebuild=False):
+
+	"""
+	Get the calendar-day percentile threshold of the daily data of a variable (see Preprocessing_Get_Data.Get_File_List)
+	The threshold is stored as a float32 (366, lat, lon) array per variable, range, percentile, window, baseline period and method,
+	and recalculated only when the source files are newer
+	==================================================
+	Input:
+		Var: variable name. Default: 't2m'
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: 'EastAsia_Analysis_Extended'
+		Baseline: [year_start, year_end] (inclusive). Default: None (whole record)
+		Percentile: percentile (0 to 100). Default: 90
+		Window: number of days of the window centred on each calendar day (odd). Default: 15
+		Method: 'Exact' (latitude bands of the whole baseline, see Calc_Threshold) or 'Sketch' (latitude bands over time chunks,
+				holding the moment sketches of (366, band), see Calc_Threshold_Sketch; a parametric approximation without an error
+				bound). Default: 'Exact'
+		Memory_Budget: memory budget (in bytes) of each latitude band (Exact), or each band of sketches and time chunk together
+					   (Sketch). Default: Preprocessing.Memory_Budget_Default
+		Rebuild: whether to recalculate the threshold. Default: False
+	Output:
+		Threshold: numpy array of threshold (366, lat, lon)
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	"""
+
+	if (Method not in ['Exact', 'Sketch']):
+
+		raise ValueError('Error in Get_Threshold: wrong method.')
+
+	# Set file paths
+	Source_Time = max(os.path.getmtime(i) for i in PrepGD.Get_File_List(Var, 'Daily'))
+	Output_Path = '../output/Output_Data/Threshold/'
+	Output_File = Get_Threshold_File(Var, Range, Baseline, Percentile, Window, Method)
+
+	# Read the stored threshold if it is up to date
+	if (not Rebuild) and (os.path.exists(Output_Path + Output_File)) and (os.path.getmtime(Output_Path + Output_File) >= Source_Time):
+
+		with np.load(Output_Path + Output_File) as npzFile:
+
+			return npzFile['Threshold'], npzFile['Lat'], npzFile['Lon']
+
+	# ==================================================
+	# Open the baseline period lazily
+	Time_Range = None if (Baseline is None) else ['{}-01-01'.format(Baseline[0]), '{}-12-31'.format(Baseline[1])]
+	Data, Time, Lat, Lon = PrepGD.Open_Data(Var, Range=Range, Time_Range=Time_Range, Frequency='Daily')
+
+	if (Method == 'Exact'):
+
+		Threshold = np.full((366, len(Lat), len(Lon)), np.nan, dtype=np.float32)
+
+		for Band_Slice, Data_Band in PrepGD.Iter_Band(Data, Time, Var, Memory_Budget, 'Daily'):
+
+			Threshold[:, Band_Slice, :] = Calc_Threshold(Data_Band, Time, Percentile, Window, Memory_Budget=Memory_Budget)
+
+	else:
+
+		Threshold = np.full((366, len(Lat), len(Lon)), np.nan, dtype=np.float32)
+
+		# Number of latitudes per band whose sketch state fits half of the budget (the time chunks take the other half)
+		Band_Size = max(1, int(Memory_Budget // 2 // (len(Lon) * Sketch_Size)))
+
+		for ind_Band in range(0, len(Lat), Band_Size):
+
+			Band_Slice = slice(ind_Band, min(ind_Band + Band_Size, len(Lat)))
+			Sketch = None
+
+			for Time_Slice, Data_Chunk in PrepGD.Iter_Chunk(Data.isel(latitude=Band_Slice), Time, Var, Memory_Budget // 2, 'Daily'):
+
+				Sketch_Chunk = Calc_Chunk_Sketch(Data_Chunk, PrepCal.Get_Calendar_Day(Time[Time_Slice]))
+				Sketch = Sketch_Chunk if (Sketch is None) else Merge_Sketch(Sketch, Sketch_Chunk)
+
+			Threshold[:, Band_Slice, :] = Calc_Threshold_Sketch(Sketch, Percentile, Window)
+
+	# Store the threshold (write to a temporary file first to avoid partially written files)
+	if not os.path.exists(Output_Path): os.makedirs(Output_Path)
+	np.savez(Output_Path + Output_File + '.tmp.npz', Threshold=Threshold, Lat=Lat, Lon=Lon)
+	os.replace(Output_Path + Output_File + '.tmp.npz', Output_Path + Output_File)
+
+	return Threshold, Lat, Lon
+
+if (__name__ == '__main__'):
+
+	# Get the threshold
+	Threshold, Lat, Lon = Get_Threshold('t2m', 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])
@@ -0,0 +1,432 @@
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Get_Data as PrepGD
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Threshold as PrepThr
+
+# ==================================================
+# Heatwave objects: connected regions of exceedance over the calendar-day threshold in (time, lat, lon)
+# Each time chunk is labelled at once, and the labels are stitched to the last time step of the previous chunk: labels connected
+# across the boundary are merged (union-find over global labels), so the whole record is never resident. The statistics of each
+# chunk are reduced per (label, time step). Objects not present at the last time step of a chunk are complete: their statistics
+# are reduced and their footprints and tracks dropped, so only the open objects are carried over (and relabelled) to the next chunk
+
+def Get_Cell_Area(Lat, Lon):
+
+	"""
+	Get the area of each grid cell from the cosine of latitude
+	==================================================
+	Input:
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	Output:
+		Cell_Area: numpy array of area (in km^2) (lat, lon)
+	"""
+
+	Radius = 6371.0
+
+	dLat = np.deg2rad(np.abs(np.gradient(Lat)))
+	dLon = np.deg2rad(np.abs(np.gradient(Lon)))
+
+	return Radius ** 2 * (dLat * np.cos(np.deg2rad(Lat)))[:, None] * dLon[None, :]
+
+def Get_Range_Mask(Lat, Lon, Range):
+
+	"""
+	Get the mask of the grid points inside the given range
+	==================================================
+	Input:
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name
+	Output:
+		Mask: boolean numpy array (lat, lon)
+	"""
+
+	Lat_Slice, Lon_Slice_List = Prep.Get_Range_Index(Lat, Lon, Range)
+
+	Mask = np.zeros((len(Lat), len(Lon)), dtype=bool)
+	for i_Lon_Slice in Lon_Slice_List: Mask[Lat_Slice, i_Lon_Slice] = True
+
+	return Mask
+
+def Get_Root(Parent):
+
+	"""
+	Get the root of each label of the union-find forest by pointer jumping
+	==================================================
+	Input:
+		Parent: numpy array of the parent of each label (a root is its own parent)
+	Output:
+		Root: numpy array of the root of each label
+	"""
+
+	Root = Parent
+
+	while (True):
+
+		Root_Next = Root[Root]
+		if (np.array_equal(Root_Next, Root)): return Root
+		Root = Root_Next
+
+def Get_Link_Pair(Label_Prev, Label_Next, Structure):
+
+	"""
+	Get the pairs of labels connected from one time step to the next
+	==================================================
+	Input:
+		Label_Prev: numpy array of labels (lat, lon) of the last time step of the previous chunk, 0 for background
+		Label_Next: numpy array of labels (lat, lon) of the first time step of the next chunk, 0 for background
+		Structure: boolean numpy array (3, 3, 3) of the connectivity
+	Output:
+		Pair: numpy array of unique pairs of connected labels (pair, 2)
+	"""
+
+	Num_Lat, Num_Lon = Label_Prev.shape
+	Pair = []
+
+	# Each neighbour (dlat, dlon) of the next time step in the structure
+	for i_dLat, i_dLon in zip(*np.nonzero(Structure[2])):
+
+		i_dLat, i_dLon = i_dLat - 1, i_dLon - 1
+
+		Label_A = Label_Prev[max(0, -i_dLat):Num_Lat - max(0, i_dLat), max(0, -i_dLon):Num_Lon - max(0, i_dLon)]
+		Label_B = Label_Next[max(0, i_dLat):Num_Lat - max(0, -i_dLat), max(0, i_dLon):Num_Lon - max(0, -i_dLon)]
+
+		Index = (Label_A > 0) & (Label_B > 0)
+		Pair.append(np.stack([Label_A[Index], Label_B[Index]], axis=1))
+
+	return np.unique(np.concatenate(Pair, axis=0), axis=0)
+
+def Merge_Label(Parent, Pair):
+
+	"""
+	Merge the connected labels in place, pointing all labels of each connected group to the smallest one
+	==================================================
+	Input:
+		Parent: numpy array of the parent of each label. The labels of the pairs should be roots
+		Pair: numpy array of pairs of connected labels (pair, 2)
+	"""
+
+	Node, Inverse = np.unique(Pair, return_inverse=True)
+	Inverse = Inverse.reshape(-1, 2)
+
+	Graph = scipy.sparse.coo_matrix((np.ones(len(Inverse)), (Inverse[:, 0], Inverse[:, 1])), shape=(len(Node), len(Node)))
+	Num_Group, Group = scipy.sparse.csgraph.connected_components(Graph, directed=False)
+
+	Group_Root = np.full(Num_Group, np.iinfo(np.int64).max)
+	np.minimum.at(Group_Root, Group, Node)
+
+	Parent[Node] = Group_Root[Group]
+
+	return
+
+def Reduce_Object(Track, Footprint, Num_Grid, Cell_Area, Mask_Range, Min_Duration=3, Min_Area=0):
+
+	"""
+	Reduce the statistics and the daily track of complete objects
+	==================================================
+	Input:
+		Track: dictionary of Label, Time, Area, Lat_Sum, Lon_Sum, Heat and Intensity_Max of each (label, time step) of the objects
+		Footprint: numpy array of unique label * Num_Grid + grid point index covered by the objects
+		Num_Grid: number of grid points
+		Cell_Area: numpy array of area (in km^2) of each grid point
+		Mask_Range: boolean numpy array (region, grid point) of the regions of the overlap
+		Min_Duration, Min_Area: see Calc_Object
+	Output:
+		Object: dictionary of the statistics of the objects kept, in order of start time (see Calc_Object, without Range_List)
+		Track: dictionary of the daily track of the objects kept, ordered by object and day (see Calc_Object)
+	"""
+
+	# Reduce each (object, day)
+	Order = np.lexsort((Track['Time'], Track['Label']))
+	Track = {i: Track[i][Order] for i in Track}
+
+	Index_Row = np.flatnonzero(np.concatenate([[True], (np.diff(Track['Label']) != 0) | (np.diff(Track['Time']) != np.timedelta64(0, 'D'))])) \
+				if (len(Order) > 0) else np.array([], dtype=np.int64)
+
+	if (len(Index_Row) > 0):
+
+		Track = {\
+			'Label'        : Track['Label'][Index_Row], \
+			'Time'         : Track['Time'][Index_Row], \
+			'Area'         : np.add.reduceat(Track['Area'], Index_Row), \
+			'Lat_Sum'      : np.add.reduceat(Track['Lat_Sum'], Index_Row), \
+			'Lon_Sum'      : np.add.reduceat(Track['Lon_Sum'], Index_Row), \
+			'Heat'         : np.add.reduceat(Track['Heat'], Index_Row), \
+			'Intensity_Max': np.maximum.reduceat(Track['Intensity_Max'], Index_Row), \
+		}
+
+	# Statistics of each object (rows of each label are consecutive and in time order)
+	Label_List, Index_Object, Num_Row = np.unique(Track['Label'], return_index=True, return_counts=True)
+	Index_Object_End = Index_Object + Num_Row - 1
+
+	Object = {\
+		'Time_Start'     : Track['Time'][Index_Object], \
+		'Time_End'       : Track['Time'][Index_Object_End], \
+		'Duration'       : (Track['Time'][Index_Object_End] - Track['Time'][Index_Object]).astype(np.int64) + 1, \
+		'Area_Max'       : np.maximum.reduceat(Track['Area'], Index_Object) if (len(Label_List) > 0) else np.array([]), \
+		'Intensity_Max'  : np.maximum.reduceat(Track['Intensity_Max'], Index_Object) if (len(Label_List) > 0) else np.array([]), \
+		'Cumulative_Heat': np.add.reduceat(Track['Heat'], Index_Object) if (len(Label_List) > 0) else np.array([]), \
+	}
+
+	# Footprint area and the overlap with each region
+	Footprint_Object = np.searchsorted(Label_List, Footprint // Num_Grid)
+	Footprint_Grid   = Footprint % Num_Grid
+
+	Object['Footprint_Area'] = np.bincount(Footprint_Object, weights=Cell_Area[Footprint_Grid], minlength=len(Label_List))
+	Object['Region_Overlap'] = np.zeros((len(Label_List), len(Mask_Range)))
+
+	for ind_Range in range(len(Mask_Range)):
+
+		Object['Region_Overlap'][:, ind_Range] = np.bincount(Footprint_Object, weights=(Cell_Area * Mask_Range[ind_Range])[Footprint_Grid], minlength=len(Label_List))
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Object['Region_Overlap'] = Object['Region_Overlap'] / Object['Footprint_Area'][:, None]
+
+	# ==================================================
+	# Keep objects long and large enough, in order of start time
+	Index_Keep = np.flatnonzero((Object['Duration'] >= Min_Duration) & (Object['Footprint_Area'] >= Min_Area))
+	Index_Keep = Index_Keep[np.argsort(Object['Time_Start'][Index_Keep], kind='stable')]
+
+	Object = {i: Object[i][Index_Keep] for i in Object}
+
+	Object_Index = np.full(len(Label_List), -1)
+	Object_Index[Index_Keep] = np.arange(len(Index_Keep))
+
+	Track_Object = Object_Index[np.searchsorted(Label_List, Track['Label'])] if (len(Label_List) > 0) else np.array([], dtype=np.int64)
+	Index_Track  = np.flatnonzero(Track_Object >= 0)
+	Index_Track  = Index_Track[np.argsort(Track_Object[Index_Track], kind='stable')]
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Track = {\
+			'Object'       : Track_Object[Index_Track], \
+			'Time'         : Track['Time'][Index_Track], \
+			'Area'         : Track['Area'][Index_Track], \
+			'Centroid_Lat' : Track['Lat_Sum'][Index_Track] / Track['Area'][Index_Track], \
+			'Centroid_Lon' : Track['Lon_Sum'][Index_Track] / Track['Area'][Index_Track], \
+			'Intensity_Max': Track['Intensity_Max'][Index_Track], \
+		}
+
+	return Object, Track
+
+def Calc_Object(Excess_Iter, Lat, Lon, Range_List=None, Connectivity=1, Min_Duration=3, Min_Area=0):
+
+	"""
+	Label heatwave objects from time chunks of exceedance over the threshold, and calculate their statistics and tracks
+	==================================================
+	Input:
+		Excess_Iter: iterable of (Time, Excess) of consecutive time chunks, where Excess is a numpy array of data minus
+					 threshold (time, lat, lon) with nan for missing values. Missing days break objects
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range_List: list of [lat_min, lat_max, lon_min, lon_max] or string of region name for the overlap.
+					Default: None (all ranges of Preprocessing.Range_Dict)
+		Connectivity: connectivity of neighbours in (time, lat, lon), 1 (faces), 2 (edges) or 3 (corners). Default: 1
+		Min_Duration: minimum number of days of an object. Default: 3
+		Min_Area: minimum footprint area (in km^2) of an object. Default: 0
+	Output:
+		Object: dictionary of
+			Time_Start: numpy array of the first day of each object
+			Time_End: numpy array of the last day of each object
+			Duration: number of days
+			Footprint_Area: area (in km^2) of the grid points covered at any time
+			Area_Max: maximum area (in km^2) covered on one day
+			Intensity_Max: maximum exceedance over the threshold
+			Cumulative_Heat: sum of exceedance over the threshold weighted by area (in K km^2 day)
+			Region_Overlap: fraction of the footprint area inside each region (object, region)
+			Range_List: list of regions of Region_Overlap
+		Track: dictionary of the daily track of objects, ordered by object and day
+			Object: index of object
+			Time: day
+			Area: area (in km^2) covered on the day
+			Centroid_Lat: area-weighted centroid latitude
+			Centroid_Lon: area-weighted centroid longitude
+			Intensity_Max: maximum exceedance over the threshold on the day
+	"""
+
+
+	if (Range_List is None): Range_List = list(Prep.Range_Dict.keys())
+
+	Structure = scipy.ndimage.generate_binary_structure(3, Connectivity)
+
+	Num_Grid   = len(Lat) * len(Lon)
+	Cell_Area  = Get_Cell_Area(Lat, Lon).ravel()
+	Lat_Grid   = np.repeat(Lat, len(Lon)).astype(np.float64)
+	Lon_Grid   = np.tile(Lon, len(Lat)).astype(np.float64)
+	Mask_Range = np.array([Get_Range_Mask(Lat, Lon, i).ravel() for i in Range_List]).reshape(len(Range_List), Num_Grid)
+
+	# Union-find forest of the labels of open objects (0 for background), the last labelled time step, the statistics of
+	# open objects, and the reduced complete objects
+	Parent      = np.zeros(1, dtype=np.int64)
+	Label_Prev  = None
+	Day_Prev    = None
+	Footprint   = np.array([], dtype=np.int64)
+	Track       = {i: np.array([], dtype=np.int64 if (i == 'Label') else ('datetime64[D]' if (i == 'Time') else np.float64)) \
+				   for i in ['Label', 'Time', 'Area', 'Lat_Sum', 'Lon_Sum', 'Heat', 'Intensity_Max']}
+	Object_List = []
+
+	for i_Time, i_Excess in Excess_Iter:
+
+		i_Day = np.asarray(i_Time).astype('datetime64[D]')
+
+		# Split the chunk at missing days
+		Index_Break = np.flatnonzero(np.diff(i_Day).astype(np.int64) != 1) + 1
+
+		for Day, Excess in zip(np.split(i_Day, Index_Break), np.split(np.asarray(i_Excess), Index_Break, axis=0)):
+
+			with np.errstate(invalid='ignore'):
+
+				Label, Num_Label = scipy.ndimage.label(Excess > 0, structure=Structure)
+
+			# Global labels of this chunk, and merge with the labels of the previous time step across the boundary
+			Label_Global = np.arange(len(Parent), len(Parent) + Num_Label, dtype=np.int64)
+			Parent = np.concatenate([Parent, Label_Global])
+
+			if (Label_Prev is not None) and (Day[0] - Day_Prev == np.timedelta64(1, 'D')) and (Num_Label > 0):
+
+				Pair = Get_Link_Pair(Label_Prev, np.concatenate([[0], Label_Global])[Label[0]], Structure)
+				if (len(Pair) > 0): Merge_Label(Parent, Pair)
+
+			Root = Get_Root(Parent)
+			Label_Root = np.concatenate([[0], Root[Label_Global]])
+
+			# ==================================================
+			# Statistics of each (label, time step)
+			Index = np.flatnonzero(Label)
+			Label_Voxel = Label_Root[Label.ravel()[Index]]
+			Index_Time, Index_Grid = Index // Num_Grid, Index % Num_Grid
+
+			Area_Voxel   = Cell_Area[Index_Grid]
+			Excess_Voxel = Excess.reshape(-1)[Index]
+
+			Key, Inverse = np.unique(Label_Voxel * len(Day) + Index_Time, return_inverse=True)
+
+			Peak = np.full(len(Key), -np.inf)
+			np.maximum.at(Peak, Inverse, Excess_Voxel)
+
+			Track_Chunk = {\
+				'Label'        : Key // len(Day), \
+				'Time'         : Day[Key % len(Day)], \
+				'Area'         : np.bincount(Inverse, weights=Area_Voxel, minlength=len(Key)), \
+				'Lat_Sum'      : np.bincount(Inverse, weights=Area_Voxel * Lat_Grid[Index_Grid], minlength=len(Key)), \
+				'Lon_Sum'      : np.bincount(Inverse, weights=Area_Voxel * Lon_Grid[Index_Grid], minlength=len(Key)), \
+				'Heat'         : np.bincount(Inverse, weights=Area_Voxel * Excess_Voxel, minlength=len(Key)), \
+				'Intensity_Max': Peak, \
+			}
+
+			# Tracks and footprints (unique (label, grid point)) of open objects, resolved to the current roots
+			Track = {i: np.concatenate([Track[i], Track_Chunk[i]]) for i in Track}
+			Track['Label'] = Root[Track['Label']]
+
+			Footprint = np.unique(np.concatenate([\
+				Root[Footprint // Num_Grid] * Num_Grid + Footprint % Num_Grid, \
+				Label_Voxel * Num_Grid + Index_Grid, \
+			]))
+
+			Label_Prev = Label_Root[Label[-1]]
+			Day_Prev   = Day[-1]
+
+			# ==================================================
+			# Reduce the objects not present at the last time step (complete), and keep the open ones
+			Label_Open = np.unique(Label_Prev[Label_Prev > 0])
+			Open_Track = np.isin(Track['Label'], Label_Open)
+			Open_Foot  = np.isin(Footprint // Num_Grid, Label_Open)
+
+			if (not np.all(Open_Track)):
+
+				Object_List.append(Reduce_Object({i: Track[i][~Open_Track] for i in Track}, Footprint[~Open_Foot], Num_Grid, Cell_Area, Mask_Range, Min_Duration, Min_Area))
+
+			Track     = {i: Track[i][Open_Track] for i in Track}
+			Footprint = Footprint[Open_Foot]
+
+			# Relabel the open objects 1, 2, ..., so the forest holds only them
+			Parent         = np.arange(len(Label_Open) + 1, dtype=np.int64)
+			Track['Label'] = np.searchsorted(Label_Open, Track['Label']) + 1
+			Footprint      = (np.searchsorted(Label_Open, Footprint // Num_Grid) + 1) * Num_Grid + Footprint % Num_Grid
+			Label_Prev     = np.where(Label_Prev > 0, np.searchsorted(Label_Open, Label_Prev) + 1, 0)
+
+	# ==================================================
+	# Reduce the objects open at the end of the record
+	Object_List.append(Reduce_Object(Track, Footprint, Num_Grid, Cell_Area, Mask_Range, Min_Duration, Min_Area))
+
+	# Concatenate the objects in order of start time, and their tracks in order of object and day
+	Offset = np.cumsum([0] + [len(i[0]['Time_Start']) for i in Object_List])
+
+	Object = {i: np.concatenate([j[0][i] for j in Object_List], axis=0) for i in Object_List[0][0]}
+	Track  = {i: np.concatenate([j[1][i] + (Offset[k] if (i == 'Object') else 0) for k, j in enumerate(Object_List)]) for i in Object_List[0][1]}
+
+	Order = np.argsort(Object['Time_Start'], kind='stable')
+	Object_Index = np.empty(len(Order), dtype=np.int64)
+	Object_Index[Order] = np.arange(len(Order))
+
+	Object = {i: Object[i][Order] for i in Object}
+	Object['Range_List'] = Range_List
+
+	Track['Object'] = Object_Index[Track['Object']]
+	Order = np.argsort(Track['Object'], kind='stable')
+	Track = {i: Track[i][Order] for i in Track}
+
+	return Object, Track
+
+def Iter_Excess(Data, Time, Var, Threshold, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Iterate over time chunks of the exceedance over the calendar-day threshold of lazily opened daily data
+	==================================================
+	Input:
+		Data: lazily indexed xarray DataArray of daily data (time, latitude, longitude) from Preprocessing_Get_Data.Open_Data
+		Time: numpy array of time
+		Var: variable name (for unit conversion)
+		Threshold: numpy array of threshold (366, lat, lon) (see Preprocessing_Threshold)
+		Memory_Budget: memory budget (in bytes) of each time chunk. Default: Preprocessing.Memory_Budget_Default
+	Output:
+		Time_Chunk: numpy array of time of each chunk
+		Excess: numpy array of data minus threshold of each chunk (time, lat, lon) with nan for missing values
+	"""
+
+	for Time_Slice, Data_Chunk in PrepGD.Iter_Chunk(Data, Time, Var, Memory_Budget, 'Daily'):
+
+		yield Time[Time_Slice], Data_Chunk - Threshold[PrepCal.Get_Calendar_Day(Time[Time_Slice])]
+
+def Get_Object(Var='t2m', Range='EastAsia_Analysis_Extended', Time_Range=None, Baseline=None, Percentile=90, Window=15, \
+			   Method='Exact', Threshold=None, Range_List=None, Connectivity=1, Min_Duration=3, Min_Area=0, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Track heatwave objects of the daily data of a variable (see Preprocessing_Get_Data.Get_File_List) in bounded memory
+	==================================================
+	Input:
+		Var: variable name. Default: 't2m'
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: 'EastAsia_Analysis_Extended'
+		Time_Range: [start, end] of time (inclusive), e.g. ['1992-01-01', '2022-12-31']. Default: None (whole record)
+		Baseline, Percentile, Window, Method: threshold (see Preprocessing_Threshold.Get_Threshold)
+		Threshold: numpy array of threshold (366, lat, lon). Default: None (from Preprocessing_Threshold.Get_Threshold)
+		Range_List, Connectivity, Min_Duration, Min_Area: see Calc_Object
+		Memory_Budget: memory budget (in bytes) of each time chunk (and each latitude band of the threshold).
+					   Default: Preprocessing.Memory_Budget_Default
+	Output:
+		Object: dictionary of object statistics from Calc_Object
+		Track: dictionary of the daily track of objects from Calc_Object
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	"""
+
+	if (Threshold is None): Threshold = PrepThr.Get_Threshold(Var, Range, Baseline, Percentile, Window, Method, Memory_Budget)[0]
+
+	Data, Time, Lat, Lon = PrepGD.Open_Data(Var, Range=Range, Time_Range=Time_Range, Frequency='Daily')
+
+	Object, Track = Calc_Object(Iter_Excess(Data, Time, Var, Threshold, Memory_Budget), Lat, Lon, Range_List, Connectivity, Min_Duration, Min_Area)
+
+	return Object, Track, Lat, Lon
+
+if (__name__ == '__main__'):
+
+	# Track heatwave objects
+	Object, Track, Lat, Lon = Get_Object('t2m', 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])
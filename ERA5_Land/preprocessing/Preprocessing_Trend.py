@@ -0,0 +1,332 @@
+import numpy as np
+import scipy.stats
+import concurrent.futures
+import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+
+# ==================================================
+# Linear trends at each grid point of (time, lat, lon) arrays, e.g. from Get_Data, Crop_Range or anomalies (see Preprocessing_Climatology)
+# OLS: the normal equations of all grid points are solved at once from sums over time (matrix products), with a Student-t test
+# Sen: Sen's slope (median of pairwise slopes) and the Mann-Kendall test with tie correction, from the pairwise differences of
+# blocks of grid points. The blocks are bounded by a memory budget and spread across a thread pool (the reductions release the GIL)
+# Slopes are per year. Missing values (nan or masked) are skipped at each grid point
+
+def Get_Time_Axis(Time):
+
+	"""
+	Get the time axis of trends, in years since the first time step
+	==================================================
+	Input:
+		Time: numpy array of time (in ascending order)
+	Output:
+		Year: numpy array of years since the first time step
+	"""
+
+	Day = np.asarray(Time).astype('datetime64[D]')
+
+	return (Day - Day[0]).astype(np.float64) / 365.25
+
+def Calc_Trend_OLS(Data, Time, Confidence=0.95):
+
+	"""
+	Calculate the ordinary least-squares linear trend at each grid point
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Time: numpy array of time
+		Confidence: confidence level. Default: 0.95
+	Output:
+		Trend: dictionary of
+			Slope: slope (per year)
+			Intercept: value of the trend line at the first time step
+			Std_Error: standard error of the slope
+			P_Value: two-sided p-value of the Student-t test of zero slope
+			CI: [lower, upper] bounds of the slope (2, ...)
+			All are nan at grid points with less than 3 valid values
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan).reshape(Data.shape[0], -1)
+
+	# Centered time and data, so the sums are well conditioned
+	Year = Get_Time_Axis(Time)
+	Year_Mean = np.mean(Year)
+	Year = Year - Year_Mean
+
+	Valid = ~np.isnan(Data)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Data_Mean = np.sum(np.where(Valid, Data, 0), axis=0) / np.sum(Valid, axis=0)
+
+	Data = np.where(Valid, Data - Data_Mean, 0)
+
+	# ==================================================
+	# Sums over the valid time steps of all grid points (matrix products)
+	Num = np.sum(Valid, axis=0).astype(np.float64)
+	Sum_X  = Year @ Valid
+	Sum_XX = (Year ** 2) @ Valid
+	Sum_Y  = np.sum(Data, axis=0)
+	Sum_XY = Year @ Data
+	Sum_YY = np.sum(Data ** 2, axis=0)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Cov_XX = Sum_XX - Sum_X ** 2 / Num
+		Cov_XY = Sum_XY - Sum_X * Sum_Y / Num
+		Cov_YY = Sum_YY - Sum_Y ** 2 / Num
+
+		# Solution of the normal equations and the residual variance
+		Slope = Cov_XY / Cov_XX
+		Intercept = (Sum_Y - Slope * Sum_X) / Num + Data_Mean - Slope * Year_Mean
+
+		Degree = np.where(Num > 2, Num - 2, np.nan)
+		Std_Error = np.sqrt(np.maximum(Cov_YY - Slope * Cov_XY, 0) / Degree / Cov_XX)
+
+		t_Value = Slope / Std_Error
+		P_Value = 2 * scipy.stats.t.sf(np.abs(t_Value), Degree)
+		P_Value = np.where(Std_Error == 0, np.where(Slope == 0, 1, 0), P_Value)
+
+		t_Critical = scipy.stats.t.ppf(0.5 + Confidence / 2, Degree)
+
+	Trend = {\
+		'Slope'    : Slope, \
+		'Intercept': Intercept, \
+		'Std_Error': Std_Error, \
+		'P_Value'  : P_Value, \
+		'CI'       : np.stack([Slope - t_Critical * Std_Error, Slope + t_Critical * Std_Error]), \
+	}
+
+	for i_Key in Trend:
+
+		Trend[i_Key] = np.where(np.isnan(Degree), np.nan, Trend[i_Key])
+		Trend[i_Key] = Trend[i_Key].reshape(*Trend[i_Key].shape[:-1], *Shape)
+
+	return Trend
+
+def Calc_Tie_Sum(Data):
+
+	"""
+	Calculate the tie correction of the Mann-Kendall variance, sum of t * (t - 1) * (2 * t + 5) over groups of t equal values
+	==================================================
+	Input:
+		Data: numpy array (grid point, time) with nan for missing values
+	Output:
+		Tie_Sum: numpy array (grid point)
+	"""
+
+	# Runs of equal neighbours of the sorted values (nan never equals), paired up in (grid point, time) order
+	Data  = np.sort(Data, axis=1)
+	Equal = np.zeros((Data.shape[0], Data.shape[1] + 1), dtype=np.int8)
+	Equal[:, 1:-1] = Data[:, 1:] == Data[:, :-1]
+
+	Edge = np.diff(Equal, axis=1)
+	Index_Grid, Index_Start = np.nonzero(Edge == 1)
+	Index_End = np.nonzero(Edge == -1)[1]
+
+	Tie = (Index_End - Index_Start + 1).astype(np.float64)
+
+	return np.bincount(Index_Grid, weights=Tie * (Tie - 1) * (2 * Tie + 5), minlength=Data.shape[0])
+
+def Calc_Sen_Block(Data, Year, Confidence=0.95):
+
+	"""
+	Calculate Sen's slope and the Mann-Kendall test of a block of grid points from all pairwise differences
+	==================================================
+	Input:
+		Data: numpy array (grid point, time) with nan for missing values
+		Year: numpy array of time axis (in ascending order) from Get_Time_Axis
+		Confidence: confidence level. Default: 0.95
+	Output:
+		Trend: dictionary of Slope, Intercept, P_Value, CI (2, grid point), S and Z (see Calc_Trend_Sen)
+	"""
+
+	Num_Grid, Num_Time = Data.shape
+
+	# ==================================================
+	# Pairwise slopes, one lag at a time into contiguous segments of the workspace, and the Mann-Kendall S from their signs
+	Slope_Pair = np.empty((Num_Grid, Num_Time * (Num_Time - 1) // 2))
+	S = np.zeros(Num_Grid)
+
+	ind_Pair = 0
+
+	for i_Lag in range(1, Num_Time):
+
+		Diff = Slope_Pair[:, ind_Pair:ind_Pair + Num_Time - i_Lag]
+		np.subtract(Data[:, i_Lag:], Data[:, :-i_Lag], out=Diff)
+
+		S += np.count_nonzero(Diff > 0, axis=1) - np.count_nonzero(Diff < 0, axis=1)
+		Diff /= Year[i_Lag:] - Year[:-i_Lag]
+
+		ind_Pair += Num_Time - i_Lag
+
+	# Mann-Kendall variance with tie correction, and the continuity-corrected test
+	Num = np.sum(~np.isnan(Data), axis=1).astype(np.float64)
+	Var_S = (Num * (Num - 1) * (2 * Num + 5) - Calc_Tie_Sum(Data)) / 18
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Z = np.where(Var_S > 0, (S - np.sign(S)) / np.sqrt(Var_S), 0)
+
+	P_Value = 2 * scipy.stats.norm.sf(np.abs(Z))
+
+	# ==================================================
+	# Ranks of the median and the confidence bounds among the valid pairs (the same as scipy.stats.theilslopes)
+	# nan pairs are placed last, so one partition at all ranks of the block gives the order statistics of every grid point
+	Num_Pair = (Num * (Num - 1) / 2).astype(np.int64)
+	Index_Valid = Num_Pair > 0
+
+	Width = scipy.stats.norm.ppf(0.5 + Confidence / 2) * np.sqrt(np.maximum(Var_S, 0))
+	Rank = np.stack([\
+		(Num_Pair - 1) // 2, \
+		Num_Pair // 2, \
+		np.round((Num_Pair - Width) / 2).astype(np.int64) - 1, \
+		np.round((Num_Pair + Width) / 2).astype(np.int64), \
+	], axis=1)
+	Rank = np.clip(Rank, 0, np.maximum(Num_Pair - 1, 0)[:, None])
+
+	if (np.any(Index_Valid)): Slope_Pair.partition(np.unique(Rank[Index_Valid, :]), axis=1)
+	Order = np.take_along_axis(Slope_Pair, Rank, axis=1)
+
+	Slope = np.mean(Order[:, :2], axis=1)
+
+	Intercept = np.full(Num_Grid, np.nan)
+	Intercept[Index_Valid] = np.nanmedian(Data[Index_Valid, :] - Slope[Index_Valid, None] * Year[None, :], axis=1)
+
+	Trend = {\
+		'Slope'    : Slope, \
+		'Intercept': Intercept, \
+		'P_Value'  : P_Value, \
+		'CI'       : Order[:, 2:].T, \
+		'S'        : S, \
+		'Z'        : Z, \
+	}
+
+	for i_Key in Trend:
+
+		Trend[i_Key] = np.where(Num > 2, Trend[i_Key], np.nan)
+
+	return Trend
+
+def Calc_Trend_Sen(Data, Time, Confidence=0.95, Max_Workers=None, Memory_Budget=256 * 1024 ** 2):
+
+	"""
+	Calculate Sen's slope and the Mann-Kendall trend test with tie correction at each grid point
+	The pairwise slopes of the grid points are reduced in blocks spread across a thread pool
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Time: numpy array of time (in ascending order)
+		Confidence: confidence level. Default: 0.95
+		Max_Workers: maximum number of threads. Default: None (number of CPUs)
+		Memory_Budget: memory budget (in bytes) of the blocks of all threads together. Default: 256 MiB
+	Output:
+		Trend: dictionary of
+			Slope: Sen's slope (per year)
+			Intercept: median of the data minus the slope times time, the value at the first time step
+			P_Value: two-sided p-value of the Mann-Kendall test
+			CI: [lower, upper] bounds of the slope (2, ...) from the Mann-Kendall variance
+			S: Mann-Kendall statistic
+			Z: standardized Mann-Kendall statistic
+			All are nan at grid points with less than 3 valid values
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan).reshape(Data.shape[0], -1)
+	Year  = Get_Time_Axis(Time)
+
+	Num_Grid = Data.shape[1]
+	Trend = {i: np.full(Num_Grid, np.nan) for i in ['Slope', 'Intercept', 'P_Value', 'S', 'Z']}
+	Trend['CI'] = np.full((2, Num_Grid), np.nan)
+
+	# Number of grid points per block (the pairwise slopes, the sign masks of one lag and the data)
+	# The blocks of all threads are in memory at once, so they share the budget
+	if (Max_Workers is None): Max_Workers = os.cpu_count()
+	Block_Size = max(1, int(Memory_Budget // Max_Workers // (Data.shape[0] * (Data.shape[0] - 1) // 2 * 8 + Data.shape[0] * 2 + Data.shape[0] * 8 * 3)))
+
+	# ==================================================
+	def Calc_Block(ind_Block):
+
+		Block_Slice = slice(ind_Block, min(ind_Block + Block_Size, Num_Grid))
+		Trend_Block = Calc_Sen_Block(np.ascontiguousarray(Data[:, Block_Slice].T), Year, Confidence)
+
+		for i_Key in Trend_Block: Trend[i_Key][..., Block_Slice] = Trend_Block[i_Key]
+
+		return
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=Max_Workers) as Executor:
+
+		# Consume the results to raise errors from the threads
+		list(Executor.map(Calc_Block, range(0, Num_Grid, Block_Size)))
+
+	for i_Key in Trend:
+
+		Trend[i_Key] = Trend[i_Key].reshape(*Trend[i_Key].shape[:-1], *Shape)
+
+	return Trend
+
+def Calc_Trend(Data, Time, Method='OLS', Confidence=0.95, Max_Workers=None, Memory_Budget=256 * 1024 ** 2):
+
+	"""
+	Calculate the linear trend at each grid point
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Time: numpy array of time (in ascending order)
+		Method: 'OLS' (see Calc_Trend_OLS) or 'Sen' (see Calc_Trend_Sen). Default: 'OLS'
+		Confidence: confidence level. Default: 0.95
+		Max_Workers, Memory_Budget: see Calc_Trend_Sen
+	Output:
+		Trend: dictionary of Slope, Intercept, P_Value and CI (2, ...), and the statistics of the method
+	"""
+
+	if (Method == 'OLS'):
+
+		return Calc_Trend_OLS(Data, Time, Confidence)
+
+	elif (Method == 'Sen'):
+
+		return Calc_Trend_Sen(Data, Time, Confidence, Max_Workers, Memory_Budget)
+
+	else:
+
+		raise ValueError('Error in Calc_Trend: wrong method.')
+
+def Calc_Trend_Regional(Data, Time, Lat, Lon, Range_List, Method='OLS', Confidence=0.95):
+
+	"""
+	Calculate the linear trend of the spatial average series of regions
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data (time, lat, lon)
+		Time: numpy array of time (in ascending order)
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+		Range_List: list of [lat_min, lat_max, lon_min, lon_max] or strings of region names
+		Method: 'OLS' or 'Sen' (see Calc_Trend). Default: 'OLS'
+		Confidence: confidence level. Default: 0.95
+	Output:
+		Series: numpy array of spatial average (time, region)
+		Trend: dictionary of the trend statistics (region) from Calc_Trend
+	"""
+
+	Data = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan)
+
+	Series = np.stack([np.ma.filled(Prep.Calc_SpatialAverage(Data, Lat, Lon, i), np.nan) for i in Range_List], axis=1)
+
+	return Series, Calc_Trend(Series, Time, Method, Confidence)
+
+if (__name__ == '__main__'):
+
+	import preprocessing.Preprocessing_Climatology as PrepClim
+
+	# Trend maps of monthly anomalies
+	for i_Var in ['t2m', 'swvl1', 'swvl2', 'swvl3', 'swvl4']:
+
+		Anomaly, _, Time, Lat, Lon = PrepClim.Get_Anomaly(i_Var, ['1992-01', '2022-12'], 'EastAsia_Analysis_Extended', Baseline=[1992, 2021])
+
+		Trend_OLS = Calc_Trend(Anomaly, Time, 'OLS')
+		Trend_Sen = Calc_Trend(Anomaly, Time, 'Sen')
+		Series, Trend_Regional = Calc_Trend_Regional(Anomaly, Time, Lat, Lon, ['EastAsia_Analysis_Extended'], 'Sen')
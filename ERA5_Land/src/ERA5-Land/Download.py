@@ -1,7 +1,8 @@
-import cdsapi
 import os
-
-c = cdsapi.Client()
+import sys
+sys.path.append('../../')
+import preprocessing.Preprocessing as Prep
+import Download_Manager as DM
 
 Var_FullName_List = [\
 	'total_precipitation', \
@@ -26,39 +27,130 @@ Var_List = [\
 	'e', \
 ]
 
-for i_Var_FullName, i_Var in zip(Var_FullName_List, Var_List):
-
-	# Print message
-	print('Download {Var}'.format(Var=i_Var))
-
-	# Skip if file exists
-	if (os.path.exists('ERA5-Land.{Var}.nc'.format(Var=i_Var))): continue
-
-	c.retrieve(
-		'reanalysis-era5-land-monthly-means',
-		{
-			'product_type': 'monthly_averaged_reanalysis',
-			'variable': [i_Var_FullName],
-			'year': [
-				'1992', '1993', '1994',
-				'1995', '1996', '1997',
-				'1998', '1999', '2000',
-				'2001', '2002', '2003',
-				'2004', '2005', '2006',
-				'2007', '2008', '2009',
-				'2010', '2011', '2012',
-				'2013', '2014', '2015',
-				'2016', '2017', '2018',
-				'2019', '2020', '2021',
-				'2022'
-			],
-			'month': [
-				'01', '02', '03',
-				'04', '05', '06',
-				'07', '08', '09',
-				'10', '11', '12',
-			],
-			'time': '00:00',
-			'format': 'netcdf',
-		},
-		'ERA5-Land.{Var}.nc'.format(Var=i_Var))
\ No newline at end of file
+# ==================================================
+# Downloaded area: range name in Prep.Range_Dict (None or 'Global_Analysis' for the globe), and margin (in degrees) around it
+# Year_Block: number of years per shard file. None to download one archive file per variable
+Download_Range  = 'EastAsia_Analysis_Extended'
+Download_Margin = 1.0
+Year_Block      = None
+
+def Get_Area(Range, Margin=Download_Margin):
+
+	"""
+	Get the CDS area of a range with a margin
+	==================================================
+	Input:
+		Range: range name in Prep.Range_Dict or [lat_min, lat_max, lon_min, lon_max]. None for the globe
+		Margin: margin (in degrees) added on each side of the range. Default: Download_Margin
+	Output:
+		Area: [north, west, south, east] (longitudes in -180 to 180), or None for the globe
+	"""
+
+	if (Range is None): return None
+
+	Lat_Min, Lat_Max, Lon_Min, Lon_Max = Prep.Get_Range(Range) if (isinstance(Range, str)) else Range
+
+	# Download the globe if the range with margin covers all longitudes
+	if (Lon_Max - Lon_Min + 2 * Margin >= 360) and (Lat_Min - Margin <= -90) and (Lat_Max + Margin >= 90): return None
+
+	North = min(Lat_Max + Margin, 90)
+	South = max(Lat_Min - Margin, -90)
+
+	if (Lon_Max - Lon_Min + 2 * Margin >= 360):
+
+		West, East = -180, 180
+
+	else:
+
+		# Wrap longitudes into -180 to 180 (west > east for areas crossing the date line)
+		West = (Lon_Min - Margin + 180) % 360 - 180
+		East = (Lon_Max + Margin + 180) % 360 - 180
+
+	return [North, West, South, East]
+
+def Get_Request(Var_FullName, Year_List, Month_List=None, Area=None):
+
+	"""
+	Get the CDS request of monthly means of a variable
+	==================================================
+	Input:
+		Var_FullName: CDS variable name
+		Year_List: list of year strings
+		Month_List: list of month strings. Default: all months
+		Area: [north, west, south, east] from Get_Area. Default: None (the globe)
+	Output:
+		Request: dictionary of CDS request
+	"""
+
+	if (Month_List is None): Month_List = ['{:02d}'.format(i) for i in range(1, 13)]
+
+	Request = {
+		'product_type': 'monthly_averaged_reanalysis',
+		'variable': [Var_FullName],
+		'year': Year_List,
+		'month': Month_List,
+		'time': '00:00',
+		'format': 'netcdf',
+	}
+
+	if (Area is not None): Request['area'] = Area
+
+	return Request
+
+def Get_Request_List(Range=Download_Range, Margin=Download_Margin, Year_Block=Year_Block, Year_Start=1992, Year_End=2022):
+
+	"""
+	Get the list of download requests of all variables
+	==================================================
+	Input:
+		Range: range name in Prep.Range_Dict or [lat_min, lat_max, lon_min, lon_max]. None for the globe. Default: Download_Range
+		Margin: margin (in degrees) added on each side of the range. Default: Download_Margin
+		Year_Block: number of years per shard file, written to ERA5-Land.{Var}.Shard/ and read together by Preprocessing_Get_Data.
+					None for one archive file ERA5-Land.{Var}.nc per variable. Default: Year_Block
+		Year_Start, Year_End: first and last year. Default: 1992, 2022
+	Output:
+		Request_List: list of dictionaries of Dataset, Request and Target (see Download_Manager.Download_Requests)
+	"""
+
+	Area = Get_Area(Range, Margin)
+
+	Request_List = []
+
+	for i_Var_FullName, i_Var in zip(Var_FullName_List, Var_List):
+
+		if (Year_Block is None):
+
+			Request_List.append({\
+				'Dataset': 'reanalysis-era5-land-monthly-means', \
+				'Request': Get_Request(i_Var_FullName, [str(i) for i in range(Year_Start, Year_End + 1)], Area=Area), \
+				'Target' : 'ERA5-Land.{Var}.nc'.format(Var=i_Var), \
+			})
+
+			continue
+
+		# One shard per block of years
+		Shard_Path = 'ERA5-Land.{Var}.Shard/'.format(Var=i_Var)
+		if not os.path.exists(Shard_Path): os.makedirs(Shard_Path)
+
+		for i_Year in range(Year_Start, Year_End + 1, Year_Block):
+
+			Year_List = [str(i) for i in range(i_Year, min(i_Year + Year_Block - 1, Year_End) + 1)]
+
+			Request_List.append({\
+				'Dataset': 'reanalysis-era5-land-monthly-means', \
+				'Request': Get_Request(i_Var_FullName, Year_List, Area=Area), \
+				'Target' : Shard_Path + 'ERA5-Land.{Var}.{Year_Start}-{Year_End}.nc'.format(Var=i_Var, Year_Start=Year_List[0], Year_End=Year_List[-1]), \
+			})
+
+	return Request_List
+
+if (__name__ == '__main__'):
+
+	# Download all variables (and shards) concurrently (completed files in the manifest are skipped)
+	Request_List = Get_Request_List()
+	Result       = DM.Download_Requests(Request_List, Max_Workers=min(len(Request_List), 8))
+
+	# Print failed downloads
+	for i_Target, i_Result in Result.items():
+
+		if (isinstance(i_Result, Exception)): print('Failed {Target}: {Error}'.format(Target=i_Target, Error=i_Result))
@@ -0,0 +1,95 @@
+"""
+Download_Hourly.py
+===============================
+Download hourly ERA5-Land of the variables reduced to daily data (see preprocessing/Preprocessing_Daily.py)
+Each variable and month is one shard file in ERA5-Land.{Var}.Hourly.Shard/, read together by Preprocessing_Get_Data
+The area is the same as Download.py (Download.Download_Range and Download.Download_Margin)
+"""
+
+import os
+import Download as DL
+import Download_Manager as DM
+
+Var_FullName_List = [\
+	'2m_temperature', \
+	'skin_temperature', \
+	'total_precipitation', \
+	'total_evaporation', \
+]
+Var_List = [\
+	't2m', \
+	'skt', \
+	'tp', \
+	'e', \
+]
+
+def Get_Request(Var_FullName, Year, Month, Area=None):
+
+	"""
+	Get the CDS request of all hours of a month of a variable
+	==================================================
+	Input:
+		Var_FullName: CDS variable name
+		Year: year string
+		Month: month string
+		Area: [north, west, south, east] from Download.Get_Area. Default: None (the globe)
+	Output:
+		Request: dictionary of CDS request
+	"""
+
+	Request = {
+		'variable': [Var_FullName],
+		'year': Year,
+		'month': Month,
+		'day': ['{:02d}'.format(i) for i in range(1, 32)],
+		'time': ['{:02d}:00'.format(i) for i in range(24)],
+		'format': 'netcdf',
+	}
+
+	if (Area is not None): Request['area'] = Area
+
+	return Request
+
+def Get_Request_List(Range=DL.Download_Range, Margin=DL.Download_Margin, Year_Start=1992, Year_End=2022):
+
+	"""
+	Get the list of download requests of all variables, one request per variable and month
+	==================================================
+	Input:
+		Range: range name in Prep.Range_Dict or [lat_min, lat_max, lon_min, lon_max]. None for the globe. Default: DL.Download_Range
+		Margin: margin (in degrees) added on each side of the range. Default: DL.Download_Margin
+		Year_Start, Year_End: first and last year. Default: 1992, 2022
+	Output:
+		Request_List: list of dictionaries of Dataset, Request and Target (see Download_Manager.Download_Requests)
+	"""
+
+	Area = DL.Get_Area(Range, Margin)
+
+	Request_List = []
+
+	for i_Var_FullName, i_Var in zip(Var_FullName_List, Var_List):
+
+		Shard_Path = 'ERA5-Land.{Var}.Hourly.Shard/'.format(Var=i_Var)
+		if not os.path.exists(Shard_Path): os.makedirs(Shard_Path)
+
+		for i_Year in range(Year_Start, Year_End + 1):
+
+			for i_Month in range(1, 13):
+
+				Request_List.append({\
+					'Dataset': 'reanalysis-era5-land', \
+					'Request': Get_Request(i_Var_FullName, str(i_Year), '{:02d}'.format(i_Month), Area), \
+					'Target' : Shard_Path + 'ERA5-Land.{Var}.Hourly.{Year}-{Month:02d}.nc'.format(Var=i_Var, Year=i_Year, Month=i_Month), \
+				})
+
+	return Request_List
+
+if (__name__ == '__main__'):
+
+	# Download all months of all variables concurrently (completed files in the manifest are skipped)
+	Result = DM.Download_Requests(Get_Request_List(), Max_Workers=8, Manifest_File='Download_Manifest.Hourly.json')
+
+	# Print failed downloads
+	for i_Target, i_Result in Result.items():
+
+		if (isinstance(i_Result, Exception)): print('Failed {Target}: {Error}'.format(Target=i_Target, Error=i_Result))
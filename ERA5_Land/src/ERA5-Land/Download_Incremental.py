@@ -0,0 +1,128 @@
+"""
+Download_Incremental.py
+===============================
+Download only the months missing after the last time step of each local ERA5-Land file
+The new months are appended along time as shard files in ERA5-Land.{Var}.Shard/ (one per year),
+so the existing archive is never rewritten. Preprocessing_Get_Data reads the archive and its shards together
+The area is taken from the grid of the existing archive (not the Download.py defaults), so the shards match its grid
+"""
+
+import numpy as np
+import xarray as xr
+import os
+import Download as DL
+import Download_Manager as DM
+
+def Get_File_List(Var):
+
+	"""
+	Get the archive file and its appended shard files of a variable
+	==================================================
+	Input:
+		Var: variable name
+	Output:
+		File_List: list of file paths in time order
+	"""
+
+	File_List  = ['ERA5-Land.{Var}.nc'.format(Var=Var)] if (os.path.exists('ERA5-Land.{Var}.nc'.format(Var=Var))) else []
+	Shard_Path = 'ERA5-Land.{Var}.Shard/'.format(Var=Var)
+
+	if (os.path.exists(Shard_Path)):
+
+		File_List += [Shard_Path + i for i in sorted(os.listdir(Shard_Path)) if (i.endswith('.nc'))]
+
+	return File_List
+
+def Get_Last_Month(Var):
+
+	"""
+	Get the last month present in the archive and its shards
+	==================================================
+	Input:
+		Var: variable name
+	Output:
+		Last_Month: numpy datetime64[M] of the last month, or None if there is no local file
+	"""
+
+	Last_Month = None
+
+	for i_File in Get_File_List(Var):
+
+		with xr.open_dataset(i_File) as ncFile:
+
+			i_Last_Month = ncFile['time'].values.max().astype('datetime64[M]')
+
+		if (Last_Month is None) or (i_Last_Month > Last_Month): Last_Month = i_Last_Month
+
+	return Last_Month
+
+def Get_Archive_Area(Var):
+
+	"""
+	Get the CDS area of the grid of the local archive of a variable
+	==================================================
+	Input:
+		Var: variable name
+	Output:
+		Area: [north, west, south, east] (longitudes in -180 to 180) of the first and last grid points, or None for the globe
+	"""
+
+	with xr.open_dataset(Get_File_List(Var)[0]) as ncFile:
+
+		Lat = ncFile['latitude'].values
+		Lon = ncFile['longitude'].values
+
+	return DM.Get_Grid_Area(Lat, Lon)
+
+def Get_Request_List(End_Month=None):
+
+	"""
+	Get the list of download requests of the missing months of all variables, one request per variable and year
+	The area of each variable is that of its archive (see Get_Archive_Area)
+	==================================================
+	Input:
+		End_Month: last month to download, e.g. '2023-06'. Default: the previous month
+	Output:
+		Request_List: list of dictionaries of Dataset, Request and Target (see Download_Manager.Download_Requests)
+	"""
+
+	End_Month = (np.datetime64('today', 'M') - 1) if (End_Month is None) else np.datetime64(End_Month, 'M')
+
+	Request_List = []
+
+	for i_Var_FullName, i_Var in zip(DL.Var_FullName_List, DL.Var_List):
+
+		# Skip variables without an archive (use Download.py for the full download)
+		Last_Month = Get_Last_Month(i_Var)
+		if (Last_Month is None): continue
+
+		Area = Get_Archive_Area(i_Var)
+
+		# Get the missing months and group them by year
+		Month_Missing = np.arange(Last_Month + 1, End_Month + 1, dtype='datetime64[M]')
+		Year_Missing  = Month_Missing.astype('datetime64[Y]').astype(int) + 1970
+
+		for i_Year in np.unique(Year_Missing):
+
+			Month_List = ['{:02d}'.format(i.astype(int) % 12 + 1) for i in Month_Missing[Year_Missing == i_Year]]
+			Shard_Path = 'ERA5-Land.{Var}.Shard/'.format(Var=i_Var)
+			if not os.path.exists(Shard_Path): os.makedirs(Shard_Path)
+
+			Request_List.append({\
+				'Dataset': 'reanalysis-era5-land-monthly-means', \
+				'Request': DL.Get_Request(i_Var_FullName, [str(i_Year)], Month_List, Area), \
+				'Target' : Shard_Path + 'ERA5-Land.{Var}.{Year}.{Month_Start}-{Month_End}.nc'.format(\
+					Var=i_Var, Year=i_Year, Month_Start=Month_List[0], Month_End=Month_List[-1]), \
+			})
+
+	return Request_List
+
+if (__name__ == '__main__'):
+
+	# Download the missing months of all variables concurrently
+	Result = DM.Download_Requests(Get_Request_List(), Max_Workers=len(DL.Var_List))
+
+	# Print failed downloads
+	for i_Target, i_Result in Result.items():
+
+		if (isinstance(i_Result, Exception)): print('Failed {Target}: {Error}'.format(Target=i_Target, Error=i_Result))
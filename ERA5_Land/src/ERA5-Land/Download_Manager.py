@@ -0,0 +1,322 @@
+"""
+Download_Manager.py
+===============================
+Download CDS requests concurrently and resumably:
+1. Requests are retrieved by a bounded thread pool, each with retries and exponential backoff
+2. Each file is written to a temporary file and renamed only when complete
+3. A manifest records the request, size and checksum of each completed file, so interrupted runs resume safely
+   Files already on disk without a manifest record (and without a partial .part file) are adopted into the manifest once,
+   if their time steps and area match the request and they can be read to the end. Other files are downloaded again
+The client is pluggable: any factory returning an object with retrieve(name, request, target), like cdsapi.Client
+"""
+
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
+import random
+import threading
+import time
+import xarray as xr
+
+def Get_Default_Client():
+
+	# Import cdsapi only when the default client is used, so a fake client can be used without it
+	import cdsapi
+
+	return cdsapi.Client()
+
+def Get_Request_Hash(Dataset, Request):
+
+	"""
+	Get the hash identifying a request
+	==================================================
+	Input:
+		Dataset: CDS dataset name
+		Request: dictionary of CDS request
+	Output:
+		Request_Hash: hex string of the request hash
+	"""
+
+	return hashlib.sha256(json.dumps([Dataset, Request], sort_keys=True).encode()).hexdigest()
+
+def Get_Checksum(File):
+
+	"""
+	Get the SHA-256 checksum of a file
+	==================================================
+	Input:
+		File: file path
+	Output:
+		Checksum: hex string of the checksum
+	"""
+
+	Hash = hashlib.sha256()
+
+	with open(File, 'rb') as f:
+
+		for i_Block in iter(lambda: f.read(1024 * 1024), b''):
+
+			Hash.update(i_Block)
+
+	return Hash.hexdigest()
+
+def Read_Manifest(Manifest_File):
+
+	"""
+	Read the manifest of completed downloads
+	==================================================
+	Input:
+		Manifest_File: manifest file path
+	Output:
+		Manifest: dictionary of target file -> {Request_Hash, Size, Checksum}
+	"""
+
+	if (not os.path.exists(Manifest_File)): return {}
+
+	with open(Manifest_File, 'r') as f:
+
+		return json.load(f)
+
+def Write_Manifest(Manifest, Manifest_File):
+
+	"""
+	Write the manifest atomically
+	==================================================
+	Input:
+		Manifest: dictionary of target file -> {Request_Hash, Size, Checksum}
+		Manifest_File: manifest file path
+	"""
+
+	with open(Manifest_File + '.tmp', 'w') as f:
+
+		json.dump(Manifest, f, indent=1, sort_keys=True)
+
+	os.replace(Manifest_File + '.tmp', Manifest_File)
+
+	return
+
+def Get_Grid_Area(Lat, Lon):
+
+	"""
+	Get the CDS area of a grid
+	==================================================
+	Input:
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	Output:
+		Area: [north, west, south, east] (longitudes in -180 to 180) of the first and last grid points, or None for the globe
+	"""
+
+	# The globe if the longitudes cover all 360 degrees
+	Resolution = np.abs(Lon[1] - Lon[0]) if (len(Lon) > 1) else 0
+	if (len(Lon) * Resolution >= 360 - 1e-6) and (np.min(Lat) - Resolution / 2 <= -90) and (np.max(Lat) + Resolution / 2 >= 90): return None
+
+	# The first and last longitudes keep the west and east edges of areas crossing the date line
+	return [\
+		round(float(np.max(Lat)), 6), \
+		round(float((Lon[0] + 180) % 360 - 180), 6), \
+		round(float(np.min(Lat)), 6), \
+		round(float((Lon[-1] + 180) % 360 - 180), 6), \
+	]
+
+def Get_Request_Time(Request):
+
+	"""
+	Get the time steps of a CDS request (the first day at 00:00 for monthly means)
+	==================================================
+	Input:
+		Request: dictionary of CDS request
+	Output:
+		Time: numpy array of time (datetime64[h]) in ascending order
+	"""
+
+	def As_List(Value):
+
+		return [str(Value)] if (isinstance(Value, (str, int))) else [str(i) for i in Value]
+
+	Time = []
+
+	for i_Year, i_Month, i_Day in itertools.product(As_List(Request['year']), As_List(Request['month']), As_List(Request.get('day', '01'))):
+
+		# Skip days not in the month (e.g. day 31 of all-day requests)
+		try:
+
+			Day = np.datetime64('{Year}-{Month:02d}-{Day:02d}'.format(Year=int(i_Year), Month=int(i_Month), Day=int(i_Day)), 'D')
+
+		except ValueError:
+
+			continue
+
+		Time += [Day + np.timedelta64(int(i[:2]), 'h') for i in As_List(Request.get('time', '00:00'))]
+
+	return np.unique(np.array(Time, dtype='datetime64[h]'))
+
+def Check_Request_Match(Target, Request):
+
+	"""
+	Check whether an existing file holds the time steps and area of a request, and can be read to its last time step
+	==================================================
+	Input:
+		Target: target file path
+		Request: dictionary of CDS request
+	Output:
+		Match: bool
+	"""
+
+	try:
+
+		with xr.open_dataset(Target) as ncFile:
+
+			Time = ncFile['time'].values.astype('datetime64[h]')
+			Lat  = ncFile['latitude'].values
+			Lon  = ncFile['longitude'].values
+
+			# Read the last time step, which fails for a truncated file
+			for i_Var in ncFile.data_vars:
+
+				if ('time' in ncFile[i_Var].dims): ncFile[i_Var].isel(time=-1).values
+
+	except Exception:
+
+		return False
+
+	if (not np.array_equal(np.unique(Time), Get_Request_Time(Request))): return False
+
+	Area, Area_Request = Get_Grid_Area(Lat, Lon), Request.get('area')
+	if (Area is None) or (Area_Request is None): return (Area is None) and (Area_Request is None)
+
+	# The grid points are within one grid spacing of the requested edges (longitudes compared across the date line)
+	Resolution = np.abs(Lat[1] - Lat[0]) if (len(Lat) > 1) else 0
+	Difference = np.array(Area) - np.array(Area_Request, dtype=np.float64)
+	Difference[1::2] = (Difference[1::2] + 180) % 360 - 180
+
+	return bool(np.all(np.abs(Difference) <= Resolution + 1e-6))
+
+def Check_Complete(Target, Request_Hash, Manifest, Verify_Checksum=False):
+
+	"""
+	Check whether a target file is completely downloaded for the given request
+	==================================================
+	Input:
+		Target: target file path
+		Request_Hash: hash of the request
+		Manifest: dictionary of the manifest
+		Verify_Checksum: whether to verify the checksum (reads the whole file). Default: False
+	Output:
+		Complete: bool
+	"""
+
+	if (Target not in Manifest) or (not os.path.exists(Target)): return False
+
+	Record = Manifest[Target]
+
+	if (Record['Request_Hash'] != Request_Hash) or (Record['Size'] != os.path.getsize(Target)): return False
+
+	if (Verify_Checksum) and (Record['Checksum'] != Get_Checksum(Target)): return False
+
+	return True
+
+def Download_Requests(Request_List, Client_Factory=Get_Default_Client, Max_Workers=4, Max_Retries=5, Backoff=30, \
+					  Manifest_File='Download_Manifest.json', Verify_Checksum=False):
+
+	"""
+	Download requests concurrently, with retries, atomic renaming and a manifest of completed files
+	==================================================
+	Input:
+		Request_List: list of dictionaries of
+			Dataset: CDS dataset name
+			Request: dictionary of CDS request
+			Target: target file path
+		Client_Factory: callable returning a client with retrieve(name, request, target). One client is created per thread.
+						Default: cdsapi.Client
+		Max_Workers: maximum number of concurrent requests. Default: 4
+		Max_Retries: maximum number of retries of each request. Default: 5
+		Backoff: initial backoff (in seconds) before retrying, doubled at each retry. Default: 30
+		Manifest_File: manifest file path. Default: 'Download_Manifest.json'
+		Verify_Checksum: whether to verify checksums of files already in the manifest. Default: False
+	Output:
+		Result: dictionary of target file -> 'Skipped', 'Adopted' (an existing file matching the request recorded in the manifest), 'Downloaded'
+				or the exception of the last failed attempt
+	"""
+
+	Manifest      = Read_Manifest(Manifest_File)
+	Manifest_Lock = threading.Lock()
+	Thread_Local  = threading.local()
+
+	# ==================================================
+	# Adopt files downloaded before the manifest existed if they match the request, one at a time (the netCDF library is
+	# not thread-safe). A .part file means the previous download was interrupted; other files are downloaded again
+	Adopt_List = [i['Target'] for i in Request_List if (i['Target'] not in Manifest) and (os.path.exists(i['Target'])) and \
+				  (not os.path.exists(i['Target'] + '.part')) and (Check_Request_Match(i['Target'], i['Request']))]
+
+	for Request in Request_List:
+
+		if (Request['Target'] not in Adopt_List): continue
+
+		Manifest[Request['Target']] = {\
+			'Request_Hash': Get_Request_Hash(Request['Dataset'], Request['Request']), \
+			'Size'        : os.path.getsize(Request['Target']), \
+			'Checksum'    : Get_Checksum(Request['Target']), \
+		}
+
+	if (len(Adopt_List) > 0): Write_Manifest(Manifest, Manifest_File)
+
+	# ==================================================
+	def Download_Request(Request):
+
+		Request_Hash = Get_Request_Hash(Request['Dataset'], Request['Request'])
+
+		if (Request['Target'] in Adopt_List): return 'Adopted'
+
+		# Skip if the target is complete
+		with Manifest_Lock:
+
+			if (Check_Complete(Request['Target'], Request_Hash, Manifest, Verify_Checksum)): return 'Skipped'
+
+		Temp_File = Request['Target'] + '.part'
+
+		for ind_Retry in range(Max_Retries + 1):
+
+			try:
+
+				# Create one client per thread (a failure is retried and returned like a failed download)
+				if (not hasattr(Thread_Local, 'Client')): Thread_Local.Client = Client_Factory()
+
+				# Print message
+				print('Download {Target} (attempt {Attempt})'.format(Target=Request['Target'], Attempt=ind_Retry + 1))
+
+				Thread_Local.Client.retrieve(Request['Dataset'], Request['Request'], Temp_File)
+
+				Record = {\
+					'Request_Hash': Request_Hash, \
+					'Size'        : os.path.getsize(Temp_File), \
+					'Checksum'    : Get_Checksum(Temp_File), \
+				}
+
+				# Rename the complete file and record it in the manifest
+				os.replace(Temp_File, Request['Target'])
+
+				with Manifest_Lock:
+
+					Manifest[Request['Target']] = Record
+					Write_Manifest(Manifest, Manifest_File)
+
+				return 'Downloaded'
+
+			except Exception as Error:
+
+				if (os.path.exists(Temp_File)): os.remove(Temp_File)
+				if (ind_Retry == Max_Retries): return Error
+
+				# Exponential backoff with jitter
+				time.sleep(Backoff * 2 ** ind_Retry * random.uniform(0.5, 1.5))
+
+	# ==================================================
+	with concurrent.futures.ThreadPoolExecutor(max_workers=Max_Workers) as Executor:
+
+		Result = dict(zip([i['Target'] for i in Request_List], Executor.map(Download_Request, Request_List)))
+
+	return Result
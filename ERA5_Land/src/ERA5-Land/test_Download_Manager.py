@@ -0,0 +1,175 @@
+"""
+test_Download_Manager.py
+===============================
+Tests of Download_Manager with a local fake CDS client (no network and no cdsapi)
+Run by pytest from this directory or the repository root
+"""
+
+import numpy as np
+import xarray as xr
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import Download_Manager as DM
+
+Area_Regional = [44, 86, 12, 137]
+
+# The netCDF library is not thread-safe, so the fake server writes one file at a time
+Write_Lock = threading.Lock()
+
+def Get_Request(Year='2022', Area=None):
+
+	Request = {
+		'product_type': 'monthly_averaged_reanalysis',
+		'variable': ['2m_temperature'],
+		'year': [Year],
+		'month': ['{:02d}'.format(i) for i in range(1, 13)],
+		'time': '00:00',
+		'format': 'netcdf',
+	}
+
+	if (Area is not None): Request['area'] = Area
+
+	return Request
+
+def Write_File(Target, Request):
+
+	# Write a 1-degree file of the time steps and area of the request
+	North, West, South, East = [90, 0, -90, 359] if ('area' not in Request) else Request['area']
+
+	Lat  = np.arange(North, South - 0.5, -1.)
+	Lon  = np.arange(West, East + 0.5, 1.)
+	Time = DM.Get_Request_Time(Request).astype('datetime64[ns]')
+
+	Data = np.zeros((len(Time), len(Lat), len(Lon)), dtype=np.float32)
+
+	with Write_Lock:
+
+		xr.Dataset({'t2m': (('time', 'latitude', 'longitude'), Data)}, coords={'time': Time, 'latitude': Lat, 'longitude': Lon}).to_netcdf(Target)
+
+	return
+
+class Fake_Client:
+
+	"""
+	Fake CDS client writing the requested file, failing the first Num_Failure calls of each target
+	"""
+
+	def __init__(self, Num_Failure=0, Call_List=None):
+
+		self.Num_Failure = Num_Failure
+		self.Call_List   = [] if (Call_List is None) else Call_List
+
+	def retrieve(self, name, request, target):
+
+		self.Call_List.append(target)
+
+		# The target is written as a partial file and only renamed by the manager
+		assert target.endswith('.part')
+
+		if (self.Call_List.count(target) <= self.Num_Failure):
+
+			# Leave a partial file behind, as an interrupted transfer does
+			with open(target, 'wb') as f: f.write(b'partial')
+
+			raise ConnectionError('fake CDS server unavailable')
+
+		Write_File(target, request)
+
+		return
+
+def Download(tmp_path, Request_List, Client):
+
+	return DM.Download_Requests(Request_List, Client_Factory=lambda: Client, Max_Workers=2, Max_Retries=2, Backoff=0, \
+								Manifest_File=str(tmp_path / 'Download_Manifest.json'))
+
+def test_Download_Retry_Rename(tmp_path):
+
+	Client = Fake_Client(Num_Failure=1)
+	Target = str(tmp_path / 'ERA5-Land.t2m.nc')
+
+	Result = Download(tmp_path, [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Get_Request(), 'Target': Target}], Client)
+
+	# Retried once through the partial file, then renamed to the target and recorded
+	assert Result[Target] == 'Downloaded'
+	assert Client.Call_List == [Target + '.part'] * 2
+	assert os.path.exists(Target) and (not os.path.exists(Target + '.part'))
+
+	Manifest = DM.Read_Manifest(str(tmp_path / 'Download_Manifest.json'))
+	assert Manifest[Target]['Size'] == os.path.getsize(Target)
+	assert Manifest[Target]['Checksum'] == DM.Get_Checksum(Target)
+
+def test_Download_Failure(tmp_path):
+
+	Target = str(tmp_path / 'ERA5-Land.t2m.nc')
+
+	Result = Download(tmp_path, [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Get_Request(), 'Target': Target}], Fake_Client(Num_Failure=5))
+
+	# The last error is returned and no partial or target file is left
+	assert isinstance(Result[Target], ConnectionError)
+	assert (not os.path.exists(Target)) and (not os.path.exists(Target + '.part'))
+
+def test_Client_Factory_Failure(tmp_path):
+
+	Target = str(tmp_path / 'ERA5-Land.t2m.nc')
+
+	def Client_Factory():
+
+		raise RuntimeError('no credentials')
+
+	Result = DM.Download_Requests([{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Get_Request(), 'Target': Target}], \
+								  Client_Factory=Client_Factory, Max_Retries=1, Backoff=0, Manifest_File=str(tmp_path / 'Download_Manifest.json'))
+
+	assert isinstance(Result[Target], RuntimeError)
+
+def test_Skip(tmp_path):
+
+	Request_List = [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Get_Request(i), 'Target': str(tmp_path / 'ERA5-Land.t2m.{}.nc'.format(i))} for i in ['2021', '2022']]
+
+	assert set(Download(tmp_path, Request_List, Fake_Client()).values()) == {'Downloaded'}
+
+	# Completed files are skipped without calling the client
+	Client = Fake_Client()
+	assert set(Download(tmp_path, Request_List, Client).values()) == {'Skipped'}
+	assert Client.Call_List == []
+
+def test_Adopt(tmp_path):
+
+	Target  = str(tmp_path / 'ERA5-Land.t2m.nc')
+	Request = Get_Request(Area=Area_Regional)
+	Write_File(Target, Request)
+
+	# A matching file without a manifest record is adopted without calling the client, then skipped
+	Client = Fake_Client()
+	assert Download(tmp_path, [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Request, 'Target': Target}], Client)[Target] == 'Adopted'
+	assert Download(tmp_path, [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Request, 'Target': Target}], Client)[Target] == 'Skipped'
+	assert Client.Call_List == []
+
+def test_Adopt_Mismatch(tmp_path):
+
+	Request = Get_Request(Area=Area_Regional)
+	Target_List = [str(tmp_path / 'ERA5-Land.{}.nc'.format(i)) for i in ['Global', 'Year', 'Truncated', 'Interrupted']]
+
+	# A global legacy file, a file of another year, a half-written file and a file with a partial download
+	Write_File(Target_List[0], Get_Request())
+	Write_File(Target_List[1], Get_Request('2021', Area_Regional))
+	Write_File(Target_List[2], Request)
+	with open(Target_List[2], 'r+b') as f: f.truncate(os.path.getsize(Target_List[2]) // 2)
+	Write_File(Target_List[3], Request)
+	with open(Target_List[3] + '.part', 'wb') as f: f.write(b'partial')
+
+	Client = Fake_Client()
+	Result = Download(tmp_path, [{'Dataset': 'reanalysis-era5-land-monthly-means', 'Request': Request, 'Target': i} for i in Target_List], Client)
+
+	# All are downloaded again, and the new files match the request
+	assert all(Result[i] == 'Downloaded' for i in Target_List)
+	assert all(DM.Check_Request_Match(i, Request) for i in Target_List)
+
+def test_Request_Time():
+
+	# Days not in the month are skipped
+	Time = DM.Get_Request_Time({'year': '2023', 'month': '02', 'day': ['{:02d}'.format(i) for i in range(1, 32)], 'time': ['00:00', '12:00']})
+
+	assert len(Time) == 28 * 2
+	assert Time[-1] == np.datetime64('2023-02-28T12', 'h')
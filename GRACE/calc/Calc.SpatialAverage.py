@@ -21,8 +21,8 @@ if (__name__ == '__main__'):
 	# Calculate spatial average
 	Data = Prep.Calc_SpatialAverage(Data, Lat, Lon, 'SouthChina_Analysis').squeeze()
 	
-	# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-	Time = np.array([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
+	# Convert Time to YYYY-MM-DD format
+	Time = Time.astype('datetime64[D]')
 	
 	# ==================================================
 	# Write spatial average to nc file by xarray
@@ -5,7 +5,6 @@ Plot climatological seasonal cycles and 2022 anomalies of lwe_thickness
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import xarray as xr
 import os
@@ -13,6 +12,9 @@ import sys
 sys.path.append('../')
 import preprocessing.Preprocessing_Get_Data as PrepGD
 import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Climatology as PrepClim
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Statistics as PrepStat
 
 def Plot_Linechart(Plot_Data, Plot_Config):
 
@@ -51,32 +53,22 @@ if (__name__ == '__main__'):
 	# Calculate spatial average
 	Data = Prep.Calc_SpatialAverage(Data, Lat, Lon, 'SouthChina_Analysis')
 	
-	# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-	Time = np.array([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
+	# Get calendar index of time
+	Calendar = PrepCal.Get_Calendar(Time)
 	
 	# ==================================================
-	# Get climatological seasonal cycle
-	# Group the data with the same month and calculate the mean
-	Data_SeasonalCycle = pd.DataFrame({'Data': Data, 'Time': Time}).set_index('Time')
-	Data_SeasonalCycle = Data_SeasonalCycle.groupby(Data_SeasonalCycle.index.month)
-	Data_Mean          = Data_SeasonalCycle.mean()['Data'].values
-	Data_Std           = Data_SeasonalCycle.std()['Data'].values
-	Data_n             = Data_SeasonalCycle.count()['Data'].values
+	# Get climatological seasonal cycle (precomputed and stored)
+	Clim      = PrepClim.Get_Climatology('lwe_thickness', 'SouthChina_Analysis', Spatial_Average=True)
+	Data_Mean = Clim['Mean']
 
-	# Extract 2022 data by selecting the Time with year 2022
-	Data_2022 = Data[np.array([i_Time.year == 2022 for i_Time in Time]), ...]
-
-	# Because 2022-12 is not available, add a nan to the end of Data_2022
-	Data_2022 = np.append(Data_2022, np.nan)
+	# Extract 2022 data into 12 months (nan for months not available, e.g. 2022-12)
+	Data_2022 = PrepCal.Select_Year(Data, Calendar, 2022)
 
 	# ==================================================
 	# Plot climatological seasonal cycle
 	Plot_Data = {\
 		'Data_Mean': Data_Mean, \
-		'Data_CI'  : [\
-			Data_Mean - 1.96 * Data_Std / np.sqrt(Data_n), \
-			Data_Mean + 1.96 * Data_Std / np.sqrt(Data_n), \
-		], \
+		'Data_CI'  : PrepStat.Calc_CI_t(Clim), \
 		'Data_2022': Data_2022, \
 	}
 
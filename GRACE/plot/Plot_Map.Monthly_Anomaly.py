@@ -5,17 +5,18 @@ Plot monthly anomalies of lwe_thickness
 """
 
 import numpy as np
-import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import cartopy
 import cartopy.crs as ccrs
-import warnings
 import os
 import sys
 sys.path.append('../')
 import preprocessing.Preprocessing_Get_Data as PrepGD
 import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Climatology as PrepClim
+import preprocessing.Preprocessing_Calendar as PrepCal
+import preprocessing.Preprocessing_Statistics as PrepStat
 
 def Plot_Map(Plot_Data, Plot_Config):
 
@@ -42,11 +43,11 @@ def Plot_Map(Plot_Data, Plot_Config):
 		transform=ccrs.PlateCarree(), \
 	)
 
-	# Plot: hatch for Data_Significance < -2 or > 2
+	# Plot: hatch for grid points significant with FDR control (Data_Significance is a boolean mask)
 	ax.contourf(\
 		Plot_Data['Lon'], Plot_Data['Lat'], \
-		np.where((~np.isnan(Plot_Data['Data_Anomaly'])), Plot_Data['Data_Significance'], np.nan), \
-		colors='none', levels=[-999, -2, 2, 999], hatches=['////', '', '////'], zorder=9, \
+		np.where((~np.isnan(Plot_Data['Data_Anomaly'])), Plot_Data['Data_Significance'].astype(np.float64), np.nan), \
+		colors='none', levels=[-0.5, 0.5, 1.5], hatches=['', '////'], zorder=9, \
 		transform=ccrs.PlateCarree(), \
 	)
 	mpl.rcParams['hatch.linewidth'] = 0.5
@@ -92,35 +93,29 @@ if (__name__ == '__main__'):
 	# Crop data
 	Data, Lat, Lon = Prep.Crop_Range(Data, Lat, Lon, Range='EastAsia_Analysis_Extended')
 
-	# Convert Time to YYYY-MM-DD format and convert to pandas datetime
-	Time = pd.Series([pd.to_datetime(str(i_Time)[0:10]) for i_Time in Time])
+	# Get climatology of each grid point (precomputed and stored)
+	Clim = PrepClim.Get_Climatology('lwe_thickness', 'EastAsia_Analysis_Extended')
+
+	# Get calendar index of time, and extract 2022 data into 12 months (nan for months not available)
+	Calendar       = PrepCal.Get_Calendar(Time)
+	Data_2022_Year = PrepCal.Select_Year(Data, Calendar, 2022)
+
+	# Calculate anomalies of all months, and test their significance with FDR control over each map
+	Data_Anomaly      = np.ma.filled(Data_2022_Year, np.nan) - Clim['Mean']
+	Data_Significance = PrepStat.Calc_FDR_Mask(PrepStat.Calc_P_Value(Data_Anomaly, Clim))
 	
 	# ==================================================
 	# Plot anomaly for each month
 	for ind_Month in np.arange(12):
 
-		# Extract data for the month
-		Data_Month = Data[Time.dt.month == (ind_Month + 1), ...]
-
-		# Extract data for 2022 and the month
-		Data_2022 = Data[(Time.dt.year == 2022)&(Time.dt.month == (ind_Month + 1)), ...].squeeze()
-
-		# Skip if Data_2022 is empty
-		if (Data_2022.size == 0): continue
-
-		# Calculate the mean, standard deviation
-		with warnings.catch_warnings():
-			
-			warnings.simplefilter('ignore', category=RuntimeWarning)
-			
-			Data_Clim_Mean = np.nanmean(Data_Month, axis=0)
-			Data_Clim_Std  = np.nanstd(Data_Month, axis=0)
+		# Skip if 2022 data of the month is not available
+		if not np.any((Calendar['Year'] == 2022) & (Calendar['Month'] == (ind_Month + 1))): continue
 
 		Plot_Data = {\
 			'Lon'                 : Lon, \
 			'Lat'                 : Lat, \
-			'Data_Anomaly'        : (Data_2022 - Data_Clim_Mean), \
-			'Data_Significance'   : (Data_2022 - Data_Clim_Mean) / Data_Clim_Std, \
+			'Data_Anomaly'        : Data_Anomaly[ind_Month, ...], \
+			'Data_Significance'   : Data_Significance[ind_Month, ...], \
 			'Rectangular_Range'   : 'SouthChina_Analysis', \
 		}
 
@@ -1,5 +1,9 @@
 import numpy as np
 
+# ==================================================
+# Default memory budget (in bytes) of each time chunk in streaming mode
+Memory_Budget_Default = 1024 ** 3
+
 def Get_Range(Range):
 
 	if (Range == 'Global_Analysis'):
@@ -178,4 +182,20 @@ def Calc_SpatialAverage(Data, Lat, Lon, Range, Optimization=True):
 	# Calculate spatial average ignoring nan values
 	Data_Avg = np.ma.average(np.ma.MaskedArray(Data, mask=np.isnan(Data)), weights=Mask, axis=(-2, -1))
 
-	return Data_Avg
\ No newline at end of file
+	return Data_Avg
+
+def Get_Chunk_Size(Num_Grid, Itemsize, Memory_Budget):
+
+	"""
+	Get the number of time steps per chunk fitting the memory budget
+	Each grid point is counted with the data itself and the float64 temporaries of the reduction
+	==================================================
+	Input:
+		Num_Grid: number of grid points per time step
+		Itemsize: size (in bytes) of each data value
+		Memory_Budget: memory budget (in bytes) of each time chunk
+	Output:
+		Chunk_Size: number of time steps per chunk (at least 1)
+	"""
+
+	return max(1, int(Memory_Budget // (Num_Grid * (Itemsize + 3 * 8))))
@@ -0,0 +1,187 @@
+import numpy as np
+import scipy.sparse
+
+# ==================================================
+# Calendar index of monthly time steps
+# Year and month codes are integers derived from datetime64 at once (no per-element conversion), and each time step is mapped to
+# a dense (year, month) slot, so partial years, gaps (e.g. between GRACE and GRACE-FO) and duplicated months are handled
+
+def Get_Calendar(Time, Year_List=None):
+
+	"""
+	Get the calendar index of time
+	==================================================
+	Input:
+		Time: numpy array of time (in ascending order)
+		Year_List: numpy array of the dense years of the slots. Default: None (from the first to the last year of time)
+	Output:
+		Calendar: dictionary of
+			Year: numpy array of year of each time step
+			Month: numpy array of month (1 to 12) of each time step
+			Year_List: numpy array of the dense years of the slots
+			Slot: numpy array of the (year, month) slot of each time step, (Year - Year_List[0]) * 12 + Month - 1
+			Num_Slot: number of (year, month) slots, len(Year_List) * 12
+			Complete: whether the time steps fill all slots once in order (whole years without gaps), so data can be reshaped
+	"""
+
+	Month_Code = np.asarray(Time).astype('datetime64[M]').astype(np.int64)
+
+	Year  = Month_Code // 12 + 1970
+	Month = Month_Code % 12 + 1
+
+	if (Year_List is None): Year_List = np.arange(Year[0], Year[-1] + 1) if (len(Year) > 0) else np.array([], dtype=np.int64)
+
+	if (len(Year) > 0) and ((Year[0] < Year_List[0]) or (Year[-1] > Year_List[-1])):
+
+		raise ValueError('Error in Get_Calendar: time is out of Year_List.')
+
+	Slot = Month_Code - (Year_List[0] - 1970) * 12 if (len(Year_List) > 0) else Month_Code
+
+	return {\
+		'Year'     : Year, \
+		'Month'    : Month, \
+		'Year_List': Year_List, \
+		'Slot'     : Slot, \
+		'Num_Slot' : len(Year_List) * 12, \
+		'Complete' : (len(Slot) == len(Year_List) * 12) and (np.array_equal(Slot, np.arange(len(Slot)))), \
+	}
+
+def Get_Days_In_Month(Time):
+
+	"""
+	Get the number of days in the month of each time step
+	==================================================
+	Input:
+		Time: numpy array of time
+	Output:
+		Num_Days: numpy array of the number of days
+	"""
+
+	Month = np.asarray(Time).astype('datetime64[M]')
+
+	return ((Month + 1).astype('datetime64[D]') - Month.astype('datetime64[D]')).astype(np.int64)
+
+def Get_Calendar_Day(Time):
+
+	"""
+	Get the calendar day (0 to 365) of each time step on a 366-day calendar, so a date has the same index in all years
+	(February 29 is 59 and March 1 is 60, also in common years)
+	==================================================
+	Input:
+		Time: numpy array of time
+	Output:
+		Calendar_Day: numpy array of calendar day
+	"""
+
+	Day  = np.asarray(Time).astype('datetime64[D]')
+	Year = Day.astype('datetime64[Y]')
+
+	Day_Of_Year = (Day - Year.astype('datetime64[D]')).astype(np.int64)
+	Num_Days    = ((Year + 1).astype('datetime64[D]') - Year.astype('datetime64[D]')).astype(np.int64)
+
+	# Skip February 29 from March 1 in common years
+	return Day_Of_Year + ((Num_Days == 365) & (Day_Of_Year >= 59))
+
+def Get_Group_Matrix(Group, Num_Group):
+
+	"""
+	Get the sparse one-hot matrix of groups, so grouped sums over time are sparse matrix products
+	==================================================
+	Input:
+		Group: numpy array of group index of each time step
+		Num_Group: number of groups
+	Output:
+		Group_Matrix: scipy.sparse csr matrix (group, time)
+	"""
+
+	return scipy.sparse.csr_matrix((np.ones(len(Group)), (Group, np.arange(len(Group)))), shape=(Num_Group, len(Group)))
+
+def Calc_Group_Mean(Data, Group, Num_Group):
+
+	"""
+	Calculate the mean of each group of time steps, ignoring missing values, by one scatter-add of sums and counts
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Group: numpy array of group index of each time step (e.g. Calendar['Month'] - 1, or Calendar['Slot'])
+		Num_Group: number of groups
+	Output:
+		Data_Mean: numpy array of mean (group, ...), nan for groups without valid values
+		Data_Count: numpy array of the number of valid values (group, ...)
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan).reshape(Data.shape[0], -1)
+	Valid = ~np.isnan(Data)
+
+	Group_Matrix = Get_Group_Matrix(Group, Num_Group)
+	Data_Sum   = Group_Matrix @ np.where(Valid, Data, 0)
+	Data_Count = Group_Matrix @ Valid.astype(np.float64)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Data_Mean = Data_Sum / Data_Count
+
+	return Data_Mean.reshape(Num_Group, *Shape), Data_Count.astype(np.int64).reshape(Num_Group, *Shape)
+
+def To_Year_Month(Data, Calendar):
+
+	"""
+	Arrange data into (year, month, ...) slots
+	For complete years the result is a view of data (no copy). Otherwise missing slots are nan, and duplicated months are averaged
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Calendar: dictionary from Get_Calendar
+	Output:
+		Data_Year_Month: numpy array of data (year, month, ...)
+	"""
+
+	Shape = Data.shape[1:]
+
+	if (Calendar['Complete']):
+
+		return Data.reshape(len(Calendar['Year_List']), 12, *Shape)
+
+	if (len(np.unique(Calendar['Slot'])) == len(Calendar['Slot'])):
+
+		# Scatter each time step into its slot
+		Data_Year_Month = np.full((Calendar['Num_Slot'], *Shape), np.nan, dtype=np.result_type(Data.dtype, np.float32))
+		Data_Year_Month[Calendar['Slot'], ...] = np.ma.filled(np.ma.asarray(Data).astype(Data_Year_Month.dtype), np.nan)
+
+	else:
+
+		Data_Year_Month = Calc_Group_Mean(Data, Calendar['Slot'], Calendar['Num_Slot'])[0]
+
+	return Data_Year_Month.reshape(len(Calendar['Year_List']), 12, *Shape)
+
+def Select_Year(Data, Calendar, Year):
+
+	"""
+	Select the 12 months of a year, with nan for missing months
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Calendar: dictionary from Get_Calendar
+		Year: year
+	Output:
+		Data_Year: numpy array of data (12, ...). A view of data if the year is complete
+	"""
+
+	Index = np.flatnonzero(Calendar['Year'] == Year)
+
+	# Complete year in order: slice of data
+	if (len(Index) == 12) and (np.array_equal(Calendar['Month'][Index], np.arange(1, 13))) and (Index[-1] - Index[0] == 11):
+
+		return Data[Index[0]:Index[-1] + 1, ...]
+
+	Calendar_Year = {\
+		'Year'     : Calendar['Year'][Index], \
+		'Month'    : Calendar['Month'][Index], \
+		'Year_List': np.array([Year]), \
+		'Slot'     : Calendar['Month'][Index] - 1, \
+		'Num_Slot' : 12, \
+		'Complete' : False, \
+	}
+
+	return To_Year_Month(Data[Index, ...], Calendar_Year)[0]
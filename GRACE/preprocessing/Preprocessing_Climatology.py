@@ -0,0 +1,469 @@
+import numpy as np
+import glob
+import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing as Prep
+import preprocessing.Preprocessing_Get_Data as PrepGD
+import preprocessing.Preprocessing_Calendar as PrepCal
+
+# ==================================================
+# Climatology of each calendar month, as streaming statistics:
+# Count: number of valid values, Mean: mean, M2: sum of squared deviations from the mean
+# The statistics of two parts of a record are merged exactly (Chan et al.), so the data is reduced in one pass of time chunks,
+# and the stored statistics are updated by adding and removing months instead of recalculating the whole record
+
+def Get_Month_Index(Time):
+
+	"""
+	Get the calendar month index of time
+	==================================================
+	Input:
+		Time: numpy array of time
+	Output:
+		Month_Index: numpy array of calendar month index (0 for January, ..., 11 for December)
+	"""
+
+	return np.asarray(Time).astype('datetime64[M]').astype(np.int64) % 12
+
+def Get_Baseline_Slice(Time, Baseline=None):
+
+	"""
+	Get the time slice of the baseline period
+	==================================================
+	Input:
+		Time: numpy array of time (in ascending order)
+		Baseline: [year_start, year_end] (inclusive). Default: None (whole record)
+	Output:
+		Time_Slice: slice of the time steps in the baseline period
+	"""
+
+	if (Baseline is None): return slice(0, len(Time))
+
+	Year = np.asarray(Time).astype('datetime64[Y]').astype(np.int64) + 1970
+
+	return slice(np.searchsorted(Year, Baseline[0], side='left'), np.searchsorted(Year, Baseline[1], side='right'))
+
+def Calc_Chunk_Climatology(Data, Month_Index):
+
+	"""
+	Calculate the climatological statistics of a chunk of data in one vectorized pass
+	==================================================
+	Input:
+		Data: numpy array of data with nan for missing values. The first dimension should be time
+		Month_Index: numpy array of calendar month index of each time step
+	Output:
+		Clim: dictionary of Count, Mean and M2, each of shape (12, ...)
+	"""
+
+	Data  = Data.reshape(Data.shape[0], -1)
+	Valid = ~np.isnan(Data)
+
+	# One-hot matrix of calendar months, so the reductions are matrix products
+	Month_Matrix = np.zeros((12, Data.shape[0]))
+	Month_Matrix[Month_Index, np.arange(Data.shape[0])] = 1
+
+	Count = Month_Matrix @ Valid
+	Sum   = Month_Matrix @ np.where(Valid, Data, 0)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Mean = Sum / Count
+
+	M2 = Month_Matrix @ np.where(Valid, Data - np.nan_to_num(Mean)[Month_Index, :], 0) ** 2
+
+	return {'Count': Count.astype(np.int64), 'Mean': Mean, 'M2': M2}
+
+def Merge_Climatology(Clim_A, Clim_B):
+
+	"""
+	Merge the climatological statistics of two disjoint parts of a record
+	==================================================
+	Input:
+		Clim_A, Clim_B: dictionaries of Count, Mean and M2
+	Output:
+		Clim: dictionary of Count, Mean and M2 of both parts
+	"""
+
+	Count_A, Count_B = Clim_A['Count'], Clim_B['Count']
+	Mean_A , Mean_B  = np.where(Count_A > 0, Clim_A['Mean'], 0), np.where(Count_B > 0, Clim_B['Mean'], 0)
+	Count = Count_A + Count_B
+	Delta = Mean_B - Mean_A
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Mean = (Count_A * Mean_A + Count_B * Mean_B) / Count
+		M2   = Clim_A['M2'] + Clim_B['M2'] + np.where(Count > 0, Delta ** 2 * Count_A * Count_B / Count, 0)
+
+	return {'Count': Count, 'Mean': Mean, 'M2': M2}
+
+def Remove_Climatology(Clim, Clim_B):
+
+	"""
+	Remove the climatological statistics of a part of a record from those of the whole record (the inverse of Merge_Climatology)
+	==================================================
+	Input:
+		Clim: dictionary of Count, Mean and M2 of the whole record
+		Clim_B: dictionary of Count, Mean and M2 of the part to remove
+	Output:
+		Clim: dictionary of Count, Mean and M2 of the rest of the record
+	"""
+
+	Count_B = Clim_B['Count']
+	Mean_B  = np.where(Count_B > 0, Clim_B['Mean'], 0)
+	Count_A = Clim['Count'] - Count_B
+
+	if (np.any(Count_A < 0)):
+
+		raise ValueError('Error in Remove_Climatology: more values removed than included.')
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Mean_A = (Clim['Count'] * np.where(Clim['Count'] > 0, Clim['Mean'], 0) - Count_B * Mean_B) / Count_A
+		Delta  = Mean_B - np.where(Count_A > 0, Mean_A, 0)
+		M2_A   = Clim['M2'] - Clim_B['M2'] - np.where(Count_A > 0, Delta ** 2 * Count_A * Count_B / (Count_A + Count_B), 0)
+
+	# Clip the rounding errors of the subtraction
+	M2_A = np.where(Count_A > 0, np.maximum(M2_A, 0), 0)
+
+	return {'Count': Count_A, 'Mean': Mean_A, 'M2': M2_A}
+
+def Calc_Climatology(Data, Time, Baseline=None, Chunk_Size=None, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Calculate the mean, variance and count of each calendar month in one streaming pass over time chunks
+	==================================================
+	Input:
+		Data: numpy array (or masked array, dask array, or lazily opened xarray DataArray) of data. The first dimension should be time
+		Time: numpy array of time (in ascending order)
+		Baseline: [year_start, year_end] (inclusive). Default: None (whole record)
+		Chunk_Size: number of time steps per chunk. Default: None (from Memory_Budget)
+		Memory_Budget: memory budget (in bytes) of each time chunk. Default: Prep.Memory_Budget_Default
+	Output:
+		Clim: dictionary of Count, Mean and M2, each of shape (12, ...) (see Get_Variance and Get_Std)
+	"""
+
+	Time_Slice = Get_Baseline_Slice(Time, Baseline)
+	Month_Index = Get_Month_Index(Time)
+	Shape = Data.shape[1:]
+
+	if (Chunk_Size is None): Chunk_Size = Prep.Get_Chunk_Size(int(np.prod(Shape)), 8, Memory_Budget)
+
+	Clim = {\
+		'Count': np.zeros((12, int(np.prod(Shape))), dtype=np.int64), \
+		'Mean' : np.full((12, int(np.prod(Shape))), np.nan), \
+		'M2'   : np.zeros((12, int(np.prod(Shape)))), \
+	}
+
+	for i_Time in range(Time_Slice.start, Time_Slice.stop, Chunk_Size):
+
+		i_Time_Slice = slice(i_Time, min(i_Time + Chunk_Size, Time_Slice.stop))
+
+		# Read the chunk as float64 with nan for missing values
+		Data_Chunk = Data[i_Time_Slice, ...]
+		if (hasattr(Data_Chunk, 'values')): Data_Chunk = Data_Chunk.values
+		Data_Chunk = np.ma.filled(np.ma.asarray(Data_Chunk).astype(np.float64), np.nan)
+
+		Clim = Merge_Climatology(Clim, Calc_Chunk_Climatology(Data_Chunk, Month_Index[i_Time_Slice]))
+
+	return {i: j.reshape(12, *Shape) for i, j in Clim.items()}
+
+def Get_Variance(Clim, ddof=0):
+
+	"""
+	Get the variance of each calendar month
+	==================================================
+	Input:
+		Clim: dictionary of Count, Mean and M2
+		ddof: delta degrees of freedom (0 as np.nanstd, 1 as pandas std). Default: 0
+	Output:
+		Variance: numpy array of variance (nan where Count <= ddof)
+	"""
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		return np.where(Clim['Count'] > ddof, Clim['M2'] / (Clim['Count'] - ddof), np.nan)
+
+def Get_Std(Clim, ddof=0):
+
+	"""
+	Get the standard deviation of each calendar month
+	==================================================
+	Input:
+		Clim: dictionary of Count, Mean and M2
+		ddof: delta degrees of freedom (0 as np.nanstd, 1 as pandas std). Default: 0
+	Output:
+		Std: numpy array of standard deviation
+	"""
+
+	return np.sqrt(Get_Variance(Clim, ddof))
+
+def Calc_Anomaly(Data, Time, Clim, ddof=0):
+
+	"""
+	Calculate the anomaly and standardized anomaly (z-score) of data from the climatology of its calendar months
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Time: numpy array of time
+		Clim: dictionary of Count, Mean and M2
+		ddof: delta degrees of freedom of the standard deviation. Default: 0
+	Output:
+		Anomaly: numpy array of anomaly with nan for missing values (float32 if data is float32, otherwise float64)
+		Zscore: numpy array of standardized anomaly
+	"""
+
+	Dtype = np.float32 if (Data.dtype == np.float32) else np.float64
+	Data  = np.ma.filled(np.ma.asarray(Data).astype(Dtype), np.nan)
+	Month_Index = Get_Month_Index(Time)
+
+	Anomaly = Data - Clim['Mean'][Month_Index, ...].astype(Dtype)
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Zscore = Anomaly / Get_Std(Clim, ddof)[Month_Index, ...].astype(Dtype)
+
+	return Anomaly, Zscore
+
+def Iter_Anomaly_Cube(Data, Time, Clim, ddof=0, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Calculate the anomaly and standardized anomaly (z-score) cubes (year, month, ...) block by block of years
+	Each block is read once and broadcast against the climatology, so the data can be larger than memory
+	==================================================
+	Input:
+		Data: numpy array (or masked array, dask array, or lazily opened xarray DataArray) of data. The first dimension should be time
+		Time: numpy array of time (in ascending order)
+		Clim: dictionary of Count, Mean and M2
+		ddof: delta degrees of freedom of the standard deviation. Default: 0
+		Memory_Budget: memory budget (in bytes) of each block. Default: Prep.Memory_Budget_Default
+	Yield:
+		Year_List: numpy array of years of the block
+		Anomaly: numpy array of anomaly (year, month, ...), nan for missing values and months
+		Zscore: numpy array of standardized anomaly (year, month, ...)
+	"""
+
+	Calendar = PrepCal.Get_Calendar(Time)
+	Shape    = Data.shape[1:]
+	Dtype    = np.float32 if (Data.dtype == np.float32) else np.float64
+	Mean     = Clim['Mean'].astype(Dtype)
+	Std      = Get_Std(Clim, ddof).astype(Dtype)
+
+	# Number of years per block
+	Num_Year = max(1, Prep.Get_Chunk_Size(12 * int(np.prod(Shape)), np.dtype(Dtype).itemsize, Memory_Budget))
+	for ind_Year in range(0, len(Calendar['Year_List']), Num_Year):
+
+		Year_List  = Calendar['Year_List'][ind_Year:ind_Year + Num_Year]
+		Time_Slice = slice(np.searchsorted(Calendar['Year'], Year_List[0], side='left'), np.searchsorted(Calendar['Year'], Year_List[-1], side='right'))
+
+		# Read the block with nan for missing values, and arrange into (year, month, ...) slots
+		Data_Block = Data[Time_Slice, ...]
+		if (hasattr(Data_Block, 'values')): Data_Block = Data_Block.values
+		Data_Block = np.ma.filled(np.ma.asarray(Data_Block).astype(Dtype), np.nan)
+		Data_Block = PrepCal.To_Year_Month(Data_Block, PrepCal.Get_Calendar(Time[Time_Slice], Year_List))
+
+		Anomaly = Data_Block - Mean
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+
+			Zscore = Anomaly / Std
+
+		yield Year_List, Anomaly, Zscore
+
+def Calc_Anomaly_Cube(Data, Time, Clim, ddof=0, Memory_Budget=Prep.Memory_Budget_Default):
+
+	"""
+	Calculate the anomaly and standardized anomaly (z-score) cubes (year, month, ...) of all years (see Iter_Anomaly_Cube)
+	==================================================
+	Input:
+		Data, Time, Clim, ddof, Memory_Budget: see Iter_Anomaly_Cube
+	Output:
+		Year_List: numpy array of years
+		Anomaly: numpy array of anomaly (year, month, ...)
+		Zscore: numpy array of standardized anomaly (year, month, ...)
+	"""
+
+	Block_List = list(Iter_Anomaly_Cube(Data, Time, Clim, ddof, Memory_Budget))
+
+	return tuple(np.concatenate([i[j] for i in Block_List], axis=0) for j in range(3))
+
+def Get_Climatology_File(Var, Range=None, Baseline=None, Spatial_Average=False):
+
+	"""
+	Get the file name of the stored climatology
+	==================================================
+	Input:
+		Var, Range, Baseline, Spatial_Average: see Get_Climatology. Baseline can be '*' for all baseline periods
+	Output:
+		Output_File: file name
+	"""
+
+	return 'Climatology.{Var}.{Range}.{Type}.{Baseline}.npz'.format(\
+		Var=Var, \
+		Range='Global' if (Range is None) else (Range if (isinstance(Range, str)) else '_'.join(str(i) for i in Range)), \
+		Type='SpatialAverage' if (Spatial_Average) else 'Field', \
+		Baseline='All' if (Baseline is None) else (Baseline if (isinstance(Baseline, str)) else '{}-{}'.format(*Baseline)), \
+	)
+
+def Get_Time_Run_List(Time):
+
+	"""
+	Split time steps into runs of consecutive months, so each run is read with one time range
+	==================================================
+	Input:
+		Time: numpy array of time (in ascending order)
+	Output:
+		Time_Run_List: list of [start, end] of time (inclusive) as 'YYYY-MM' strings
+	"""
+
+	if (len(Time) == 0): return []
+
+	Month = np.asarray(Time).astype('datetime64[M]')
+	Index = np.flatnonzero(np.diff(Month.astype(np.int64)) > 1) + 1
+
+	return [[str(i[0]), str(i[-1])] for i in np.split(Month, Index)]
+
+def Read_Data(Var, Range=None, Time_Range=None, Spatial_Average=False):
+
+	"""
+	Read data of the time range for the climatology: the field cropped to the range, or the spatial average over the range
+	==================================================
+	Input:
+		Var, Range, Spatial_Average: see Get_Climatology
+		Time_Range: [start, end] of time (inclusive). Default: None (whole record)
+	Output:
+		Data: numpy array (time, lat, lon) or (time) of data
+		Time: numpy array of time
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	"""
+
+	Data, Time, Lat, Lon = PrepGD.Get_Data(Var, Time_Range=Time_Range)
+
+	if (Spatial_Average):
+
+		Data = Prep.Calc_SpatialAverage(Data, Lat, Lon, Range)
+
+	elif (Range is not None):
+
+		Data, Lat, Lon = Prep.Crop_Range(Data, Lat, Lon, Range)
+
+	return Data, Time, Lat, Lon
+
+def Get_Climatology(Var='lwe_thickness', Range=None, Baseline=None, Spatial_Average=False, Rebuild=False):
+
+	"""
+	Get the climatology of a variable (see Calc_Climatology)
+	The statistics are stored per variable, range and baseline period with the time steps they include. When the source files are
+	newer (e.g. a new month arrives) or the baseline period slides, the stored statistics closest to the requested ones are
+	updated by reading only the months to add and remove
+	==================================================
+	Input:
+		Var: variable name. Default: 'lwe_thickness'
+		Range: [lat_min, lat_max, lon_min, lon_max] or string of region name. Default: None (whole grid)
+		Baseline: [year_start, year_end] (inclusive). Default: None (whole record)
+		Spatial_Average: whether to calculate the climatology of the spatial average over Range, instead of each grid point. Default: False
+		Rebuild: whether to recalculate the whole record, e.g. after months already included are revised. Default: False
+	Output:
+		Clim: dictionary of Count, Mean and M2 of shape (12,) for the spatial average, or (12, lat, lon) with Lat and Lon,
+			  and Time of the included time steps
+	"""
+
+	if (Spatial_Average) and (Range is None):
+
+		raise ValueError('Error in Get_Climatology: Range is required for the spatial average.')
+
+	# Set file paths
+	Source_Time = max(os.path.getmtime(i) for i in PrepGD.Get_File_List())
+	Output_Path = '../output/Output_Data/Climatology/'
+	Output_File = Get_Climatology_File(Var, Range, Baseline, Spatial_Average)
+
+	# Read the stored statistics if they are up to date
+	if (not Rebuild) and (os.path.exists(Output_Path + Output_File)) and (os.path.getmtime(Output_Path + Output_File) >= Source_Time):
+
+		with np.load(Output_Path + Output_File) as npzFile:
+
+			return {i: npzFile[i] for i in npzFile.files}
+
+	# ==================================================
+	# Get the time steps of the baseline period (only time coordinates are read)
+	Time_All = PrepGD.Get_Time()
+	Time     = Time_All[Get_Baseline_Slice(Time_All, Baseline)]
+
+	# ==================================================
+	# Find the stored statistics (of any baseline period) needing the fewest months to add and remove
+	Clim, Num_Update = None, len(Time)
+
+	for i_File in ([] if (Rebuild) else glob.glob(Output_Path + Get_Climatology_File(Var, Range, '*', Spatial_Average))):
+
+		with np.load(i_File) as npzFile:
+
+			if ('Time' not in npzFile.files): continue
+
+			i_Num_Update = np.sum(~np.isin(npzFile['Time'], Time)) + np.sum(~np.isin(Time, npzFile['Time']))
+			if (i_Num_Update < Num_Update): Clim, Num_Update = {i: npzFile[i] for i in npzFile.files}, i_Num_Update
+
+	if (Clim is None):
+
+		# Calculate the statistics of the baseline period (only the baseline period is read)
+		Time_Range = None if (Baseline is None) else ['{}-01'.format(Baseline[0]), '{}-12'.format(Baseline[1])]
+		Data, Time_Read, Lat, Lon = Read_Data(Var, Range, Time_Range, Spatial_Average)
+
+		Clim = Calc_Climatology(Data, Time_Read)
+		if (not Spatial_Average): Clim.update({'Lat': Lat, 'Lon': Lon})
+
+	else:
+
+		# Update the stored statistics by removing and adding months (only these months are read)
+		# Time steps read are matched against the ones to update, as a month may hold several solutions
+		Time_Remove = Clim['Time'][~np.isin(Clim['Time'], Time)]
+		Time_Add    = Time[~np.isin(Time, Clim['Time'])]
+
+		for i_Time_Range in Get_Time_Run_List(Time_Remove):
+
+			Data, Time_Read, _, _ = Read_Data(Var, Range, i_Time_Range, Spatial_Average)
+			Index = np.isin(Time_Read, Time_Remove)
+			Clim.update(Remove_Climatology(Clim, Calc_Climatology(Data[Index, ...], Time_Read[Index])))
+
+		for i_Time_Range in Get_Time_Run_List(Time_Add):
+
+			Data, Time_Read, _, _ = Read_Data(Var, Range, i_Time_Range, Spatial_Average)
+			Index = np.isin(Time_Read, Time_Add)
+			Clim.update(Merge_Climatology(Clim, Calc_Climatology(Data[Index, ...], Time_Read[Index])))
+
+	Clim['Time'] = Time
+
+	# Store the statistics
+	if not os.path.exists(Output_Path): os.makedirs(Output_Path)
+	np.savez(Output_Path + Output_File + '.tmp.npz', **Clim)
+	os.replace(Output_Path + Output_File + '.tmp.npz', Output_Path + Output_File)
+
+	return Clim
+
+def Get_Anomaly(Var='lwe_thickness', Time_Range=None, Range=None, Baseline=None, Spatial_Average=False, ddof=0):
+
+	"""
+	Get the anomaly and standardized anomaly (z-score) of the given months, e.g. of a newly arrived month
+	Only these months are read, and the stored climatology is updated incrementally (see Get_Climatology)
+	==================================================
+	Input:
+		Var: variable name. Default: 'lwe_thickness'
+		Time_Range: [start, end] of time (inclusive), e.g. ['2023-01', '2023-01']. Default: None (whole record)
+		Range, Baseline, Spatial_Average: see Get_Climatology
+		ddof: delta degrees of freedom of the standard deviation. Default: 0
+	Output:
+		Anomaly: numpy array of anomaly with nan for missing values
+		Zscore: numpy array of standardized anomaly
+		Time: numpy array of time
+		Lat: numpy array of latitude
+		Lon: numpy array of longitude
+	"""
+
+	Clim = Get_Climatology(Var, Range, Baseline, Spatial_Average)
+
+	# Read only the months
+	Data, Time, Lat, Lon = Read_Data(Var, Range, Time_Range, Spatial_Average)
+
+	Anomaly, Zscore = Calc_Anomaly(Data, Time, Clim, ddof)
+
+	return Anomaly, Zscore, Time, Lat, Lon
@@ -1,47 +1,171 @@
 import numpy as np
 import pandas as pd
 import xarray as xr
+import concurrent.futures
 import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing_Cache as PrepCache
 
-def Get_Data(Var='lwe_thickness'):
+def Get_File_List():
+
+	"""
+	Get the monthly GRD-3 files sorted by the start date in the file name (e.g. GRD-3_2022305-2022334_...: YYYYDDD from 2022-305)
+	==================================================
+	Output:
+		File_List: list of file paths in time order
+	"""
+
+	# Set data path
+	Data_Path = '/work5/TELLUS_GRFO_L3_CSR_RL06.1_LND_v04/'
+
+	File_List = [i for i in os.listdir(Data_Path) if i.endswith('.nc')]
+	File_List = sorted(File_List, key=lambda x: int(x[6:13]))
+
+	return [Data_Path + i for i in File_List]
+
+def Get_Time_Index(Time, Time_Range):
+
+	"""
+	Get the boolean index of the time steps within the time range
+	==================================================
+	Input:
+		Time: numpy array of time
+		Time_Range: [start, end] of time (inclusive), e.g. ['2023-01', '2023-12']
+	Output:
+		Index: boolean numpy array
+	"""
+
+	Month = np.asarray(Time).astype('datetime64[M]')
+
+	return (Month >= np.datetime64(Time_Range[0], 'M')) & (Month <= np.datetime64(Time_Range[1], 'M'))
+
+def Get_Time_List(File_List, Max_Workers=8):
+
+	"""
+	Get the time steps of each file, reading only the time coordinate
+	==================================================
+	Input:
+		File_List: list of file paths
+		Max_Workers: maximum number of files read concurrently. Default: 8
+	Output:
+		Time_List: list of numpy arrays of time, one per file
+	"""
+
+	def Read_Time(File):
+
+		with xr.open_dataset(File) as ncFile:
+
+			return ncFile['time'].values
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=Max_Workers) as Executor:
+
+		return list(Executor.map(Read_Time, File_List))
+
+def Get_Time(Time_Range=None, Max_Workers=8):
+
+	"""
+	Get the time steps of the record without reading data
+	==================================================
+	Input:
+		Time_Range: [start, end] of time (inclusive), e.g. ['2023-01', '2023-12']. Default: None (whole record)
+		Max_Workers: see Get_Time_List
+	Output:
+		Time: numpy array of time
+	"""
+
+	Time = np.concatenate(Get_Time_List(Get_File_List(), Max_Workers))
+
+	return Time if (Time_Range is None) else Time[Get_Time_Index(Time, Time_Range)]
+
+def Get_Data(Var='lwe_thickness', Time_Range=None, Max_Workers=8, Cache=True):
 
 	"""
 	Get data by xarray and convert to numpy array
+	The monthly files are read concurrently by a bounded thread pool, directly into a preallocated array
+	With Time_Range, only the time coordinates of the other files are read
 	==================================================
 	Input:
 		Var: variable name. Default: 'lwe_thickness'
+		Time_Range: [start, end] of time (inclusive), e.g. ['2023-01', '2023-12']. Default: None (whole record)
+		Max_Workers: maximum number of files read concurrently. Default: 8
+		Cache: whether to use the decoded-array cache (see Preprocessing_Cache). Default: True
 	Output:
-		Data: numpy array of data
+		Data: numpy array of data. Read-only if from the cache
 		Time: numpy array of time
 		Lat: numpy array of latitude
 		Lon: numpy array of longitude
 	"""
 
-	# Set data path
-	Data_Path = '/work5/TELLUS_GRFO_L3_CSR_RL06.1_LND_v04/'
+	# List files in time order
+	File_List = Get_File_List()
 
-	# Get data and time from all nc files
-	Data = []
-	Time = []
+	# Select the files with time steps within the time range
+	if (Time_Range is not None):
 
-	File_List = [i for i in os.listdir(Data_Path) if i.endswith('.nc')]
-	File_List = sorted(File_List, key=lambda x: int(x[6:12]))
-	
-	for i_File in File_List:
-		
-		Data.append(xr.open_dataset(Data_Path + i_File)[Var].values)
-		Time.append(xr.open_dataset(Data_Path + i_File)['time'].values)
+		File_List = [i for i, i_Time in zip(File_List, Get_Time_List(File_List, Max_Workers)) if (np.any(Get_Time_Index(i_Time, Time_Range)))]
+
+		if (len(File_List) == 0):
+
+			raise ValueError('Error in Get_Data: no time steps within the time range.')
 
-	Data = np.concatenate(Data, axis=0)
-	Time = np.concatenate(Time, axis=0)
+	# Get decoded arrays from the cache
+	if (Cache):
 
-	# Get latitude and longitude from GRD-3_2022305-2022334_GRFO_UTCSR_BA01_0601_LND_v04.nc
-	Lat  = xr.open_dataset(Data_Path + 'GRD-3_2022305-2022334_GRFO_UTCSR_BA01_0601_LND_v04.nc')['lat'].values
-	Lon  = xr.open_dataset(Data_Path + 'GRD-3_2022305-2022334_GRFO_UTCSR_BA01_0601_LND_v04.nc')['lon'].values
+		Cache_Key  = PrepCache.Get_Cache_Key(File_List, Function='Get_Data', Var=Var, Fill_Value=-99999., Time_Range=Time_Range)
+		Cache_Data = PrepCache.Get_Cache(Cache_Key)
+
+		if (Cache_Data is not None):
+
+			return Cache_Data['Data'], Cache_Data['Time'], Cache_Data['Lat'], Cache_Data['Lon']
+
+	# ==================================================
+	# Get latitude, longitude and the shape of each file from the first file
+	with xr.open_dataset(File_List[0]) as ncFile:
+
+		Lat        = ncFile['lat'].values
+		Lon        = ncFile['lon'].values
+		Shape_File = ncFile[Var].shape
+		Dtype_Data = ncFile[Var].dtype
+		Dtype_Time = ncFile['time'].dtype
+
+	# Preallocate output arrays
+	Num_Time = Shape_File[0]
+	Data = np.empty((len(File_List) * Num_Time, *Shape_File[1:]), dtype=Dtype_Data)
+	Time = np.empty(len(File_List) * Num_Time, dtype=Dtype_Time)
+
+	# ==================================================
+	# Read each file into its slot of the output arrays
+	def Read_File(ind_File):
+
+		with xr.open_dataset(File_List[ind_File]) as ncFile:
+
+			if (ncFile[Var].shape != Shape_File):
+
+				raise ValueError('Error in Get_Data: shape of {} does not meet the other files.'.format(os.path.basename(File_List[ind_File])))
+
+			Data[ind_File*Num_Time:(ind_File+1)*Num_Time] = ncFile[Var].values
+			Time[ind_File*Num_Time:(ind_File+1)*Num_Time] = ncFile['time'].values
+
+		return
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=Max_Workers) as Executor:
+
+		# Consume the results to raise errors from the threads
+		list(Executor.map(Read_File, range(len(File_List))))
 
 	# Mask fill values to nan
 	Data = np.ma.masked_where(Data == -99999., Data)
 
+	# Select the time steps within the time range (files may hold several time steps)
+	if (Time_Range is not None):
+
+		Index = Get_Time_Index(Time, Time_Range)
+		Data, Time = Data[Index, ...], Time[Index]
+
+	# Put decoded arrays into the cache
+	if (Cache): PrepCache.Set_Cache(Cache_Key, {'Data': Data, 'Time': Time, 'Lat': Lat, 'Lon': Lon})
+
 	return Data, Time, Lat, Lon
 
 if (__name__ == '__main__'):
@@ -0,0 +1,205 @@
+import numpy as np
+import scipy.stats
+import concurrent.futures
+import os
+import sys
+sys.path.append('../')
+import preprocessing.Preprocessing_Calendar as PrepCal
+
+def Calc_CI_t(Clim, Confidence=0.95):
+
+	"""
+	Calculate the Student-t confidence interval of the mean of each calendar month from the climatological statistics
+	==================================================
+	Input:
+		Clim: dictionary of Count, Mean and M2 (see Preprocessing_Climatology)
+		Confidence: confidence level. Default: 0.95
+	Output:
+		CI: numpy array of [lower, upper] bounds (2, 12, ...), nan where Count < 2
+	"""
+
+	Count = Clim['Count']
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		# Standard error of the mean from the sample standard deviation (ddof=1)
+		Std_Error = np.sqrt(np.where(Count > 1, Clim['M2'] / (Count - 1), np.nan) / Count)
+		t_Value   = scipy.stats.t.ppf(0.5 + Confidence / 2, np.where(Count > 1, Count - 1, np.nan))
+
+	return np.stack([Clim['Mean'] - t_Value * Std_Error, Clim['Mean'] + t_Value * Std_Error])
+
+def Get_Resample_Count(Num_Sample, Num_Resample, Seed=0):
+
+	"""
+	Get the index matrix of bootstrap resamples, as the number of times each sample is drawn in each resample
+	Drawing indices with replacement is equivalent to a multinomial count, so a resample mean is a row of a matrix product
+	==================================================
+	Input:
+		Num_Sample: number of samples
+		Num_Resample: number of resamples
+		Seed: seed of the random number generator. Default: 0
+	Output:
+		Resample_Count: numpy array of counts (resample, sample)
+	"""
+
+	return np.random.default_rng(Seed).multinomial(Num_Sample, np.full(Num_Sample, 1 / Num_Sample), size=Num_Resample).astype(np.float64)
+
+def Calc_Bootstrap_Mean_CI(Data, Resample_Count, Confidence=0.95):
+
+	"""
+	Calculate the percentile bootstrap confidence interval of the mean of samples at each grid point
+	==================================================
+	Input:
+		Data: numpy array of samples (sample, grid point) with nan for missing values
+		Resample_Count: numpy array of counts (resample, sample) from Get_Resample_Count
+		Confidence: confidence level. Default: 0.95
+	Output:
+		CI: numpy array of [lower, upper] bounds (2, grid point)
+	"""
+
+	Valid = ~np.isnan(Data)
+
+	# Resample means of all grid points by two matrix products (grid point, resample), so each quantile is along contiguous memory
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		Data_Mean = (np.where(Valid, Data, 0).T @ Resample_Count.T) / (Valid.T.astype(np.float64) @ Resample_Count.T)
+
+	Quantile = [0.5 - Confidence / 2, 0.5 + Confidence / 2]
+
+	# Resamples without valid values are nan (e.g. grid points with missing values in some years)
+	if (np.all(Valid)):
+
+		return np.quantile(Data_Mean, Quantile, axis=1)
+
+	CI = np.full((2, Data.shape[1]), np.nan)
+	Index_Valid = np.any(Valid, axis=0)
+	Index_Full  = np.all(~np.isnan(Data_Mean), axis=1) & Index_Valid
+
+	CI[:, Index_Full] = np.quantile(Data_Mean[Index_Full, :], Quantile, axis=1)
+	CI[:, Index_Valid & ~Index_Full] = np.nanquantile(Data_Mean[Index_Valid & ~Index_Full, :], Quantile, axis=1)
+
+	return CI
+
+def Calc_CI_Bootstrap(Data, Time, Confidence=0.95, Num_Resample=10000, Seed=0, Max_Workers=None, Memory_Budget=256 * 1024 ** 2):
+
+	"""
+	Calculate the percentile bootstrap confidence interval of the mean of each calendar month, for series or grids
+	The years of each month are resampled with the same index matrix at all grid points (a fixed seed), and the grid points are
+	reduced in blocks spread across a thread pool (the matrix products and quantiles release the GIL)
+	==================================================
+	Input:
+		Data: numpy array (or masked array) of data. The first dimension should be time
+		Time: numpy array of time
+		Confidence: confidence level. Default: 0.95
+		Num_Resample: number of resamples. Default: 10000
+		Seed: seed of the random number generator. Default: 0
+		Max_Workers: maximum number of threads. Default: None (number of CPUs)
+		Memory_Budget: memory budget (in bytes) of the resample means of each block. Default: 256 MiB
+	Output:
+		CI: numpy array of [lower, upper] bounds (2, 12, ...), nan for months with less than 2 samples
+	"""
+
+	Shape = Data.shape[1:]
+	Data  = np.ma.filled(np.ma.asarray(Data).astype(np.float64), np.nan).reshape(Data.shape[0], -1)
+	Month = PrepCal.Get_Calendar(Time)['Month']
+	CI    = np.full((2, 12, Data.shape[1]), np.nan)
+
+	# Number of grid points per block (the resample means and the quantile workspace)
+	Block_Size = max(1, int(Memory_Budget // (Num_Resample * 8 * 2)))
+	if (Max_Workers is None): Max_Workers = os.cpu_count()
+
+	for ind_Month in range(12):
+
+		Data_Month = Data[Month == (ind_Month + 1), :]
+		if (Data_Month.shape[0] < 2): continue
+
+		Resample_Count = Get_Resample_Count(Data_Month.shape[0], Num_Resample, Seed + ind_Month)
+
+		# ==================================================
+		def Calc_Block(ind_Block):
+
+			Block_Slice = slice(ind_Block, min(ind_Block + Block_Size, Data.shape[1]))
+			CI[:, ind_Month, Block_Slice] = Calc_Bootstrap_Mean_CI(Data_Month[:, Block_Slice], Resample_Count, Confidence)
+
+			return
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=Max_Workers) as Executor:
+
+			# Consume the results to raise errors from the threads
+			list(Executor.map(Calc_Block, range(0, Data.shape[1], Block_Size)))
+
+	return CI.reshape(2, 12, *Shape)
+
+def Calc_P_Value(Anomaly, Clim, Month=None):
+
+	"""
+	Calculate the two-sided p-value of each anomaly against the climatological distribution of its calendar month
+	The anomaly of a new observation is tested with the Student-t prediction interval, t = anomaly / (s * sqrt(1 + 1/n)), n - 1 dof
+	==================================================
+	Input:
+		Anomaly: numpy array of anomaly. The dimensions should be (..., 12, ...) matching Clim, or the dimensions of Clim of one month
+		Clim: dictionary of Count, Mean and M2 (see Preprocessing_Climatology)
+		Month: month (1 to 12) of the anomaly if it is of one month. Default: None (Anomaly has all months as Clim)
+	Output:
+		P_Value: numpy array of p-value, nan for missing values or Count < 2
+	"""
+
+	Count, M2 = (Clim['Count'], Clim['M2']) if (Month is None) else (Clim['Count'][Month - 1], Clim['M2'][Month - 1])
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+
+		# Sample standard deviation (ddof=1) and the scale of the prediction interval
+		Scale   = np.sqrt(np.where(Count > 1, M2 / (Count - 1), np.nan) * (1 + 1 / Count))
+		t_Value = np.abs(np.asarray(Anomaly, dtype=np.float64)) / Scale
+
+	return 2 * scipy.stats.t.sf(t_Value, np.where(Count > 1, Count - 1, np.nan))
+
+def Calc_FDR_Mask(P_Value, Alpha=0.05, Method='Wilks', Mask_Region=None):
+
+	"""
+	Get the field significance mask controlling the false discovery rate over the region (the last two dimensions) of each map
+	All maps of the leading dimensions (e.g. year, month) are tested in one vectorized pass
+	==================================================
+	Input:
+		P_Value: numpy array of p-value (..., lat, lon), nan for missing values
+		Alpha: significance level. Default: 0.05
+		Method: 'BH' (Benjamini-Hochberg at FDR Alpha) or 'Wilks' (Benjamini-Hochberg at FDR 2 * Alpha, recommended by Wilks (2016)
+				for spatially correlated fields to keep the global test level Alpha). Default: 'Wilks'
+		Mask_Region: boolean numpy array (lat, lon) of the region tested. Default: None (all grid points)
+	Output:
+		Mask: boolean numpy array (..., lat, lon), True for significant grid points
+	"""
+
+	if (Method == 'BH'):
+
+		Alpha_FDR = Alpha
+
+	elif (Method == 'Wilks'):
+
+		Alpha_FDR = 2 * Alpha
+
+	else:
+
+		raise ValueError('Error in Calc_FDR_Mask: wrong method.')
+
+	Shape = P_Value.shape
+	P_Value = np.array(P_Value, dtype=np.float64).reshape(-1, Shape[-2] * Shape[-1])
+	if (Mask_Region is not None): P_Value[:, ~np.asarray(Mask_Region).ravel()] = np.nan
+
+	# Sort p-values of each map (nan at the end) and find the largest p_(i) <= i / N * Alpha_FDR
+	P_Sort  = np.sort(P_Value, axis=1)
+	Num_Valid = np.sum(~np.isnan(P_Value), axis=1, keepdims=True)
+	Rank    = np.arange(1, P_Value.shape[1] + 1)[None, :]
+
+	with np.errstate(invalid='ignore'):
+
+		Pass = P_Sort <= Rank / np.maximum(Num_Valid, 1) * Alpha_FDR
+
+	Index_Max   = P_Value.shape[1] - 1 - np.argmax(Pass[:, ::-1], axis=1)
+	P_Threshold = np.where(np.any(Pass, axis=1), P_Sort[np.arange(P_Value.shape[0]), Index_Max], -1)
+
+	with np.errstate(invalid='ignore'):
+
+		Mask = P_Value <= P_Threshold[:, None]
+
+	return Mask.reshape(Shape)